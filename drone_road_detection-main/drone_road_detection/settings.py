@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -77,14 +78,61 @@ WSGI_APPLICATION = "drone_road_detection.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# SQLite performance profiles, selected with the DJANGO_DB_PROFILE
+# environment variable.  "pragmas" are applied to every new connection,
+# "timeout" is how long (seconds) a connection waits on a lock and
+# "conn_max_age" enables persistent connections.
+SQLITE_PROFILES = {
+    "default": {
+        "pragmas": {},
+        "timeout": 5,
+        "conn_max_age": 0,
+    },
+    # WAL lets readers run while ingestion writes.
+    "performance": {
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -65536,  # KiB, i.e. 64 MiB
+            "mmap_size": 268435456,  # 256 MiB
+            "busy_timeout": 5000,  # ms
+            "temp_store": "MEMORY",
+        },
+        "timeout": 5,
+        "conn_max_age": 600,
+    },
+}
+DB_PROFILE = os.environ.get("DJANGO_DB_PROFILE", "default")
+SQLITE_PRAGMAS = SQLITE_PROFILES[DB_PROFILE]["pragmas"]
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        "OPTIONS": {"timeout": SQLITE_PROFILES[DB_PROFILE]["timeout"]},
+        "CONN_MAX_AGE": SQLITE_PROFILES[DB_PROFILE]["conn_max_age"],
     }
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# The "api" cache holds rendered API responses.  LocMemCache evicts the
+# least recently used entries once MAX_ENTRIES is reached.
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "api": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "web-api",
+        "TIMEOUT": 300,
+        "OPTIONS": {"MAX_ENTRIES": 2000, "CULL_FREQUENCY": 10},
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -123,6 +171,16 @@ STATICFILES_DIRS = [BASE_DIR / "web" / "static"]
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
 
+# Cold storage of archived batches, one compressed .npz per batch
+ARCHIVE_ROOT = BASE_DIR / "archive"
+
+# Smallest IoU between an interpolated box and the original when tracks
+# are stored as keyframes (``convert_frames --to keyframes``)
+TRACK_KEYFRAME_MIN_IOU = 0.9
+
+# Detector class run on every frame by ``ingest_video``, see web.detectors
+VIDEO_DETECTOR = "web.detectors.ContrastDetector"
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -132,6 +190,14 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # Number of defect track thumbnails shown at the bottom section
 TRACK_PREVIEW_LIMIT = 5
 
+# Thumbnails served by /api/thumbnails/<media id>/<preset>/: longest side
+# in pixels per preset, the preset of the track slider, and the size
+# bound of the on-disk cache under MEDIA_ROOT/thumbnails (least recently
+# used files are evicted first)
+THUMBNAIL_PRESETS = {"small": 160, "medium": 320, "large": 640}
+TRACK_THUMBNAIL_PRESET = "medium"
+THUMBNAIL_CACHE_BYTES = 256 * 1024 * 1024
+
 # Road statistics displayed in the header
 ROAD_TOTAL_LENGTH = 568  # km
 ROAD_TOTAL_COUNT = 28    # roads
@@ -139,3 +205,18 @@ ROAD_TOTAL_COUNT = 28    # roads
 # How many days of demo data the management command generates
 DEMO_DAYS = 5
 
+# Lifetime in seconds of cached API responses per endpoint (0 disables).
+# Entries are also retired as soon as the data they depend on changes.
+API_CACHE_TTLS = {
+    "stats": 60,
+    "disease_types": 300,
+    "batches": 60,
+    "boxes": 600,
+    "tracks": 300,
+    "weather": 300,
+}
+
+# Larger response bodies (e.g. whole-batch /api/boxes/) are not cached;
+# with MAX_ENTRIES this bounds the "api" cache to about 128 MB.
+API_CACHE_MAX_BODY = 64 * 1024
+
@@ -11,6 +11,8 @@ from .models import (
     DefectTrack,
     DiseaseMedia,
     GroundTruthFrame,
+    IngestToken,
+    ModelEvaluation,
 )
 
 
@@ -83,3 +85,17 @@ class DiseaseMediaAdmin(admin.ModelAdmin):
 class GroundTruthFrameAdmin(admin.ModelAdmin):
     list_display = ("track", "frame_index", "time")
     list_filter = ("track",)
+
+
+@admin.register(IngestToken)
+class IngestTokenAdmin(admin.ModelAdmin):
+    list_display = ("name", "drone_id", "is_active", "created_at")
+    list_filter = ("is_active",)
+    search_fields = ("name", "drone_id")
+
+
+@admin.register(ModelEvaluation)
+class ModelEvaluationAdmin(admin.ModelAdmin):
+    list_display = ("batch", "model_name", "map", "map50", "mota", "idf1", "created_at")
+    list_filter = ("model_name",)
+    search_fields = ("model_name", "batch__airport")
@@ -0,0 +1,244 @@
+"""Cold storage of expired detection batches.
+
+:func:`archive_batch` exports the frame annotations of a batch, plus a copy
+of its track table, into ``ARCHIVE_ROOT/batch_<id>.npz``.  It then flags the
+batch ``is_archived`` and deletes its ``GroundTruthFrame`` rows (and packed
+track frames, see ``web.trackdata``) in chunks.
+Tracks, media, counters and rollups stay in the database, so dashboards and
+``/api/tracks/`` are unaffected.  ``web.overlay`` reads the annotations of
+archived batches back through :func:`iter_rows`, so old inspections can
+still be replayed.
+
+Frames are stored sorted by ``(frame_index, track_id)`` in compressed
+chunks of :data:`ARCHIVE_CHUNK_ROWS` rows, members ``frame_index_<i>``,
+``time_<i>``, ``track_id_<i>`` and ``bbox_<i>``, with the first and last
+frame of every chunk in ``chunk_first_frame``/``chunk_last_frame``.
+Members of an ``.npz`` are decompressed only when read, so both export and
+:func:`iter_rows` hold one chunk in memory at a time and a frame window
+only reads the chunks it overlaps.  Format 1 archives, which stored each
+column as a single member, are read as one chunk.
+"""
+
+import math
+import os
+import zipfile
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import signals, trackdata
+from .models import DefectTrack, DetectionBatch, GroundTruthFrame, PackedTrackFrames
+from .purge import DEFAULT_CHUNK_SIZE, delete_rows
+
+ARCHIVE_FORMAT = 2
+
+# Frame rows per compressed chunk of an archive.
+ARCHIVE_CHUNK_ROWS = 65536
+
+_COLUMNS = ("frame_index", "time", "track_id", "bbox")
+
+_TRACK_FIELDS = (
+    "pk",
+    "unique_code",
+    "disease_type__name",
+    "start_frame",
+    "end_frame",
+    "start_time",
+    "end_time",
+)
+
+
+def archive_path(batch_id):
+    """Return the archive file of ``batch_id``."""
+    return Path(settings.ARCHIVE_ROOT) / f"batch_{batch_id}.npz"
+
+
+def is_archived(batch_id):
+    """Whether the annotations of ``batch_id`` live in its archive file."""
+    return bool(batch_id) and DetectionBatch.objects.filter(pk=batch_id, is_archived=True).exists()
+
+
+def _nan(value):
+    return math.nan if value is None else value
+
+
+def _column_chunks(rows, size):
+    """Group annotation tuples into :class:`trackdata.BatchColumns` of at
+    most ``size`` rows."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield _columns(chunk)
+            chunk = []
+    if chunk:
+        yield _columns(chunk)
+
+
+def _columns(rows):
+    return trackdata.BatchColumns(
+        np.array([r[0] for r in rows], "<u4"),
+        np.array([_nan(r[1]) for r in rows], "<f8"),
+        np.array([r[2] for r in rows], "<i8"),
+        np.array([r[3:] for r in rows], "<f8").reshape(-1, 4),
+    )
+
+
+def write_archive(path, chunks, arrays=None):
+    """Write an archive of the :class:`trackdata.BatchColumns` ``chunks``,
+    sorted by frame, plus the extra ``arrays``; return the number of rows.
+
+    The file is renamed into place, so readers never see a partial archive.
+    """
+    first, last, rows = [], [], 0
+    tmp = path.with_name(f".{path.name}.tmp")
+
+    def put(zf, name, array):
+        with zf.open(f"{name}.npy", "w", force_zip64=True) as fh:
+            np.lib.format.write_array(fh, np.asanyarray(array), allow_pickle=False)
+
+    with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as zf:
+        for i, chunk in enumerate(chunks):
+            for name, column in zip(_COLUMNS, chunk):
+                put(zf, f"{name}_{i}", column)
+            first.append(chunk.frame_index[0])
+            last.append(chunk.frame_index[-1])
+            rows += len(chunk.frame_index)
+        put(zf, "format", np.array(ARCHIVE_FORMAT))
+        put(zf, "chunk_first_frame", np.array(first, "<u4"))
+        put(zf, "chunk_last_frame", np.array(last, "<u4"))
+        for name, array in (arrays or {}).items():
+            put(zf, name, array)
+    os.replace(tmp, path)
+    return rows
+
+
+def export_batch(batch_id):
+    """Write the archive of ``batch_id``; return ``(path, frame_rows)``.
+
+    Frames are streamed from ``trackdata.iter_rows`` one chunk at a time.
+    """
+    tracks = list(
+        DefectTrack.objects.filter(batch_id=batch_id).order_by("pk").values_list(*_TRACK_FIELDS)
+    )
+    pks, codes, labels, start_frames, end_frames, start_times, end_times = (
+        zip(*tracks) if tracks else ((),) * len(_TRACK_FIELDS)
+    )
+    arrays = {
+        "track_pk": np.array(pks, "<i8"),
+        "track_code": np.array(codes, str),
+        "track_label": np.array(labels, str),
+        "track_start_frame": np.array(start_frames, "<u4"),
+        "track_end_frame": np.array(end_frames, "<u4"),
+        "track_start_time": np.array([_nan(t) for t in start_times], "<f8"),
+        "track_end_time": np.array([_nan(t) for t in end_times], "<f8"),
+    }
+    path = archive_path(batch_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    chunks = _column_chunks(trackdata.iter_rows(batch_id), ARCHIVE_CHUNK_ROWS)
+    return path, write_archive(path, chunks, arrays)
+
+
+def _chunk_names(npz):
+    """Return the member name suffix and frame range of every chunk."""
+    if "chunk_first_frame" not in npz.files:
+        frames = npz["frame_index"]
+        return [("", frames[0], frames[-1])] if len(frames) else []
+    return [
+        (f"_{i}", first, last)
+        for i, (first, last) in enumerate(
+            zip(npz["chunk_first_frame"].tolist(), npz["chunk_last_frame"].tolist())
+        )
+    ]
+
+
+def _chunk(npz, suffix):
+    return trackdata.BatchColumns(*(npz[name + suffix] for name in _COLUMNS))
+
+
+def load(batch_id):
+    """Return :class:`trackdata.BatchColumns` of every archived box of
+    ``batch_id``, for callers that need whole columns."""
+    with np.load(archive_path(batch_id)) as npz:
+        chunks = [_chunk(npz, suffix) for suffix, _, _ in _chunk_names(npz)]
+    if not chunks:
+        return trackdata.BatchColumns(
+            np.empty(0, np.uint32), np.empty(0), np.empty(0, np.int64), np.empty((0, 4))
+        )
+    return trackdata.BatchColumns(*(np.concatenate(column) for column in zip(*chunks)))
+
+
+def remove_archives(batch_ids):
+    """Delete the archive files of ``batch_ids``."""
+    for batch_id in batch_ids:
+        archive_path(batch_id).unlink(missing_ok=True)
+
+
+def iter_rows(batch_id, window=None):
+    """Yield archived annotation tuples like ``overlay.iter_frame_rows``,
+    decompressing only the chunks that overlap a frame window."""
+    window = window or {}
+    low = window.get("frame_index__gte", -math.inf)
+    high = window.get("frame_index__lte", math.inf)
+    with np.load(archive_path(batch_id)) as npz:
+        for suffix, first, last in _chunk_names(npz):
+            if last < low or first > high:
+                continue
+            chunk = _chunk(npz, suffix)
+            mask = trackdata.window_mask(chunk.frame_index, chunk.time, window)
+            yield from trackdata.columns_to_rows(
+                trackdata.BatchColumns(*(column[mask] for column in chunk))
+            )
+
+
+def has_frames(batch_id):
+    """Whether the archive of ``batch_id`` holds any annotation."""
+    with np.load(archive_path(batch_id)) as npz:
+        return bool(_chunk_names(npz))
+
+
+def archive_batch(batch_id, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Move the frame annotations of ``batch_id`` to cold storage.
+
+    The archive is written and the batch flagged before any row is
+    deleted, so an interrupted run is resumed by calling this again: an
+    already archived batch only has its leftover rows removed.  Returns
+    ``(archived_rows, deleted_rows)``.
+    """
+    archived = 0
+    if not (is_archived(batch_id) and archive_path(batch_id).exists()):
+        _, archived = export_batch(batch_id)
+        with transaction.atomic():
+            DetectionBatch.objects.filter(pk=batch_id).update(is_archived=True)
+            delete_rows(
+                PackedTrackFrames,
+                list(
+                    PackedTrackFrames.objects.filter(track__batch_id=batch_id)
+                    .values_list("pk", flat=True)
+                ),
+            )
+            signals.bulk_changed(batch_id)
+
+    deleted = 0
+    frames = GroundTruthFrame.objects.filter(batch_id=batch_id).values_list("pk", flat=True)
+    while True:
+        with transaction.atomic():
+            pks = list(frames[:chunk_size])
+            if not pks:
+                return archived, deleted
+            deleted += delete_rows(GroundTruthFrame, pks)
+
+
+def expired_batches(now=None):
+    """Return the ids of expired batches that still have hot rows."""
+    return list(
+        DetectionBatch.objects.filter(expire_at__lte=now or timezone.now())
+        .filter(Q(is_archived=False) | Q(frames__isnull=False))
+        .order_by("pk")
+        .values_list("pk", flat=True)
+        .distinct()
+    )
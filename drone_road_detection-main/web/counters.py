@@ -0,0 +1,80 @@
+"""Incrementally maintained dashboard counters.
+
+``StatsCounter`` holds one ``global`` row plus one row per detection batch
+so that ``/api/stats/`` is a single primary-key lookup.  The receivers in
+``web.signals`` apply deltas on every write; :func:`rebuild` recomputes
+everything from scratch to repair drift.
+"""
+
+from django.db import transaction
+from django.db.models import Count, F, Q
+
+from .models import DetectionBatch, DefectTrack, StatsCounter
+
+COMPLETED_TREND = "已修复"
+GLOBAL_KEY = "global"
+
+
+def batch_key(batch_id):
+    """Return the counter key of a detection batch."""
+    return f"batch:{batch_id}"
+
+
+def apply(key, inspections=0, defects=0, completed=0):
+    """Add the given deltas to the counter row ``key``."""
+    if not (inspections or defects or completed):
+        return
+    with transaction.atomic():
+        StatsCounter.objects.get_or_create(key=key)
+        StatsCounter.objects.filter(key=key).update(
+            inspection_count=F("inspection_count") + inspections,
+            defect_count=F("defect_count") + defects,
+            completed_count=F("completed_count") + completed,
+        )
+
+
+def apply_tracks(batch_id, defects=0, completed=0):
+    """Apply track deltas to both the global and the batch counters."""
+    with transaction.atomic():
+        apply(GLOBAL_KEY, defects=defects, completed=completed)
+        apply(batch_key(batch_id), defects=defects, completed=completed)
+
+
+@transaction.atomic
+def rebuild():
+    """Recompute every counter from the source tables."""
+    StatsCounter.objects.all().delete()
+    per_batch = (
+        DefectTrack.objects.values("batch_id")
+        .annotate(
+            defects=Count("id"),
+            completed=Count("id", filter=Q(develop_trend=COMPLETED_TREND)),
+        )
+        .order_by()
+    )
+    rows = [
+        StatsCounter(
+            key=batch_key(r["batch_id"]),
+            defect_count=r["defects"],
+            completed_count=r["completed"],
+        )
+        for r in per_batch
+    ]
+    rows.append(
+        StatsCounter(
+            key=GLOBAL_KEY,
+            inspection_count=DetectionBatch.objects.count(),
+            defect_count=sum(r.defect_count for r in rows),
+            completed_count=sum(r.completed_count for r in rows),
+        )
+    )
+    StatsCounter.objects.bulk_create(rows, batch_size=500)
+    return len(rows)
+
+
+def lookup(batch_id=None):
+    """Return ``{key: StatsCounter}`` for the global and batch counters."""
+    keys = [GLOBAL_KEY]
+    if batch_id:
+        keys.append(batch_key(batch_id))
+    return StatsCounter.objects.in_bulk(keys)
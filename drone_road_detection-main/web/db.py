@@ -0,0 +1,12 @@
+"""SQLite connection tuning shared by Django connections and benchmarks."""
+
+
+def pragma_statements(pragmas):
+    """Return the ``PRAGMA`` statements for a ``{name: value}`` mapping."""
+    return [f"PRAGMA {name} = {value}" for name, value in pragmas.items()]
+
+
+def apply_pragmas(cursor, pragmas):
+    """Execute ``pragmas`` on a DB-API cursor of an SQLite connection."""
+    for statement in pragma_statements(pragmas):
+        cursor.execute(statement)
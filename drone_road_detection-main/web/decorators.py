@@ -0,0 +1,157 @@
+"""View decorators shared by the dashboard APIs."""
+
+import hashlib
+import threading
+from collections import Counter
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+from . import versions
+
+# Largest response body :func:`cached_api` stores, in bytes.
+DEFAULT_MAX_BODY = 64 * 1024
+
+# Per-process hit/miss counters of :func:`cached_api`.
+_cache_counts = Counter()
+_cache_lock = threading.Lock()
+
+
+def global_scopes(request):
+    """Scopes of views whose data spans every batch."""
+    return [versions.GLOBAL_SCOPE]
+
+
+def batch_scopes(request):
+    """Scopes of views that can be narrowed with a ``batch`` parameter."""
+    batch_id = request.GET.get("batch")
+    if batch_id:
+        return [versions.batch_scope(batch_id), versions.DICTIONARY_SCOPE]
+    return [versions.GLOBAL_SCOPE]
+
+
+def _request_versions(request, names):
+    """Return the data versions of ``names``, memoised on the request."""
+    memo = request.__dict__.setdefault("_data_versions", {})
+    missing = [name for name in names if name not in memo]
+    if missing:
+        found = versions.state(missing)
+        for name in missing:
+            memo[name] = found.get(name, (0, None))
+    return {name: memo[name] for name in names}
+
+
+def _representation_key(view, request, current):
+    """Hash everything a response representation depends on."""
+    return hashlib.md5(
+        "\n".join(
+            [
+                view.__name__,
+                request.get_full_path(),
+                request.headers.get("Accept", ""),
+            ]
+            + [f"{name}={version}" for name, (version, _) in sorted(current.items())]
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def conditional_api(scopes):
+    """Answer conditional GETs from data versions before running the view.
+
+    ``scopes(request)`` names the version scopes the response depends on.
+    The ETag hashes the request path, its ``Accept`` header and those
+    versions.  Matching ``If-None-Match`` requests get ``304 Not Modified``
+    after a single version lookup.  No ``Last-Modified`` is sent: it only
+    has whole-second resolution, so a write in the same second as the
+    previous one would leave ``If-Modified-Since`` clients with stale data.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view(request, *args, **kwargs)
+            current = _request_versions(request, scopes(request))
+            etag = quote_etag(_representation_key(view, request, current))
+
+            response = get_conditional_response(request, etag=etag)
+            if response is None:
+                response = view(request, *args, **kwargs)
+            if response.status_code in (200, 304):
+                if not response.has_header("ETag"):
+                    response["ETag"] = etag
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def cached_api(endpoint, scopes):
+    """Cache successful responses of an API view in the ``api`` cache.
+
+    Entries are keyed on the request path, ``Accept`` header and the data
+    versions of ``scopes(request)``.  Model signals bump those versions, so
+    a write to batch N only retires the entries of batch N and of the
+    global aggregates; retired entries age out of the bounded LRU cache.
+    ``settings.API_CACHE_TTLS[endpoint]`` gives the lifetime in seconds
+    (``0`` disables caching for the endpoint).  Bodies larger than
+    ``settings.API_CACHE_MAX_BODY`` bytes are not stored, so the memory of
+    the cache stays bounded by its entry count times that limit; such
+    responses still revalidate through their ETag.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            ttls = getattr(settings, "API_CACHE_TTLS", {})
+            timeout = ttls.get(endpoint, ttls.get("default", 0))
+            if request.method not in ("GET", "HEAD") or not timeout:
+                return view(request, *args, **kwargs)
+            cache = caches["api"]
+            current = _request_versions(request, scopes(request))
+            key = f"api:{endpoint}:{_representation_key(view, request, current)}"
+            entry = cache.get(key)
+            if entry is not None:
+                _count(endpoint, "hits")
+                content, content_type = entry
+                return HttpResponse(content, content_type=content_type)
+            _count(endpoint, "misses")
+            response = view(request, *args, **kwargs)
+            max_body = getattr(settings, "API_CACHE_MAX_BODY", DEFAULT_MAX_BODY)
+            if (
+                response.status_code == 200
+                and not response.streaming
+                and len(response.content) <= max_body
+            ):
+                cache.set(key, (response.content, response["Content-Type"]), timeout)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def _count(endpoint, outcome):
+    with _cache_lock:
+        _cache_counts[(endpoint, outcome)] += 1
+
+
+def cache_stats():
+    """Return ``{endpoint: {"hits": n, "misses": n}}`` for this process."""
+    with _cache_lock:
+        items = list(_cache_counts.items())
+    stats = {}
+    for (endpoint, outcome), count in items:
+        stats.setdefault(endpoint, {"hits": 0, "misses": 0})[outcome] = count
+    return stats
+
+
+def reset_cache_stats():
+    """Clear the hit/miss counters."""
+    with _cache_lock:
+        _cache_counts.clear()
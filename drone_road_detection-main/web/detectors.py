@@ -0,0 +1,124 @@
+"""Pluggable frame detectors for ``ingest_video``.
+
+A detector is any class with a ``labels`` attribute and a
+``detect(frame)`` method taking an ``H x W x 3`` RGB ``uint8`` array and
+returning :class:`Detections` with boxes normalised to the frame size.
+Detectors are named by dotted path (``VIDEO_DETECTOR`` or
+``ingest_video --detector``) and built once per worker process.
+
+This module does not touch the database, so it can be imported by the
+worker processes of the ingestion pool.
+"""
+
+import importlib
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+# ``boxes`` is ``(N, 4)`` of normalised ``x, y, w, h``; ``labels`` are
+# disease type names and ``scores`` confidences in ``[0, 1]``.
+Detections = namedtuple("Detections", "boxes labels scores")
+
+
+def empty_detections():
+    return Detections(np.empty((0, 4)), [], np.empty(0))
+
+
+def load_detector(path, **options):
+    """Instantiate the detector class at dotted ``path``."""
+    module, _, name = path.rpartition(".")
+    if not module:
+        raise ValueError(f"detector {path!r} is not a dotted path")
+    return getattr(importlib.import_module(module), name)(**options)
+
+
+class Detector:
+    """Base class of frame detectors."""
+
+    labels = ()
+
+    def detect(self, frame):
+        raise NotImplementedError
+
+
+class NullDetector(Detector):
+    """Detects nothing; measures the decoding and pool overhead."""
+
+    def detect(self, frame):
+        return empty_detections()
+
+
+class ContrastDetector(Detector):
+    """OpenCV baseline finding patches of the road surface that stand out.
+
+    The road is taken to be the unsaturated part of the frame and its
+    median grey level the intact surface.  Pixels departing from it by
+    more than ``delta`` grey levels form the candidate regions; lane paint
+    (``paint`` and brighter) and the road border are excluded.  Connected
+    regions of at least ``min_area`` (a fraction of the frame) are
+    reported, elongated ones (aspect ratio >= ``elongation``) as
+    ``crack_label`` and the others as ``pothole_label``.  Frames are
+    processed at most ``max_width`` pixels wide.
+    """
+
+    def __init__(self, crack_label="裂缝", pothole_label="坑槽", delta=12, paint=200,
+                 max_saturation=60, min_area=1e-4, elongation=2.0, max_width=960):
+        self.crack_label = crack_label
+        self.pothole_label = pothole_label
+        self.labels = (crack_label, pothole_label)
+        self.delta = delta
+        self.paint = paint
+        self.max_saturation = max_saturation
+        self.min_area = min_area
+        self.elongation = elongation
+        self.max_width = max_width
+        self._kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+        self._margin = cv2.getStructuringElement(cv2.MORPH_RECT, (7, 7))
+
+    def detect(self, frame):
+        height, width = frame.shape[:2]
+        if width > self.max_width:
+            scale = self.max_width / width
+            frame = cv2.resize(frame, (self.max_width, round(height * scale)),
+                               interpolation=cv2.INTER_AREA)
+        small_h, small_w = frame.shape[:2]
+        hsv = cv2.cvtColor(frame, cv2.COLOR_RGB2HSV)
+        grey = hsv[..., 2]
+        road = hsv[..., 1] < self.max_saturation
+        if not road.any():
+            return empty_detections()
+
+        surface = np.median(grey[road][::7])
+        excluded = cv2.dilate(
+            ((~road) | (grey >= self.paint)).astype(np.uint8), self._margin
+        ).astype(bool)
+        anomaly = (np.abs(grey.astype(np.int16) - surface) > self.delta) & ~excluded
+        anomaly = cv2.morphologyEx(anomaly.astype(np.uint8), cv2.MORPH_OPEN, self._kernel)
+
+        count, _, stats, _ = cv2.connectedComponentsWithStats(anomaly, connectivity=8)
+        stats = stats[1:]
+        stats = stats[stats[:, cv2.CC_STAT_AREA] >= self.min_area * small_w * small_h]
+        if not len(stats):
+            return empty_detections()
+        x, y, w, h, area = (stats[:, i].astype(np.float64) for i in range(5))
+        boxes = np.stack([x / small_w, y / small_h, w / small_w, h / small_h], axis=1)
+        elongated = np.maximum(w, h) >= self.elongation * np.minimum(w, h)
+        labels = [self.crack_label if e else self.pothole_label for e in elongated]
+        # Share of the box covered by the region, as a crude confidence.
+        scores = np.clip(area / (w * h), 0, 1)
+        return Detections(boxes, labels, scores)
+
+
+_worker_detector = None
+
+
+def init_worker(path, options):
+    """Pool initializer: build the detector of this worker process."""
+    global _worker_detector
+    _worker_detector = load_detector(path, **options)
+
+
+def detect_in_worker(frame_index, frame):
+    """Run the worker's detector; returns ``(frame_index, Detections)``."""
+    return frame_index, _worker_detector.detect(frame)
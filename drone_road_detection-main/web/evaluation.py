@@ -0,0 +1,339 @@
+"""Scoring detector predictions against the ``GroundTruthFrame`` labels.
+
+Predictions of a model live in ``PredictionFrame`` with the same frame and
+box layout as the labels.  :func:`evaluate` works on whole batches at once:
+
+* boxes are grouped by ``(disease type, frame)`` and the IoU of every
+  label/prediction pair within a group is computed in one NumPy pass;
+* detection metrics follow COCO: for each IoU threshold in
+  ``0.50:0.05:0.95`` predictions are matched greedily in score order, and
+  AP is the 101-point interpolated area under the precision/recall curve.
+  ``map`` averages over thresholds and classes with labels;
+* tracking metrics follow CLEAR MOT and the identity measures at IoU 0.5.
+  Per frame, pairs are matched greedily by IoU (continuing correspondences
+  are not preferred), ``MOTA = 1 - (FN + FP + IDSW) / labels``;
+  ``IDF1`` uses the best one-to-one assignment of label tracks to
+  predicted tracks, solved by ``web.matching.assign``.
+
+Greedy matching is done in rounds: an edge is accepted when it comes
+first, in priority order, among the remaining edges of both its label
+and its prediction.  This yields exactly the sequential greedy result
+without a Python loop over boxes.
+"""
+
+import math
+import time
+from collections import namedtuple
+
+import numpy as np
+from django.db import connection, transaction
+
+from . import interchange, matching, overlay, trackdata
+from .models import (
+    DefectTrack,
+    DiseaseType,
+    ModelEvaluation,
+    PredictionFrame,
+    Report,
+    ReportType,
+)
+from .purge import DEFAULT_CHUNK_SIZE, delete_rows
+
+IOU_THRESHOLDS = np.round(np.arange(0.5, 0.951, 0.05), 2)
+TRACKING_IOU = 0.5
+RECALL_POINTS = np.linspace(0, 1, 101)
+
+REPORT_TYPE_CODE = "evaluation"
+REPORT_TYPE_NAME = "模型评估"
+
+FETCH_SIZE = 100_000
+
+# Boxes of one side of the comparison; ``score`` is 1 for labels.
+Boxes = namedtuple("Boxes", "frame_index track label score bbox")
+
+Metrics = namedtuple(
+    "Metrics",
+    "gt_count prediction_count precision recall map map50 mota motp idf1 id_switches per_class",
+)
+
+
+def _empty_boxes():
+    return Boxes(
+        np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int64),
+        np.empty(0), np.empty((0, 4)),
+    )
+
+
+def ground_truth(batch_id):
+    """Return the labelled :class:`Boxes` of a batch in any storage mode."""
+    columns = overlay.batch_columns(batch_id)
+    track = columns.track_id.astype(np.int64)
+    types = dict(DefectTrack.objects.filter(batch_id=batch_id).values_list("pk", "disease_type_id"))
+    pks = np.array(sorted(types), np.int64)
+    type_ids = np.array([types[pk] for pk in pks.tolist()], np.int64)
+    label = type_ids[np.searchsorted(pks, track)] if len(track) else track
+    return Boxes(
+        columns.frame_index.astype(np.int64), track, label, np.ones(len(track)), columns.bbox
+    )
+
+
+def predictions(batch_id, model_name):
+    """Return the :class:`Boxes` predicted by ``model_name`` for a batch."""
+    qn = connection.ops.quote_name
+    chunks = []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT frame_index, track, disease_type_id, score, bbox_x, bbox_y, bbox_width, "
+            f"bbox_height FROM {qn(PredictionFrame._meta.db_table)} "
+            f"WHERE batch_id = %s AND model_name = %s",
+            [batch_id, model_name],
+        )
+        while rows := cursor.fetchmany(FETCH_SIZE):
+            chunks.append(np.array(rows, np.float64))
+    if not chunks:
+        return _empty_boxes()
+    data = np.concatenate(chunks)
+    ints = data[:, :3].astype(np.int64)
+    return Boxes(ints[:, 0], ints[:, 1], ints[:, 2], data[:, 3], data[:, 4:])
+
+
+def store_predictions(batch_id, model_name, parsed, type_ids, batch_size=interchange.DEFAULT_BATCH_SIZE):
+    """Replace the predictions of ``model_name`` for a batch with a
+    :class:`formats.ParsedFile`; ``type_ids`` maps its labels to disease
+    types.  Returns the number of boxes stored."""
+    labels = np.array([type_ids[label] for _, label in parsed.track_keys], np.int64)
+    label_of_track = labels[parsed.track] if len(labels) else parsed.track
+    with transaction.atomic():
+        stale = PredictionFrame.objects.filter(batch_id=batch_id, model_name=model_name)
+        while pks := list(stale.values_list("pk", flat=True)[:DEFAULT_CHUNK_SIZE]):
+            delete_rows(PredictionFrame, pks)
+        return interchange._bulk_insert(
+            PredictionFrame,
+            (
+                PredictionFrame(
+                    batch_id=batch_id,
+                    model_name=model_name,
+                    track=track,
+                    disease_type_id=type_id,
+                    score=score,
+                    frame_index=frame_index,
+                    time=None if math.isnan(t) else t,
+                    bbox_x=x,
+                    bbox_y=y,
+                    bbox_width=w,
+                    bbox_height=h,
+                )
+                for frame_index, t, track, type_id, score, (x, y, w, h) in zip(
+                    parsed.frame_index.tolist(),
+                    parsed.time.tolist(),
+                    parsed.track.tolist(),
+                    label_of_track.tolist(),
+                    parsed.score.tolist(),
+                    parsed.bbox.tolist(),
+                )
+            ),
+            batch_size,
+        )
+
+
+def candidate_pairs(gt, pred, min_iou=IOU_THRESHOLDS[0]):
+    """Return ``(gt_index, pred_index, iou)`` of the label/prediction pairs
+    in the same frame and class with IoU >= ``min_iou``."""
+    if not len(gt.frame_index) or not len(pred.frame_index):
+        return np.empty(0, np.intp), np.empty(0, np.intp), np.empty(0)
+    span = int(max(gt.frame_index.max(), pred.frame_index.max())) + 1
+    gt_key = gt.label * span + gt.frame_index
+    pred_key = pred.label * span + pred.frame_index
+    gt_order = np.argsort(gt_key, kind="stable")
+    pred_order = np.argsort(pred_key, kind="stable")
+    gt_key, pred_key = gt_key[gt_order], pred_key[pred_order]
+
+    keys, gt_start, gt_count = np.unique(gt_key, return_index=True, return_counts=True)
+    pred_start = np.searchsorted(pred_key, keys, "left")
+    pred_count = np.searchsorted(pred_key, keys, "right") - pred_start
+    sizes = gt_count * pred_count
+    group = np.repeat(np.arange(len(keys)), sizes)
+    offset = np.arange(int(sizes.sum())) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    gi = gt_order[gt_start[group] + offset // pred_count[group]]
+    pi = pred_order[pred_start[group] + offset % pred_count[group]]
+
+    iou = trackdata.box_iou(gt.bbox[gi], pred.bbox[pi])
+    keep = iou >= min_iou
+    return gi[keep], pi[keep], iou[keep]
+
+
+def greedy_match(gi, pi, n_gt, n_pred):
+    """Greedy one-to-one matching of edges listed in priority order.
+
+    Returns ``matched_pred``: the label matched to each prediction, or -1.
+    """
+    matched_gt = np.full(n_gt, -1, np.intp)
+    matched_pred = np.full(n_pred, -1, np.intp)
+    first_gt = np.empty(n_gt, np.intp)
+    first_pred = np.empty(n_pred, np.intp)
+    while len(gi):
+        edge = np.arange(len(gi))
+        first_gt[gi] = len(gi)
+        first_pred[pi] = len(gi)
+        np.minimum.at(first_gt, gi, edge)
+        np.minimum.at(first_pred, pi, edge)
+        accept = (first_gt[gi] == edge) & (first_pred[pi] == edge)
+        matched_pred[pi[accept]] = gi[accept]
+        matched_gt[gi[accept]] = pi[accept]
+        remaining = (matched_pred[pi] < 0) & (matched_gt[gi] < 0)
+        gi, pi = gi[remaining], pi[remaining]
+    return matched_pred
+
+
+def average_precision(tp, n_gt):
+    """COCO 101-point interpolated AP of predictions sorted by descending
+    score with true-positive flags ``tp``; ``nan`` when there are no labels."""
+    if not n_gt:
+        return math.nan
+    if not len(tp):
+        return 0.0
+    hits = np.cumsum(tp)
+    recall = hits / n_gt
+    precision = hits / np.arange(1, len(tp) + 1)
+    envelope = np.maximum.accumulate(precision[::-1])[::-1]
+    index = np.searchsorted(recall, RECALL_POINTS, "left")
+    found = index < len(envelope)
+    return float(np.where(found, envelope[np.minimum(index, len(envelope) - 1)], 0).mean())
+
+
+def _mean(values):
+    values = [v for v in values if not math.isnan(v)]
+    return float(np.mean(values)) if values else 0.0
+
+
+def _detection(gt, pred, gi, pi, iou, names):
+    """Per-class precision/recall at IoU 0.5 and AP at every threshold."""
+    n_gt, n_pred = len(gt.frame_index), len(pred.frame_index)
+    by_score = np.argsort(-pred.score, kind="stable")
+    rank = np.empty(n_pred, np.intp)
+    rank[by_score] = np.arange(n_pred)
+    # Each prediction tries its best-IoU label first.
+    edges = np.lexsort((gi, -iou, rank[pi]))
+    classes, gt_counts = np.unique(gt.label, return_counts=True)
+    gt_per_class = dict(zip(classes.tolist(), gt_counts.tolist()))
+    classes = np.union1d(classes, pred.label).tolist()
+    sorted_label = pred.label[by_score]
+    members = {c: sorted_label == c for c in classes}
+
+    ap = {c: [] for c in classes}
+    tp50 = None
+    for threshold in IOU_THRESHOLDS:
+        keep = edges[iou[edges] >= threshold]
+        tp = (greedy_match(gi[keep], pi[keep], n_gt, n_pred) >= 0)[by_score]
+        if tp50 is None:
+            tp50 = tp
+        for c in classes:
+            ap[c].append(average_precision(tp[members[c]], gt_per_class.get(c, 0)))
+
+    per_class = {}
+    for c in classes:
+        predicted = int(members[c].sum())
+        hits = int(tp50[members[c]].sum())
+        labelled = gt_per_class.get(c, 0)
+        per_class[names.get(c, str(c))] = {
+            "gt": labelled,
+            "predictions": predicted,
+            "precision": hits / predicted if predicted else 0.0,
+            "recall": hits / labelled if labelled else 0.0,
+            "ap": _mean(ap[c]),
+            "ap50": _mean(ap[c][:1]),
+        }
+    labelled = [c for c in classes if gt_per_class.get(c)]
+    hits = int(tp50.sum())
+    return {
+        "precision": hits / n_pred if n_pred else 0.0,
+        "recall": hits / n_gt if n_gt else 0.0,
+        "map": _mean([_mean(ap[c]) for c in labelled]),
+        "map50": _mean([ap[c][0] for c in labelled]),
+        "per_class": per_class,
+    }
+
+
+def _identity_f1(gt, pred, gi, pi):
+    """``IDF1`` from the best one-to-one assignment of label tracks to
+    predicted tracks, weighted by frames with IoU >= ``TRACKING_IOU``."""
+    if not len(gt.track) and not len(pred.track):
+        return 1.0
+    gt_tracks, gt_track = np.unique(gt.track, return_inverse=True)
+    pred_tracks, pred_track = np.unique(pred.track, return_inverse=True)
+    pairs, counts = np.unique(
+        gt_track[gi] * len(pred_tracks) + pred_track[pi], return_counts=True
+    )
+    rows, cols = matching.assign(
+        pairs // len(pred_tracks), pairs % len(pred_tracks), -counts.astype(np.float64),
+        len(gt_tracks), len(pred_tracks), missing=0.0,
+    )
+    matched = np.isin(pairs, rows * len(pred_tracks) + cols)
+    return 2 * int(counts[matched].sum()) / (len(gt.track) + len(pred.track))
+
+
+def _tracking(gt, pred, gi, pi, iou):
+    """CLEAR MOT and identity metrics at IoU ``TRACKING_IOU``."""
+    n_gt, n_pred = len(gt.frame_index), len(pred.frame_index)
+    strong = np.flatnonzero(iou >= TRACKING_IOU)
+    by_iou = strong[np.argsort(-iou[strong], kind="stable")]
+    matched = greedy_match(gi[by_iou], pi[by_iou], n_gt, n_pred)
+    pred_idx = np.flatnonzero(matched >= 0)
+    gt_idx = matched[pred_idx]
+    order = np.lexsort((gt.frame_index[gt_idx], gt.track[gt_idx]))
+    gt_track = gt.track[gt_idx][order]
+    pred_track = pred.track[pred_idx][order]
+    switches = int(((gt_track[1:] == gt_track[:-1]) & (pred_track[1:] != pred_track[:-1])).sum())
+    matches = len(pred_idx)
+    errors = (n_gt - matches) + (n_pred - matches) + switches
+    return {
+        "mota": 1 - errors / n_gt if n_gt else 0.0,
+        "motp": float(trackdata.box_iou(gt.bbox[gt_idx], pred.bbox[pred_idx]).mean()) if matches else 0.0,
+        "idf1": _identity_f1(gt, pred, gi[strong], pi[strong]),
+        "id_switches": switches,
+    }
+
+
+def evaluate(gt, pred, names=None):
+    """Compute :class:`Metrics` of ``pred`` against ``gt`` (:class:`Boxes`).
+
+    ``names`` maps class ids to the keys of ``per_class``.
+    """
+    gi, pi, iou = candidate_pairs(gt, pred)
+    return Metrics(
+        gt_count=len(gt.frame_index),
+        prediction_count=len(pred.frame_index),
+        **_detection(gt, pred, gi, pi, iou, names or {}),
+        **_tracking(gt, pred, gi, pi, iou),
+    )
+
+
+def _summary(model_name, metrics):
+    return (
+        f"模型 {model_name}：mAP@[.5:.95] {metrics.map:.3f}，mAP@.5 {metrics.map50:.3f}，"
+        f"精确率 {metrics.precision:.3f}，召回率 {metrics.recall:.3f}，"
+        f"MOTA {metrics.mota:.3f}，IDF1 {metrics.idf1:.3f}，ID 切换 {metrics.id_switches} 次"
+    )
+
+
+def evaluate_batch(batch_id, model_name):
+    """Evaluate ``model_name`` on a batch and store the result with a new
+    ``Report``.  Returns the :class:`~web.models.ModelEvaluation`."""
+    started = time.perf_counter()
+    names = dict(DiseaseType.objects.values_list("pk", "name"))
+    metrics = evaluate(ground_truth(batch_id), predictions(batch_id, model_name), names)
+    elapsed = time.perf_counter() - started
+    report_type, _ = ReportType.objects.get_or_create(
+        code=REPORT_TYPE_CODE, defaults={"name": REPORT_TYPE_NAME}
+    )
+    with transaction.atomic():
+        report = Report.objects.create(
+            batch_id=batch_id, report_type=report_type, content=_summary(model_name, metrics)
+        )
+        return ModelEvaluation.objects.create(
+            batch_id=batch_id,
+            report=report,
+            model_name=model_name,
+            elapsed=elapsed,
+            **metrics._asdict(),
+        )
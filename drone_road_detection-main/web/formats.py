@@ -0,0 +1,355 @@
+"""Streaming readers and writers for COCO-JSON and MOTChallenge annotations.
+
+This module does not touch the database, so :func:`parse_file` can run in
+worker processes; ``web.interchange`` stores and exports the results.
+
+COCO files are read with :class:`JsonArrayReader`, which decodes the
+top-level arrays one element at a time instead of loading the document.
+Frames come from ``images[].frame_id`` (else the image order by id) and
+tracks from ``annotations[].track_id`` (or ``attributes.track_id``);
+annotations without a track become single-box tracks.  The optional
+``score`` of detector output is kept, defaulting to ``1``.
+
+MOT files are CSV rows ``frame, id, left, top, width, height, conf,
+class, visibility`` in pixels with 1-based frames; ``conf`` is read as the
+score and ``class`` defaults to ``1`` when the column is missing.
+"""
+
+import csv
+import json
+import math
+import re
+from array import array
+from collections import namedtuple
+
+import numpy as np
+
+COCO = "coco"
+MOT = "mot"
+FORMATS = (COCO, MOT)
+
+READ_CHUNK_SIZE = 1 << 20
+
+# Columns of one parsed file.  ``track`` and ``label`` index into
+# ``track_keys`` and ``labels``; ``bbox`` is normalised to the image size.
+ParsedFile = namedtuple(
+    "ParsedFile", "path frame_index time track bbox score track_keys labels total_frames"
+)
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+
+
+def _skippable():
+    """Regex of text :meth:`JsonArrayReader._skip` can pass in one match:
+    anything but quotes and brackets, complete strings (which may contain
+    both) and complete containers up to three levels deep."""
+    text = r'[^"\[\]{}]+'
+    string = r'(?>"[^"\\]*(?:\\.[^"\\]*)*")'
+    pattern = rf"(?:{text}|{string})*+"
+    for _ in range(3):
+        pattern = rf"(?:{text}|{string}|[\[{{]{pattern}[\]}}])*+"
+    return re.compile(pattern)
+
+
+_SKIPPABLE = _skippable()
+
+
+def parse_size(value):
+    """Parse a ``WIDTHxHEIGHT`` image size."""
+    width, height = (int(v) for v in value.lower().split("x"))
+    if width <= 0 or height <= 0:
+        raise ValueError("image size must be positive")
+    return width, height
+
+
+def detect_format(path):
+    """Guess the format of ``path`` from its extension."""
+    return COCO if str(path).lower().endswith(".json") else MOT
+
+
+class JsonArrayReader:
+    """Iterate over the elements of the top-level arrays of a JSON object.
+
+    Only one element is decoded at a time; the text buffer holds at most
+    one read chunk plus the element being decoded.  Other members are
+    scanned past without being decoded.
+    """
+
+    def __init__(self, fh, chunk_size=READ_CHUNK_SIZE):
+        self._fh = fh
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        data = self._fh.read(self._chunk_size)
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        self._eof = not data
+
+    def _peek(self):
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or self._eof:
+                return self._buf[self._pos:self._pos + 1]
+            self._fill()
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"expected {char!r} at offset {self._pos}")
+        self._pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            else:
+                # A number running to the end of the buffer (``1.`` decodes
+                # as ``1``) may continue in the next chunk.
+                partial = (
+                    isinstance(value, (int, float))
+                    and not isinstance(value, bool)
+                    and _NUMBER_TAIL.match(self._buf, end).end() == len(self._buf)
+                )
+                if not partial or self._eof:
+                    self._pos = end
+                    return value
+            self._fill()
+
+    def _skip(self):
+        """Move past one value without decoding it, one chunk at a time."""
+        if self._peek() not in ("[", "{"):
+            self._value()
+            return
+        # Past the opening bracket, matches stop at the first unbalanced one.
+        self._pos += 1
+        depth = 1
+        while True:
+            pos = _SKIPPABLE.match(self._buf, self._pos).end()
+            # Stopped at a bracket, or at a string or the end of the buffer
+            # that needs the next chunk.
+            if pos < len(self._buf) and self._buf[pos] != '"':
+                depth += 1 if self._buf[pos] in "[{" else -1
+                self._pos = pos + 1
+                if not depth:
+                    return
+                continue
+            self._pos = pos
+            if self._eof:
+                raise ValueError(f"unterminated value at offset {self._pos}")
+            self._fill()
+
+    def items(self, keys):
+        """Yield ``(key, element)`` for each element of the arrays ``keys``;
+        other members are skipped without being decoded."""
+        self._expect("{")
+        if self._peek() == "}":
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key in keys and self._peek() == "[":
+                self._pos += 1
+                if self._peek() != "]":
+                    while True:
+                        yield key, self._value()
+                        if self._peek() != ",":
+                            break
+                        self._pos += 1
+                self._expect("]")
+            else:
+                self._skip()
+            if self._peek() != ",":
+                break
+            self._pos += 1
+        self._expect("}")
+
+
+class _Columns:
+    """Accumulate parsed boxes in compact typed arrays."""
+
+    def __init__(self):
+        self.frame_index = array("I")
+        self.time = array("d")
+        self.track = array("q")
+        self.bbox = array("d")
+        self.score = array("d")
+        self.track_keys = {}
+        self.labels = {}
+
+    def add(self, frame_index, time, track_key, label, x, y, w, h, score=1.0):
+        track = self.track_keys.setdefault(track_key, (len(self.track_keys), label))[0]
+        self.labels.setdefault(label, len(self.labels))
+        self.frame_index.append(frame_index)
+        self.time.append(math.nan if time is None else time)
+        self.track.append(track)
+        self.bbox.extend((x, y, w, h))
+        self.score.append(score)
+
+    def result(self, path, total_frames):
+        keys = sorted(self.track_keys, key=lambda k: self.track_keys[k][0])
+        labels = sorted(self.labels, key=self.labels.get)
+        return ParsedFile(
+            path=str(path),
+            frame_index=np.frombuffer(self.frame_index, np.uint32),
+            time=np.frombuffer(self.time, np.float64),
+            track=np.frombuffer(self.track, np.int64),
+            bbox=np.frombuffer(self.bbox, np.float64).reshape(-1, 4),
+            score=np.frombuffer(self.score, np.float64),
+            track_keys=[(key, self.track_keys[key][1]) for key in keys],
+            labels=labels,
+            total_frames=total_frames,
+        )
+
+
+def _frame_time(frame_index, fps):
+    return round(frame_index / fps, 3) if fps else None
+
+
+def parse_coco(path, fps=None):
+    """Parse a COCO-JSON file into a :class:`ParsedFile`.
+
+    The file is read twice: first for images and categories, then for the
+    annotations, so neither pass depends on the order of the arrays.
+    """
+    images, categories = {}, {}
+    with open(path, encoding="utf-8") as fh:
+        for key, item in JsonArrayReader(fh).items({"images", "categories"}):
+            if key == "images":
+                images[item["id"]] = (item.get("frame_id"), item["width"], item["height"])
+            else:
+                categories[item["id"]] = item["name"]
+    if any(frame is None for frame, _, _ in images.values()):
+        images = {
+            image_id: (position, width, height)
+            for position, (image_id, (_, width, height)) in enumerate(sorted(images.items()))
+        }
+
+    columns = _Columns()
+    with open(path, encoding="utf-8") as fh:
+        for _, ann in JsonArrayReader(fh).items({"annotations"}):
+            frame_index, width, height = images[ann["image_id"]]
+            track = ann.get("track_id", (ann.get("attributes") or {}).get("track_id"))
+            x, y, w, h = ann["bbox"]
+            columns.add(
+                frame_index,
+                _frame_time(frame_index, fps),
+                f"a{ann['id']}" if track is None else str(track),
+                categories[ann["category_id"]],
+                x / width,
+                y / height,
+                w / width,
+                h / height,
+                ann.get("score", 1.0),
+            )
+    total = max((frame for frame, _, _ in images.values()), default=-1) + 1
+    return columns.result(path, total)
+
+
+def parse_mot(path, width, height, fps=None):
+    """Parse a MOTChallenge CSV file into a :class:`ParsedFile`."""
+    columns = _Columns()
+    total = 0
+    with open(path, newline="", encoding="utf-8") as fh:
+        for row in csv.reader(fh):
+            if not row or row[0].lstrip().startswith("#"):
+                continue
+            frame_index = int(float(row[0])) - 1
+            x, y, w, h = (float(v) for v in row[2:6])
+            label = row[7].strip() if len(row) > 7 else "1"
+            score = float(row[6]) if len(row) > 6 else 1.0
+            columns.add(
+                frame_index,
+                _frame_time(frame_index, fps),
+                str(int(float(row[1]))),
+                label,
+                x / width,
+                y / height,
+                w / width,
+                h / height,
+                score,
+            )
+            total = max(total, frame_index + 1)
+    return columns.result(path, total)
+
+
+def parse_file(path, fmt=None, width=1920, height=1080, fps=None):
+    """Parse ``path`` in format ``fmt`` (guessed from the extension)."""
+    fmt = fmt or detect_format(path)
+    if fmt == COCO:
+        return parse_coco(path, fps)
+    if fmt == MOT:
+        return parse_mot(path, width, height, fps)
+    raise ValueError(f"unknown annotation format {fmt!r}")
+
+
+def _number(value):
+    return f"{value:.4f}".rstrip("0").rstrip(".")
+
+
+def write_mot(fh, rows, classes, width, height):
+    """Write MOT rows for ``(frame_index, track, label, x, y, w, h)`` tuples.
+
+    ``track`` must be a positive integer; ``classes`` maps labels to MOT
+    class ids.  Returns the number of rows written.
+    """
+    count = 0
+    for frame_index, track, label, x, y, w, h in rows:
+        fh.write(
+            f"{frame_index + 1},{track},{_number(x * width)},{_number(y * height)},"
+            f"{_number(w * width)},{_number(h * height)},1,{classes[label]},1\n"
+        )
+        count += 1
+    return count
+
+
+def write_coco(fh, rows, categories, width, height):
+    """Write a COCO-JSON document, streaming annotations as they come.
+
+    ``rows`` are ``(frame_index, track, label, x, y, w, h)`` tuples and
+    ``categories`` maps labels to ``(category_id, name)``.  Annotations are
+    written before the images, which are listed once the frames with boxes
+    are known.  Returns the number of annotations written.
+    """
+    fh.write('{"categories": ')
+    fh.write(json.dumps(
+        [{"id": cid, "name": name} for cid, name in sorted(categories.values())],
+        ensure_ascii=False,
+    ))
+    fh.write(',\n"annotations": [')
+    frames = set()
+    count = 0
+    for frame_index, track, label, x, y, w, h in rows:
+        px, py, pw, ph = x * width, y * height, w * width, h * height
+        fh.write(",\n" if count else "\n")
+        count += 1
+        fh.write(json.dumps({
+            "id": count,
+            "image_id": frame_index + 1,
+            "category_id": categories[label][0],
+            "track_id": track,
+            "bbox": [round(v, 4) for v in (px, py, pw, ph)],
+            "area": round(max(pw, 0) * max(ph, 0), 4),
+            "iscrowd": 0,
+        }))
+        frames.add(frame_index)
+    fh.write('\n],\n"images": [')
+    for n, frame_index in enumerate(sorted(frames)):
+        fh.write(",\n" if n else "\n")
+        fh.write(json.dumps({
+            "id": frame_index + 1,
+            "frame_id": frame_index,
+            "file_name": f"{frame_index:06d}.jpg",
+            "width": width,
+            "height": height,
+        }))
+    fh.write("\n]}\n")
+    return count
+
@@ -0,0 +1,269 @@
+"""Streaming ingestion of frame detections pushed by drones in flight.
+
+``POST /api/ingest/<batch_id>/`` accepts newline-delimited JSON, gzip
+compressed when sent with ``Content-Encoding: gzip``, one detection per
+line::
+
+    {"track": "7", "frame": 120, "time": 4.0, "bbox": [0.1, 0.2, 0.05, 0.08],
+     "label": "裂缝", "severity": "low"}
+
+``track`` is the drone's own track id; it becomes the track's
+``unique_code`` ``B<batch_id>-<track>``.  ``label`` names a
+``DiseaseType`` and is only read from the first line of a track;
+``time`` and ``severity`` (a ``SeverityLevel`` code) are optional.
+``frame`` is a non-negative 32-bit integer.
+
+Lines are parsed incrementally and written :data:`DEFAULT_CHUNK_SIZE` at
+a time, each chunk in its own transaction with bulk inserts.  Tracks are
+keyed by ``unique_code`` and frames by ``(track, frame_index)``, so a
+retried upload skips what an earlier attempt already stored.
+"""
+
+import gzip
+import json
+import math
+from collections import Counter
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+from django.db.models import Value
+from django.db.models.functions import Coalesce, Greatest, Least
+
+from . import counters, rollups, signals, trackdata
+from .models import DefectTrack, DiseaseType, GroundTruthFrame, SeverityLevel
+
+DEFAULT_CHUNK_SIZE = 2000
+
+# Longest accepted NDJSON line, in bytes.
+MAX_LINE_BYTES = 64 * 1024
+
+
+class IngestError(ValueError):
+    """A line of the upload cannot be ingested; ``line`` is 1-based."""
+
+    def __init__(self, message, line):
+        super().__init__(f"line {line}: {message}")
+        self.message = message
+        self.line = line
+
+
+def _code_max_length():
+    return DefectTrack._meta.get_field("unique_code").max_length
+
+
+def track_code(batch_id, track):
+    """Return the ``unique_code`` of drone track ``track`` of a batch."""
+    return f"B{batch_id}-{track}"
+
+
+ENCODINGS = ("", "identity", "gzip")
+
+
+def iter_lines(stream, encoding=""):
+    """Return an iterator over the non-blank lines of a NDJSON byte stream
+    sent with one of the :data:`ENCODINGS`."""
+    if encoding not in ENCODINGS:
+        raise ValueError(f"unsupported content encoding {encoding!r}")
+    if encoding == "gzip":
+        stream = gzip.GzipFile(fileobj=stream, mode="rb")
+    return _lines(stream)
+
+
+def _lines(stream):
+    while True:
+        line = stream.readline(MAX_LINE_BYTES + 1)
+        if not line:
+            return
+        if len(line) > MAX_LINE_BYTES:
+            raise ValueError("line too long")
+        if line.strip():
+            yield line
+
+
+def _number(value, line, name):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise IngestError(f"{name} must be a number", line)
+    return value
+
+
+def parse(line, number):
+    """Validate one detection line; return ``(track, frame, time, bbox, label, severity)``."""
+    try:
+        row = json.loads(line)
+    except ValueError:
+        raise IngestError("invalid JSON", number)
+    if not isinstance(row, dict):
+        raise IngestError("expected an object", number)
+    track = row.get("track")
+    if isinstance(track, bool) or not isinstance(track, (str, int)) or track == "":
+        raise IngestError("track must be a string or integer", number)
+    frame = row.get("frame")
+    if isinstance(frame, bool) or not isinstance(frame, int) or frame < 0:
+        raise IngestError("frame must be a non-negative integer", number)
+    if frame > trackdata.MAX_FRAME_INDEX:
+        raise IngestError(f"frame must be at most {trackdata.MAX_FRAME_INDEX}", number)
+    time = row.get("time")
+    if time is not None:
+        time = _number(time, number, "time")
+    bbox = row.get("bbox")
+    if not isinstance(bbox, list) or len(bbox) != 4:
+        raise IngestError("bbox must be [x, y, width, height]", number)
+    bbox = [_number(v, number, "bbox") for v in bbox]
+    label, severity = row.get("label"), row.get("severity")
+    for name, value in (("label", label), ("severity", severity)):
+        if value is not None and not isinstance(value, str):
+            raise IngestError(f"{name} must be a string", number)
+    return str(track), frame, time, bbox, label, severity
+
+
+class _Ingest:
+    def __init__(self, batch):
+        self.batch = batch
+        self.rollup_key = rollups.batch_key(batch.pk)
+        self.disease_types = dict(DiseaseType.objects.values_list("name", "pk"))
+        self.severities = dict(SeverityLevel.objects.values_list("code", "pk"))
+        self.stats = Counter(lines=0, frames=0, duplicates=0, tracks=0)
+
+    def _new_track(self, code, number, label, severity, span):
+        if label not in self.disease_types:
+            raise IngestError(f"unknown label {label!r}", number)
+        if severity is not None and severity not in self.severities:
+            raise IngestError(f"unknown severity {severity!r}", number)
+        start_frame, end_frame, start_time, end_time = span
+        return DefectTrack(
+            batch=self.batch,
+            unique_code=code,
+            disease_type_id=self.disease_types[label],
+            severity_id=self.severities.get(severity),
+            start_frame=start_frame,
+            end_frame=end_frame,
+            start_time=start_time,
+            end_time=end_time,
+        )
+
+    @staticmethod
+    def _extend(code, span):
+        """Widen the frame and time span of an existing track to ``span``."""
+        start_frame, end_frame, start_time, end_time = span
+        changes = dict(
+            start_frame=Least("start_frame", Value(start_frame)),
+            end_frame=Greatest("end_frame", Value(end_frame)),
+        )
+        if start_time is not None:
+            changes.update(
+                start_time=Least(Coalesce("start_time", Value(start_time)), Value(start_time)),
+                end_time=Greatest(Coalesce("end_time", Value(end_time)), Value(end_time)),
+            )
+        DefectTrack.objects.filter(unique_code=code).update(**changes)
+
+    def _tracks(self, rows, retry=True):
+        """Return ``{code: pk}`` for the tracks of ``rows``; new tracks are
+        created and existing ones extended to the frames of ``rows``."""
+        first, spans = {}, {}
+        for number, (track, frame, time, *_) in rows:
+            code = track_code(self.batch.pk, track)
+            if code not in first and len(code) > _code_max_length():
+                raise IngestError("track id too long", number)
+            first.setdefault(code, number)
+            lo, hi, t0, t1 = spans.get(code, (frame, frame, time, time))
+            if time is not None:
+                t0 = time if t0 is None else min(t0, time)
+                t1 = time if t1 is None else max(t1, time)
+            spans[code] = (min(lo, frame), max(hi, frame), t0, t1)
+
+        existing = dict(
+            DefectTrack.objects.filter(unique_code__in=list(spans)).values_list("unique_code", "batch_id")
+        )
+        for code, batch_id in existing.items():
+            if batch_id != self.batch.pk:
+                raise IngestError(f"track {code} belongs to another batch", first[code])
+            self._extend(code, spans[code])
+        lines = dict(rows)
+        new = [
+            self._new_track(code, first[code], *lines[first[code]][4:], spans[code])
+            for code in spans
+            if code not in existing
+        ]
+        if new:
+            try:
+                with transaction.atomic():
+                    DefectTrack.objects.bulk_create(new)
+            except IntegrityError:
+                if not retry:
+                    raise
+                # A concurrent upload created some of the tracks first.
+                return self._tracks(rows, retry=False)
+            self.stats["tracks"] += len(new)
+            counters.apply_tracks(self.batch.pk, defects=len(new))
+            groups = Counter((t.disease_type_id, t.severity_id) for t in new)
+            for (disease_type_id, severity_id), count in groups.items():
+                rollups.apply(self.rollup_key, disease_type_id, severity_id, count)
+        return dict(
+            DefectTrack.objects.filter(unique_code__in=list(spans)).values_list("unique_code", "pk")
+        )
+
+    def _frames(self, rows, track_ids):
+        """Insert the frames of ``rows`` that are not stored yet."""
+        frames = {}
+        for _, (track, frame, time, bbox, _, _) in rows:
+            frames[track_ids[track_code(self.batch.pk, track)], frame] = (time, bbox)
+        stored = set(
+            GroundTruthFrame.objects.filter(
+                track_id__in=list(track_ids.values()),
+                frame_index__gte=min(frame for _, frame in frames),
+                frame_index__lte=max(frame for _, frame in frames),
+            ).values_list("track_id", "frame_index")
+        )
+        new = [
+            GroundTruthFrame(
+                track_id=track_id,
+                batch_id=self.batch.pk,
+                frame_index=frame,
+                time=time,
+                bbox_x=bbox[0],
+                bbox_y=bbox[1],
+                bbox_width=bbox[2],
+                bbox_height=bbox[3],
+            )
+            for (track_id, frame), (time, bbox) in frames.items()
+            if (track_id, frame) not in stored
+        ]
+        # ``ignore_conflicts`` covers a concurrent retry of the same upload.
+        GroundTruthFrame.objects.bulk_create(new, ignore_conflicts=True)
+        self.stats["frames"] += len(new)
+        self.stats["duplicates"] += len(rows) - len(new)
+
+    def chunk(self, rows):
+        with transaction.atomic():
+            self._frames(rows, self._tracks(rows))
+            signals.bulk_changed(self.batch.pk)
+
+    def run(self, numbered, chunk_size):
+        try:
+            while rows := list(islice(numbered, chunk_size)):
+                self.chunk(rows)
+                self.stats["lines"] += len(rows)
+        except (ValueError, OSError, EOFError) as exc:
+            # Corrupt gzip data surfaces as OSError/EOFError.
+            exc.stats = dict(self.stats)
+            raise
+        return dict(self.stats)
+
+
+def ingest(batch, lines, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Store the NDJSON detection ``lines`` in ``batch``.
+
+    Each chunk of ``chunk_size`` lines is committed on its own, so after an
+    :class:`IngestError` (or a corrupt stream) the chunks before the fault
+    are kept and the upload can simply be retried; the exception's
+    ``stats`` tell what was stored.  Returns counts of ``lines`` read,
+    ``frames`` inserted, ``duplicates`` skipped and ``tracks`` created.
+    """
+    numbered = ((number, parse(line, number)) for number, line in enumerate(lines, 1))
+    return _Ingest(batch).run(numbered, chunk_size)
+
+
+def ingest_rows(batch, rows, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Like :func:`ingest` for already validated ``(track, frame, time,
+    bbox, label, severity)`` tuples, e.g. from ``web.pipeline``."""
+    return _Ingest(batch).run(enumerate(rows, 1), chunk_size)
@@ -0,0 +1,223 @@
+"""Bulk import and streaming export of COCO-JSON and MOT annotations.
+
+Files are parsed by ``web.formats`` in a process pool while the main
+process writes the previous results.  Each file becomes one
+``DetectionBatch`` and is written in one transaction with bulk inserts.
+Track codes follow the ingestion API (``B<batch_id>-<track>``).  Labels
+are mapped to ``DiseaseType`` names through a configurable mapping.
+
+Exports stream the rows of ``overlay.iter_frame_rows`` straight to the
+output file, whatever storage mode or archive the batch uses.
+"""
+
+import json
+import math
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+
+from . import counters, formats, ingest, overlay, rollups, signals
+from .models import DefectTrack, DetectionBatch, DiseaseType, GroundTruthFrame
+from .snapshots import worker_context
+
+DEFAULT_BATCH_SIZE = 2000
+
+
+def load_mapping(pairs=(), path=None):
+    """Merge a JSON object file of label mappings with ``(source, target)``
+    pairs, the latter taking precedence."""
+    mapping = {}
+    if path:
+        with open(path, encoding="utf-8") as fh:
+            mapping.update({str(k): str(v) for k, v in json.load(fh).items()})
+    mapping.update(pairs or ())
+    return mapping
+
+
+def resolve_types(labels, mapping=None, create=False):
+    """Return ``{label: DiseaseType pk}`` for source ``labels``.
+
+    ``mapping`` renames labels to disease type names; unmapped labels are
+    used as names.  Unknown names raise ``ValueError`` unless ``create``.
+    """
+    names = {label: (mapping or {}).get(label, label) for label in labels}
+    known = dict(DiseaseType.objects.filter(name__in=set(names.values())).values_list("name", "pk"))
+    missing = sorted(set(names.values()) - set(known))
+    if missing and not create:
+        raise ValueError(f"unknown disease types: {', '.join(missing)}")
+    for name in missing:
+        known[name] = DiseaseType.objects.create(name=name).pk
+    return {label: known[name] for label, name in names.items()}
+
+
+def _bulk_insert(model, objs, batch_size):
+    objs = iter(objs)
+    total = 0
+    while chunk := list(islice(objs, batch_size)):
+        model.objects.bulk_create(chunk)
+        total += len(chunk)
+    return total
+
+
+def _track_spans(parsed):
+    """Per parsed track: ``(start_frame, end_frame, start_time, end_time)``."""
+    count = len(parsed.track_keys)
+    frames = parsed.frame_index.astype(np.int64)
+    start = np.full(count, np.iinfo(np.int64).max)
+    end = np.full(count, -1)
+    np.minimum.at(start, parsed.track, frames)
+    np.maximum.at(end, parsed.track, frames)
+    start_time = np.full(count, np.inf)
+    end_time = np.full(count, -np.inf)
+    timed = ~np.isnan(parsed.time)
+    np.minimum.at(start_time, parsed.track[timed], parsed.time[timed])
+    np.maximum.at(end_time, parsed.track[timed], parsed.time[timed])
+    return [
+        (int(s), int(e), None if math.isinf(t0) else t0, None if math.isinf(t1) else t1)
+        for s, e, t0, t1 in zip(start, end, start_time.tolist(), end_time.tolist())
+    ]
+
+
+def store_parsed(parsed, type_ids, batch_fields, fps=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Write one :class:`formats.ParsedFile` as a new batch.
+
+    Repeated ``(track, frame)`` boxes keep the first one.  Returns
+    ``(batch, tracks, boxes)``.
+    """
+    _, first = np.unique(
+        parsed.track * (1 << 32) + parsed.frame_index.astype(np.int64), return_index=True
+    )
+    keep = np.sort(first)
+    with transaction.atomic():
+        batch = DetectionBatch.objects.create(
+            total_frames=parsed.total_frames,
+            video_duration=parsed.total_frames / fps if fps else None,
+            **batch_fields,
+        )
+        tracks = DefectTrack.objects.bulk_create(
+            [
+                DefectTrack(
+                    batch=batch,
+                    unique_code=ingest.track_code(batch.pk, key),
+                    disease_type_id=type_ids[label],
+                    start_frame=start_frame,
+                    end_frame=end_frame,
+                    start_time=start_time,
+                    end_time=end_time,
+                )
+                for (key, label), (start_frame, end_frame, start_time, end_time) in zip(
+                    parsed.track_keys, _track_spans(parsed)
+                )
+            ],
+            batch_size=batch_size,
+        )
+        track_pks = [track.pk for track in tracks]
+        boxes = _bulk_insert(
+            GroundTruthFrame,
+            (
+                GroundTruthFrame(
+                    track_id=track_pks[track],
+                    batch_id=batch.pk,
+                    frame_index=frame_index,
+                    time=None if math.isnan(time) else time,
+                    bbox_x=x,
+                    bbox_y=y,
+                    bbox_width=w,
+                    bbox_height=h,
+                )
+                for frame_index, time, track, (x, y, w, h) in zip(
+                    parsed.frame_index[keep].tolist(),
+                    parsed.time[keep].tolist(),
+                    parsed.track[keep].tolist(),
+                    parsed.bbox[keep].tolist(),
+                )
+            ),
+            batch_size,
+        )
+        counters.apply_tracks(batch.pk, defects=len(tracks))
+        rollups.apply_batch(batch.pk, rollups.batch_key(batch.pk), 1)
+        signals.bulk_changed(batch.pk)
+    return batch, len(tracks), boxes
+
+
+def parse_files(paths, workers=None, **options):
+    """Yield :class:`formats.ParsedFile` for ``paths`` in order, parsing
+    up to ``workers`` files ahead in a process pool (inline with 0)."""
+    workers = min(os.cpu_count() if workers is None else workers, len(paths))
+    if not workers:
+        for path in paths:
+            yield formats.parse_file(path, **options)
+        return
+    with ProcessPoolExecutor(workers, mp_context=worker_context()) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(formats.parse_file, path, **options))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def import_files(paths, fmt=None, width=1920, height=1080, fps=None, mapping=None,
+                 create_types=False, workers=None, batch_size=DEFAULT_BATCH_SIZE,
+                 batch_fields=None, progress=None):
+    """Import annotation files, one batch per file.
+
+    ``progress(path, batch, tracks, boxes)`` is called after each file.
+    Returns ``(batches, tracks, boxes)`` totals.
+    """
+    totals = [0, 0, 0]
+    for parsed in parse_files(list(paths), workers, fmt=fmt, width=width, height=height, fps=fps):
+        type_ids = resolve_types(parsed.labels, mapping, create_types)
+        fields = {
+            "airport": "import",
+            "drone_id": "import",
+            "start_time": timezone.now(),
+            "end_time": timezone.now(),
+            **(batch_fields or {}),
+        }
+        batch, tracks, boxes = store_parsed(parsed, type_ids, fields, fps, batch_size)
+        totals[0] += 1
+        totals[1] += tracks
+        totals[2] += boxes
+        if progress is not None:
+            progress(parsed.path, batch, tracks, boxes)
+    return tuple(totals)
+
+
+def _export_rows(batch_id):
+    """Yield ``(frame_index, track, label, x, y, w, h)`` with tracks
+    numbered from 1 in primary-key order."""
+    tracks = DefectTrack.objects.filter(batch_id=batch_id).order_by("pk")
+    numbers = {
+        pk: (n, name)
+        for n, (pk, name) in enumerate(tracks.values_list("pk", "disease_type__name"), 1)
+    }
+    for frame_index, _, track_id, x, y, w, h in overlay.iter_frame_rows(batch_id):
+        number, label = numbers[track_id]
+        yield frame_index, number, label, x, y, w, h
+
+
+def export_batch(batch_id, fmt, fh, width=1920, height=1080, mapping=None):
+    """Stream the annotations of ``batch_id`` to ``fh`` in ``fmt``.
+
+    ``mapping`` renames disease types to MOT class ids or COCO category
+    names; by default MOT classes are disease type ids and COCO
+    categories keep their names.  Returns the number of boxes written.
+    """
+    mapping = mapping or {}
+    types = DiseaseType.objects.filter(defecttrack__batch_id=batch_id).distinct()
+    types = dict(types.values_list("name", "pk"))
+    rows = _export_rows(batch_id)
+    if fmt == formats.MOT:
+        classes = {name: mapping.get(name, pk) for name, pk in types.items()}
+        return formats.write_mot(fh, rows, classes, width, height)
+    if fmt == formats.COCO:
+        categories = {name: (pk, mapping.get(name, name)) for name, pk in types.items()}
+        return formats.write_coco(fh, rows, categories, width, height)
+    raise ValueError(f"unknown annotation format {fmt!r}")
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from web import archive
+from web.purge import DEFAULT_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = "Move the frame annotations of expired batches to compressed archive files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("batch_ids", nargs="*", type=int,
+                            help="batches to archive (default: every batch past expire_at)")
+        parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                            help="rows per DELETE statement")
+
+    def handle(self, *args, **options):
+        batch_ids = options["batch_ids"] or archive.expired_batches()
+        for batch_id in batch_ids:
+            archived, deleted = archive.archive_batch(batch_id, chunk_size=options["chunk_size"])
+            self.stdout.write(
+                f"  batch {batch_id}: {archived} frames archived to "
+                f"{archive.archive_path(batch_id)}, {deleted} rows deleted"
+            )
+        self.stdout.write(self.style.SUCCESS(f"Archived {len(batch_ids)} batches"))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from web import rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily disease-type rollup from the defect tracks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", help="first day to rebuild (YYYY-MM-DD)")
+        parser.add_argument("--until", help="last day to rebuild (YYYY-MM-DD)")
+
+    def handle(self, *args, **options):
+        try:
+            since = parse_date(options["since"] or "")
+            until = parse_date(options["until"] or "")
+        except ValueError as exc:
+            raise CommandError(exc)
+        rows = rollups.rebuild(since, until)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {rows} rollup rows"))
@@ -0,0 +1,35 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from web.management.commands.generate_demo_data import _resolution
+from web.synth import RoadRenderer, random_defects, reference_frames
+
+
+class Command(BaseCommand):
+    help = "Compare frames/sec of the reference and vectorized demo video renderers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--frames", type=int, default=300, help="frames rendered per renderer")
+        parser.add_argument("--fps", type=int, default=30, help="video frame rate")
+        parser.add_argument("--resolution", type=_resolution, default=(1920, 1080),
+                            help="frame size as WIDTHxHEIGHT (default 1920x1080)")
+        parser.add_argument("--seed", type=int, default=0, help="random seed for the defects")
+
+    def _measure(self, frames):
+        start = time.perf_counter()
+        count = sum(1 for _ in frames)
+        return count / (time.perf_counter() - start)
+
+    def handle(self, *args, **options):
+        width, height = options["resolution"]
+        fps, total = options["fps"], options["frames"]
+        np.random.seed(options["seed"])
+        defects = random_defects(max(1, total // fps), width, height)
+
+        before = self._measure(reference_frames(defects, width, height, fps, total))
+        after = self._measure(RoadRenderer(defects, width, height, fps).frames(total))
+        self.stdout.write(f"{total} frames at {width}x{height}, {len(defects)} defects")
+        self.stdout.write(f"  reference : {before:8.1f} frames/s")
+        self.stdout.write(f"  vectorized: {after:8.1f} frames/s ({after / before:.1f}x)")
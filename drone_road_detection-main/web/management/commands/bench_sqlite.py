@@ -0,0 +1,144 @@
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from web.db import apply_pragmas
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark concurrent dashboard reads against ingestion writes for "
+        "each SQLite profile and report latency percentiles and lock errors"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--profiles", nargs="+", help="profiles to compare (default: all)")
+        parser.add_argument("--readers", type=int, default=4, help="reader threads")
+        parser.add_argument("--duration", type=float, default=5.0, help="seconds per profile")
+        parser.add_argument("--rows", type=int, default=50000, help="rows seeded before the run")
+        parser.add_argument("--write-batch", type=int, default=500, help="rows per write transaction")
+
+    # ---------- 数据准备 ----------
+    def _seed(self, path, rows):
+        conn = sqlite3.connect(path)
+        conn.executescript(
+            """
+            CREATE TABLE frame (
+                id INTEGER PRIMARY KEY,
+                batch_id INTEGER NOT NULL,
+                frame_index INTEGER NOT NULL,
+                x REAL, y REAL, w REAL, h REAL
+            );
+            CREATE INDEX frame_batch_idx ON frame (batch_id, frame_index);
+            """
+        )
+        conn.executemany(
+            "INSERT INTO frame (batch_id, frame_index, x, y, w, h) VALUES (?, ?, .1, .2, .3, .4)",
+            ((i % 20, i) for i in range(rows)),
+        )
+        conn.commit()
+        conn.close()
+
+    def _connect(self, path, profile):
+        conn = sqlite3.connect(path, timeout=profile["timeout"], isolation_level=None,
+                               check_same_thread=False)
+        apply_pragmas(conn.cursor(), profile["pragmas"])
+        return conn
+
+    # ---------- 单个配置的压测 ----------
+    def _run(self, path, profile, readers, duration, write_batch):
+        persistent = profile["conn_max_age"] != 0
+        stop = threading.Event()
+        lock = threading.Lock()
+        read_latencies, write_latencies = [], []
+        errors = {"read": 0, "write": 0}
+
+        def reader(seed):
+            rng = np.random.default_rng(seed)
+            conn = self._connect(path, profile) if persistent else None
+            local = []
+            while not stop.is_set():
+                batch_id = int(rng.integers(0, 20))
+                start = time.perf_counter()
+                try:
+                    c = conn or self._connect(path, profile)
+                    c.execute(
+                        "SELECT frame_index, x, y, w, h FROM frame "
+                        "WHERE batch_id = ? ORDER BY frame_index LIMIT 300",
+                        (batch_id,),
+                    ).fetchall()
+                    if conn is None:
+                        c.close()
+                    local.append(time.perf_counter() - start)
+                except sqlite3.OperationalError:
+                    with lock:
+                        errors["read"] += 1
+            with lock:
+                read_latencies.extend(local)
+
+        def writer():
+            conn = self._connect(path, profile)
+            next_index = 10 ** 7
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    conn.execute("BEGIN")
+                    conn.executemany(
+                        "INSERT INTO frame (batch_id, frame_index, x, y, w, h) "
+                        "VALUES (?, ?, .1, .2, .3, .4)",
+                        ((i % 20, next_index + i) for i in range(write_batch)),
+                    )
+                    conn.execute("COMMIT")
+                    next_index += write_batch
+                    write_latencies.append(time.perf_counter() - start)
+                except sqlite3.OperationalError:
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                    errors["write"] += 1
+
+        threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+        threads.append(threading.Thread(target=writer))
+        for t in threads:
+            t.start()
+        time.sleep(duration)
+        stop.set()
+        for t in threads:
+            t.join()
+        return read_latencies, write_latencies, errors
+
+    @staticmethod
+    def _summary(latencies):
+        if not latencies:
+            return "n=0"
+        ms = np.asarray(latencies) * 1000
+        p50, p99 = np.percentile(ms, [50, 99])
+        return f"n={len(ms)} p50={p50:.2f}ms p99={p99:.2f}ms max={ms.max():.2f}ms"
+
+    # ---------- 主入口 ----------
+    def handle(self, *args, **options):
+        profiles = getattr(settings, "SQLITE_PROFILES", {})
+        names = options["profiles"] or list(profiles)
+        unknown = set(names) - set(profiles)
+        if unknown:
+            raise CommandError(f"Unknown profiles: {', '.join(sorted(unknown))}")
+
+        for name in names:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = str(Path(tmp) / "bench.sqlite3")
+                self._seed(path, options["rows"])
+                reads, writes, errors = self._run(
+                    path,
+                    profiles[name],
+                    options["readers"],
+                    options["duration"],
+                    options["write_batch"],
+                )
+            self.stdout.write(self.style.MIGRATE_HEADING(f"[{name}]"))
+            self.stdout.write(f"  reads : {self._summary(reads)} lock_errors={errors['read']}")
+            self.stdout.write(f"  writes: {self._summary(writes)} lock_errors={errors['write']}")
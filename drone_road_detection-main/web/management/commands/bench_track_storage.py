@@ -0,0 +1,136 @@
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from web import trackdata
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare database size and batch read latency of row-per-frame and "
+        "packed per-track frame storage on a scratch SQLite database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batches", type=int, default=20, help="batches generated")
+        parser.add_argument("--tracks", type=int, default=50, help="tracks per batch")
+        parser.add_argument("--frames", type=int, default=300, help="frames per track")
+        parser.add_argument("--repeat", type=int, default=5, help="timed reads per mode")
+
+    # Mirrors the ground_truth_frame table and its indexes.
+    ROW_SCHEMA = """
+        CREATE TABLE frame (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            track_id INTEGER NOT NULL,
+            batch_id INTEGER,
+            frame_index INTEGER NOT NULL,
+            time REAL,
+            bbox_x REAL NOT NULL, bbox_y REAL NOT NULL,
+            bbox_width REAL NOT NULL, bbox_height REAL NOT NULL
+        );
+        CREATE INDEX frame_track_idx ON frame (track_id);
+        CREATE UNIQUE INDEX gtf_track_frame_uniq ON frame (track_id, frame_index);
+        CREATE INDEX gtf_batch_frame_idx ON frame (batch_id, frame_index, track_id);
+    """
+
+    # Mirrors packed_track_frames joined through defect_track.batch_id.
+    PACKED_SCHEMA = """
+        CREATE TABLE track (id INTEGER PRIMARY KEY, batch_id INTEGER NOT NULL);
+        CREATE INDEX track_batch_idx ON track (batch_id);
+        CREATE TABLE packed (
+            track_id INTEGER PRIMARY KEY, frame_count INTEGER NOT NULL, data BLOB NOT NULL
+        );
+    """
+
+    def _tracks(self, options):
+        rng = np.random.default_rng(0)
+        n = options["frames"]
+        for b in range(options["batches"]):
+            for t in range(options["tracks"]):
+                start = int(rng.integers(0, 1000))
+                frames = np.arange(start, start + n)
+                bbox = rng.random((n, 4))
+                yield b, b * options["tracks"] + t, frames, np.round(frames / 30, 3), bbox
+
+    def _build(self, path, schema, insert):
+        conn = sqlite3.connect(path)
+        conn.executescript(schema)
+        insert(conn)
+        conn.commit()
+        conn.execute("VACUUM")
+        conn.close()
+        return Path(path).stat().st_size
+
+    def _time(self, path, read, batches, repeat):
+        conn = sqlite3.connect(path)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for b in range(batches):
+                read(conn, b)
+        elapsed = (time.perf_counter() - start) / (repeat * batches)
+        conn.close()
+        return elapsed
+
+    def handle(self, *args, **options):
+        def insert_rows(conn):
+            for b, t, frames, times, bbox in self._tracks(options):
+                conn.executemany(
+                    "INSERT INTO frame (track_id, batch_id, frame_index, time, bbox_x, bbox_y, "
+                    "bbox_width, bbox_height) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    ((t, b, int(f), float(s), *map(float, box))
+                     for f, s, box in zip(frames, times, bbox)),
+                )
+
+        def insert_packed(conn):
+            for b, t, frames, times, bbox in self._tracks(options):
+                conn.execute("INSERT INTO track VALUES (?, ?)", (t, b))
+                conn.execute(
+                    "INSERT INTO packed VALUES (?, ?, ?)",
+                    (t, len(frames), trackdata.pack(frames, times, bbox)),
+                )
+
+        def read_rows(conn, b):
+            rows = conn.execute(
+                "SELECT frame_index, time, track_id, bbox_x, bbox_y, bbox_width, bbox_height "
+                "FROM frame WHERE batch_id = ? ORDER BY frame_index, track_id",
+                (b,),
+            ).fetchall()
+            return np.array(rows, np.float64)
+
+        def read_packed(conn, b):
+            parts = [
+                trackdata.unpack(data)
+                for (data,) in conn.execute(
+                    "SELECT data FROM packed JOIN track ON track.id = packed.track_id "
+                    "WHERE track.batch_id = ?",
+                    (b,),
+                )
+            ]
+            return np.concatenate([p.bbox for p in parts])
+
+        boxes = options["batches"] * options["tracks"] * options["frames"]
+        with tempfile.TemporaryDirectory() as tmp:
+            results = {}
+            for mode, schema, insert, read in (
+                ("rows", self.ROW_SCHEMA, insert_rows, read_rows),
+                ("packed", self.PACKED_SCHEMA, insert_packed, read_packed),
+            ):
+                path = str(Path(tmp) / f"{mode}.sqlite3")
+                size = self._build(path, schema, insert)
+                latency = self._time(path, read, options["batches"], options["repeat"])
+                results[mode] = (size, latency)
+
+        self.stdout.write(f"{boxes} boxes in {options['batches']} batches")
+        for mode, (size, latency) in results.items():
+            self.stdout.write(
+                f"  {mode:6}: {size / 1e6:8.2f} MB ({size / boxes:6.1f} B/box), "
+                f"batch read {latency * 1000:8.2f} ms"
+            )
+        rows, packed = results["rows"], results["packed"]
+        self.stdout.write(
+            f"  packed is {rows[0] / packed[0]:.1f}x smaller and {rows[1] / packed[1]:.1f}x faster to read"
+        )
@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from web import trackdata
+from web.models import DetectionBatch
+from web.purge import DEFAULT_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = "Convert frame annotations between row-per-frame and packed per-track storage"
+
+    def add_arguments(self, parser):
+        parser.add_argument("batch_ids", nargs="*", type=int,
+                            help="batches to convert (default: every batch not archived)")
+        parser.add_argument("--to", choices=("packed", "keyframes", "rows"), required=True,
+                            help="target storage mode")
+        parser.add_argument("--min-iou", type=float, default=None,
+                            help="keyframe tolerance (default: TRACK_KEYFRAME_MIN_IOU)")
+        parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                            help="rows per DELETE/INSERT statement")
+
+    def handle(self, *args, **options):
+        batch_ids = options["batch_ids"] or list(
+            DetectionBatch.objects.filter(is_archived=False).order_by("pk").values_list("pk", flat=True)
+        )
+        target = options["to"]
+        if target == "rows":
+            convert = trackdata.unpack_batch
+        else:
+            min_iou = None
+            if target == "keyframes":
+                min_iou = options["min_iou"] or settings.TRACK_KEYFRAME_MIN_IOU
+
+            def convert(batch_id, chunk_size):
+                return trackdata.pack_batch(batch_id, chunk_size=chunk_size, min_iou=min_iou)
+
+        total_tracks = total_rows = total_stored = 0
+        for batch_id in batch_ids:
+            tracks, rows = convert(batch_id, chunk_size=options["chunk_size"])
+            stored = trackdata.stored_boxes_of_batch(batch_id)
+            total_tracks += tracks
+            total_rows += rows
+            total_stored += stored
+            self.stdout.write(
+                f"  batch {batch_id}: {tracks} tracks, {rows} frame rows, {stored} boxes stored"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"Converted {total_tracks} tracks ({total_rows} frame rows) to {target} storage, "
+            f"{total_stored} boxes stored"
+        ))
@@ -0,0 +1,71 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from web import evaluation, formats, interchange
+from web.models import DetectionBatch, PredictionFrame
+
+from .import_annotations import _pair, _size
+
+
+class Command(BaseCommand):
+    help = "Score model predictions against the labelled frames: per-class P/R, mAP, MOTA and IDF1"
+
+    def add_arguments(self, parser):
+        parser.add_argument("batch_ids", nargs="+", type=int)
+        parser.add_argument("--model", required=True, help="name the predictions are stored under")
+        parser.add_argument("--predictions",
+                            help="COCO-JSON or MOT file replacing the stored predictions (one batch only)")
+        parser.add_argument("--format", choices=formats.FORMATS, default=None,
+                            help="prediction file format (default: coco for .json, else mot)")
+        parser.add_argument("--resolution", type=_size, default=(1920, 1080),
+                            help="image size of MOT files as WIDTHxHEIGHT")
+        parser.add_argument("--fps", type=float, default=None, help="frame rate used for frame times")
+        parser.add_argument("--map", type=_pair, action="append", metavar="LABEL=TYPE",
+                            help="map a COCO category name or MOT class id to a disease type")
+        parser.add_argument("--map-file", help="JSON object of label to disease type mappings")
+
+    def handle(self, *args, **options):
+        batch_ids = options["batch_ids"]
+        missing = set(batch_ids) - set(
+            DetectionBatch.objects.filter(pk__in=batch_ids).values_list("pk", flat=True)
+        )
+        if missing:
+            raise CommandError(f"unknown batches: {sorted(missing)}")
+        model = options["model"]
+
+        if options["predictions"]:
+            if len(batch_ids) != 1:
+                raise CommandError("--predictions needs exactly one batch")
+            width, height = options["resolution"]
+            mapping = interchange.load_mapping(options["map"], options["map_file"])
+            try:
+                parsed = formats.parse_file(
+                    options["predictions"], options["format"], width, height, options["fps"]
+                )
+                type_ids = interchange.resolve_types(parsed.labels, mapping)
+            except (OSError, ValueError, KeyError) as exc:
+                raise CommandError(f"cannot read predictions: {exc}")
+            started = time.perf_counter()
+            boxes = evaluation.store_predictions(batch_ids[0], model, parsed, type_ids)
+            self.stdout.write(
+                f"Stored {boxes} predictions in {time.perf_counter() - started:.2f}s"
+            )
+
+        for batch_id in batch_ids:
+            if not PredictionFrame.objects.filter(batch_id=batch_id, model_name=model).exists():
+                raise CommandError(f"batch {batch_id} has no predictions of model {model!r}")
+            result = evaluation.evaluate_batch(batch_id, model)
+            self.stdout.write(
+                f"Batch {batch_id}: {result.gt_count} labels, {result.prediction_count} predictions; "
+                f"mAP@[.5:.95] {result.map:.3f}, mAP@.5 {result.map50:.3f}, "
+                f"P {result.precision:.3f}, R {result.recall:.3f}, MOTA {result.mota:.3f}, "
+                f"IDF1 {result.idf1:.3f}, ID switches {result.id_switches} "
+                f"in {result.elapsed:.2f}s (report {result.report_id})"
+            )
+            for name, metrics in sorted(result.per_class.items()):
+                self.stdout.write(
+                    f"  {name}: P {metrics['precision']:.3f}, R {metrics['recall']:.3f}, "
+                    f"AP {metrics['ap']:.3f}, AP50 {metrics['ap50']:.3f}"
+                )
+        self.stdout.write(self.style.SUCCESS("Done"))
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from web import formats, interchange
+from web.models import DetectionBatch
+
+from .import_annotations import _pair, _size
+
+
+class Command(BaseCommand):
+    help = "Stream the annotations of a detection batch as COCO-JSON or MOTChallenge CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument("batch_id", type=int)
+        parser.add_argument("output", help="file to write")
+        parser.add_argument("--format", choices=formats.FORMATS, default=None,
+                            help="output format (default: coco for .json, else mot)")
+        parser.add_argument("--resolution", type=_size, default=(1920, 1080),
+                            help="image size the normalised boxes are scaled to")
+        parser.add_argument("--map", type=_pair, action="append", metavar="TYPE=LABEL",
+                            help="map a disease type to a MOT class id or COCO category name")
+        parser.add_argument("--map-file", help="JSON object of disease type to label mappings")
+
+    def handle(self, *args, **options):
+        batch_id = options["batch_id"]
+        if not DetectionBatch.objects.filter(pk=batch_id).exists():
+            raise CommandError(f"unknown batch {batch_id}")
+        fmt = options["format"] or formats.detect_format(options["output"])
+        width, height = options["resolution"]
+        started = time.perf_counter()
+        with open(options["output"], "w", encoding="utf-8", newline="") as fh:
+            boxes = interchange.export_batch(
+                batch_id, fmt, fh, width, height,
+                interchange.load_mapping(options["map"], options["map_file"]),
+            )
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Exported {boxes} boxes to {options['output']} in {elapsed:.2f}s "
+            f"({boxes / max(elapsed, 1e-9):.0f} boxes/s)"
+        ))
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from web import pipeline, snapshots
+from web.models import DetectionBatch
+
+
+class Command(BaseCommand):
+    help = "Replace the frame images of each defect track with one cropped snapshot of its best frame"
+
+    def add_arguments(self, parser):
+        parser.add_argument("batch_ids", nargs="*", type=int)
+        parser.add_argument("--all", action="store_true",
+                            help="process every batch with a local video")
+        parser.add_argument("--margin", type=float, default=snapshots.SNAPSHOT_MARGIN,
+                            help="margin around the box as a fraction of its size")
+        parser.add_argument("--max-size", type=int, default=snapshots.SNAPSHOT_SIZE,
+                            help="longest side of a snapshot in pixels")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="encoding processes (default: CPU count, 0 encodes inline)")
+        parser.add_argument("--keep-files", action="store_true",
+                            help="keep the image files of the replaced media rows")
+
+    def handle(self, *args, **options):
+        if options["all"] == bool(options["batch_ids"]):
+            raise CommandError("pass batch ids or --all")
+        qs = DetectionBatch.objects.order_by("pk")
+        if not options["all"]:
+            qs = qs.filter(pk__in=options["batch_ids"])
+            missing = set(options["batch_ids"]) - set(qs.values_list("pk", flat=True))
+            if missing:
+                raise CommandError(f"unknown batches: {sorted(missing)}")
+
+        for batch in qs:
+            path = pipeline.video_path(batch)
+            if path is None:
+                if not options["all"]:
+                    raise CommandError(f"batch {batch.pk} has no local video")
+                continue
+            try:
+                result = pipeline.extract_snapshots(
+                    batch,
+                    path,
+                    margin=options["margin"],
+                    max_size=options["max_size"],
+                    workers=options["workers"],
+                    remove_files=not options["keep_files"],
+                )
+            except OSError as exc:
+                raise CommandError(f"batch {batch.pk}: {exc}")
+            self.stdout.write(
+                f"Batch {batch.pk}: {result['tracks']} snapshots, {result['files']} new files "
+                f"({result['bytes'] / 1e3:.0f} kB), {result['replaced']} media rows replaced "
+                f"in {result['elapsed']:.2f}s"
+            )
+        self.stdout.write(self.style.SUCCESS("Done"))
@@ -1,17 +1,22 @@
 # web/management/commands/generate_demo_data.py
+import argparse
+import time
+from itertools import islice
 from pathlib import Path
 import shutil
-import numpy as np
 import imageio
-import cv2
 from datetime import timedelta
 
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from django.apps import apps
-from django.db import connection
+from django.db import transaction
 from django.conf import settings
 
+from web import counters, rollups, trackdata, versions
+from web.overlay import build_overlay
+from web.purge import purge_batches
+from web.snapshots import SNAPSHOT_DIR, SNAPSHOT_SIZE, BestViews, SnapshotStore
+from web.synth import RoadRenderer, random_defects
 from web.models import (
     DiseaseType,
     WeatherType,
@@ -23,128 +28,135 @@ from web.models import (
     DefectTrack,
     DiseaseMedia,
     GroundTruthFrame,
+    PackedTrackFrames,
 )
 
 
+def _resolution(value):
+    """解析 ``WIDTHxHEIGHT`` 形式的分辨率参数"""
+    try:
+        width, height = (int(v) for v in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid resolution {value!r}, expected WIDTHxHEIGHT")
+    if width < 320 or height < 180:
+        raise argparse.ArgumentTypeError("resolution must be at least 320x180")
+    return width, height
+
+
+def _bulk_insert(model, objs, batch_size):
+    """分块 bulk_create 可迭代对象，避免一次性物化全部行；返回写入行数"""
+    objs = iter(objs)
+    total = 0
+    while chunk := list(islice(objs, batch_size)):
+        model.objects.bulk_create(chunk)
+        total += len(chunk)
+    return total
+
+
 class Command(BaseCommand):
     help = "Generate demo detection data with a short video and sample defects"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--duration", type=int, default=10, help="video length in seconds")
+        parser.add_argument("--fps", type=int, default=30, help="video frame rate")
+        parser.add_argument(
+            "--resolution",
+            type=_resolution,
+            default=(1920, 1080),
+            help="video size as WIDTHxHEIGHT (default 1920x1080)",
+        )
+        parser.add_argument(
+            "--scale", type=int, default=1,
+            help="multiply the DEMO_DAYS batches, e.g. 20 loads 100 days of flights",
+        )
+        parser.add_argument("--batch-size", type=int, default=2000, help="rows per bulk INSERT")
+        parser.add_argument(
+            "--workers", type=int, default=None,
+            help="snapshot encoding processes (default: CPU count, 0 encodes inline)",
+        )
+        parser.add_argument(
+            "--keyframe-iou", type=float, default=None,
+            help="store tracks as packed keyframes reproducing every box with this IoU",
+        )
+
     # ---------- 1. 生成视频及缺陷标签 ----------
-    def _generate_demo_video_with_defects(self, path: Path, duration: int = 10, fps: int = 30):
-        width, height = 1920, 1080
+    def _generate_demo_video_with_defects(self, path: Path, duration: int = 10, fps: int = 30,
+                                          width: int = 1920, height: int = 1080,
+                                          on_labeled_frame=None):
+        """逐帧渲染并编码视频，帧用完即释放，内存占用与时长无关。
+
+        ``on_labeled_frame(frame_index, img, labels)`` 在含缺陷的帧编码后立即调用，
+        用于在同一遍渲染中保存截图。
+        """
         total_frames = duration * fps
-        all_frames = []          # 每帧图像（长度 == total_frames）
         defect_labels = []       # [{frame_index, bbox_x, ...}]
-        defects = []             # 缺陷轨迹配置
-
-        road_left, road_right = width // 4, width * 3 // 4
-
-        def add_defects(label, shape, base_kwargs):
-            """为某类缺陷随机生成 2~10 条轨迹"""
-            cnt = np.random.randint(2, 11)
-            for _ in range(cnt):
-                start_t = float(np.random.uniform(0, max(0.1, duration - 1)))
-                end_t   = float(min(duration, start_t + np.random.uniform(0.5, 1.5)))
-                x_pos   = int(np.random.randint(road_left + 50, road_right - 50))
-                defects.append(
-                    dict(label=label, shape=shape, start=start_t, end=end_t,
-                         x=x_pos, start_y=height + 150, end_y=-150, **base_kwargs)
-                )
-
-        add_defects("裂缝", "line",   {"length": 300, "thickness": 8, "color": (30, 30, 30)})
-        add_defects("坑槽", "circle", {"size": 120, "color": (80, 80, 80)})
+        defects = random_defects(duration, width, height)   # 缺陷轨迹配置
+        renderer = RoadRenderer(defects, width, height, fps)
 
         with imageio.get_writer(str(path),
                                 fps=fps,
                                 codec="libx264",
                                 bitrate="2M",
                                 macro_block_size=None) as writer:
-            for t in range(total_frames):
-                img = np.full((height, width, 3), (34, 139, 34), np.uint8)
-
-                # 画公路背景
-                img[:, road_left:road_right] = (50, 50, 50)
-                offset = (t * 20) % 80
-                for y in range(-offset, height, 80):
-                    img[y:y+40, width//2-5:width//2+5] = (255, 255, 255)
-
-                time_sec = t / fps
-                for idx, df in enumerate(defects):
-                    if not (df["start"] <= time_sec <= df["end"]):
-                        continue
-                    ratio = (time_sec - df["start"]) / (df["end"] - df["start"])
-                    cx    = int(df["x"])
-                    cy    = int(df["start_y"] + ratio * (df["end_y"] - df["start_y"]))
-                    shape = df["shape"]
-
-                    # ---------- 根据形状画缺陷并计算 bbox ----------
-                    if shape == "circle":
-                        r = df["size"] // 2
-                        cv2.circle(img, (cx, cy), r, df["color"], -1)
-                        x, y, w, h = cx - r, cy - r, 2*r, 2*r
-                    elif shape == "line":
-                        L       = df["length"]
-                        thick   = df["thickness"]
-                        segments = 8
-                        amp      = thick * 2
-                        pts = [
-                            (int(cx + ((-1) ** i) * amp),
-                             int(cy - L/2 + i * L / (segments - 1)))
-                            for i in range(segments)
-                        ]
-                        cv2.polylines(img, [np.array(pts, dtype=np.int32)],
-                                      False, df["color"], thick)
-                        x, y, w, h = cv2.boundingRect(np.array(pts, dtype=np.int32))
-                        # 扩一点边缘
-                        pad = thick
-                        x, y, w, h = x-pad, y-pad, w+2*pad, h+2*pad
-                    else:
-                        continue
-
-                    # 裁剪到画面边界
-                    x = max(0, x);    y = max(0, y)
-                    w = min(w, width  - x)
-                    h = min(h, height - y)
-
-                    defect_labels.append(
-                        dict(frame_index=t,
-                             time=round(time_sec, 3),
-                             bbox_x=x / width,
-                             bbox_y=y / height,
-                             bbox_width=w / width,
-                             bbox_height=h / height,
-                             label=df["label"],
-                             track_id=idx)  # 轨迹编号 == defects 列表索引
-                    )
-
-                # 保存帧
-                all_frames.append(img.copy())
+            # 背景为预生成长条图的滚动视图，活动缺陷经区间索引查找、bbox 批量计算
+            for t, img, frame_labels in renderer.frames(total_frames):
+                # 编码当前帧，并在同一遍中交给截图回调
                 writer.append_data(img)
+                defect_labels.extend(frame_labels)
+                if frame_labels and on_labeled_frame is not None:
+                    on_labeled_frame(t, img, frame_labels)
 
-        return all_frames, defect_labels, fps
+        return defect_labels, fps
 
     # ---------- 2. 主入口 ----------
     def handle(self, *args, **options):
-        # 清空旧数据
-        for model in reversed(list(apps.get_app_config("web").get_models())):
-            if model._meta.db_table in connection.introspection.table_names():
-                model.objects.all().delete()
+        # 清空旧批次（分块原生 DELETE，不加载模型实例）；媒体目录随后整体重建
+        purge_batches(remove_files=False)
 
         # 重建 media/demo
-        media_root = Path("media")
+        media_root = Path(settings.MEDIA_ROOT)
         shutil.rmtree(media_root, ignore_errors=True)
         base_dir = media_root / "demo"
         base_dir.mkdir(parents=True, exist_ok=True)
         video_path = base_dir / "demo_video.mp4"
+        base_days = getattr(settings, "DEMO_DAYS", 5)
+        days = base_days * options["scale"]
 
-        # 生成视频 + 标签
-        duration = 10
-        all_frames, defect_labels, fps = self._generate_demo_video_with_defects(
-            video_path, duration=duration, fps=30
-        )
+        # 生成视频 + 标签；同一遍渲染中为每条轨迹保留框最大（居中）的一帧，
+        # 裁出缺陷区域加边距，缩放到 SNAPSHOT_SIZE 以内后交给进程池编码，
+        # 按内容哈希存储，各天共享同一轨迹的截图文件
+        duration = options["duration"]
+        width, height = options["resolution"]
+        snapshot_started = time.perf_counter()
+        views = BestViews()
+
+        def keep_best_views(frame_index, img, labels):
+            for lab in labels:
+                views.offer(
+                    lab["track_id"], frame_index, img,
+                    (lab["bbox_x"], lab["bbox_y"], lab["bbox_width"], lab["bbox_height"]),
+                )
+
+        with SnapshotStore(
+            media_root / SNAPSHOT_DIR,
+            f"{settings.MEDIA_URL}{SNAPSHOT_DIR}/",
+            workers=options["workers"],
+            max_size=SNAPSHOT_SIZE,
+        ) as snapshots:
+            defect_labels, fps = self._generate_demo_video_with_defects(
+                video_path, duration=duration, fps=options["fps"], width=width, height=height,
+                on_labeled_frame=keep_best_views,
+            )
+            for track_id, (_, _, img) in views.views.items():
+                snapshots.put(track_id, img)
         total_frames = duration * fps
+        self.stdout.write(
+            f"Rendered video and {snapshots.files} track snapshots "
+            f"({snapshots.bytes / 1e6:.1f} MB, {snapshots.duplicates} duplicates skipped) "
+            f"in {time.perf_counter() - snapshot_started:.2f}s"
+        )
 
-        # ---------- 3. 业务表准备 ----------
+        # ---------- 3. 业务表准备（字典表只解析一次） ----------
         severity, _    = SeverityLevel.objects.get_or_create(name="轻度", code="low")
         report_type, _ = ReportType.objects.get_or_create(name="日常报表", code="daily")
         mtype, _       = MediaType.objects.get_or_create(name="图片", code="image")
@@ -162,64 +174,143 @@ class Command(BaseCommand):
         for lab in defect_labels:
             labels_by_track.setdefault(lab["track_id"], []).append(lab)
         track_groups = list(labels_by_track.values())   # 每元素 = 同一轨迹所有帧标签
+        for items in track_groups:
+            items.sort(key=lambda x: x["frame_index"])
+        disease_types = {
+            label: DiseaseType.objects.get_or_create(name=label)[0]
+            for label in {items[0]["label"] for items in track_groups}
+        }
 
-        days = getattr(settings, "DEMO_DAYS", 5)
-        for day in range(days):
-            ts       = timezone.now() - timedelta(days=day)
-            weather  = weather_list[day % len(weather_list)]
-            temp     = weather_opts[day % len(weather_opts)][2]
-
-            batch = DetectionBatch.objects.create(
-                start_time=ts,
-                end_time=ts,
-                airport=f"A{day+1}",
-                drone_id=f"D{day+1}",
-                weather=weather,
-                temperature=temp,
-                video_link=f"{settings.MEDIA_URL}demo/demo_video.mp4",
-                total_frames=total_frames,
-                video_duration=duration,
+        # ---------- 4. 批量写入 ----------
+        batch_size = options["batch_size"]
+        started = time.perf_counter()
+        rows = 0
+        now = timezone.now()
+        with transaction.atomic():
+            batches = DetectionBatch.objects.bulk_create(
+                [
+                    DetectionBatch(
+                        start_time=now - timedelta(days=day),
+                        end_time=now - timedelta(days=day),
+                        airport=f"A{day % base_days + 1}",
+                        drone_id=f"D{day % base_days + 1}",
+                        weather=weather_list[day % len(weather_list)],
+                        temperature=weather_opts[day % len(weather_opts)][2],
+                        video_link=f"{settings.MEDIA_URL}demo/demo_video.mp4",
+                        total_frames=total_frames,
+                        video_duration=duration,
+                    )
+                    for day in range(days)
+                ],
+                batch_size=batch_size,
             )
-            report = Report.objects.create(batch=batch, report_type=report_type)
-
-            # *** 关键修正：每天导入「全部」轨迹，保证数据与视频一致 ***
-            for idx, items in enumerate(track_groups, 1):
-                items.sort(key=lambda x: x["frame_index"])
-                label  = items[0]["label"]
-                d_type, _ = DiseaseType.objects.get_or_create(name=label)
-
-                track = DefectTrack.objects.create(
-                    batch=batch,
-                    disease_type=d_type,
-                    unique_code=f"DEMO-{day+1}-{idx}",
-                    severity=severity,
-                    start_frame=items[0]["frame_index"],
-                    end_frame=items[-1]["frame_index"],
-                    start_time=items[0]["time"],
-                    end_time=items[-1]["time"],
-                    report=report,
-                )
+            reports = Report.objects.bulk_create(
+                [Report(batch=batch, report_type=report_type) for batch in batches],
+                batch_size=batch_size,
+            )
+            rows += len(batches) + len(reports)
 
-                # 保存帧图片 + GT
-                for lab in items:
-                    frame_img  = all_frames[lab["frame_index"]]
-                    frame_name = f"day{day}_{label}_{lab['frame_index']}.jpg"
-                    frame_path = base_dir / frame_name
-                    imageio.imwrite(str(frame_path), frame_img)
+            # *** 每天导入「全部」轨迹，保证数据与视频一致 ***
+            tracks = DefectTrack.objects.bulk_create(
+                [
+                    DefectTrack(
+                        batch=batch,
+                        disease_type=disease_types[items[0]["label"]],
+                        unique_code=f"DEMO-{day+1}-{idx}",
+                        severity=severity,
+                        start_frame=items[0]["frame_index"],
+                        end_frame=items[-1]["frame_index"],
+                        start_time=items[0]["time"],
+                        end_time=items[-1]["time"],
+                        report=report,
+                        snapshot_link=snapshots.urls[items[0]["track_id"]],
+                    )
+                    for day, (batch, report) in enumerate(zip(batches, reports))
+                    for idx, items in enumerate(track_groups, 1)
+                ],
+                batch_size=batch_size,
+            )
+            rows += len(tracks)
 
-                    DiseaseMedia.objects.create(
+            # 截图已在渲染时写出，每条轨迹只登记一张最佳帧截图 + 保存 GT；按批大小分块写入
+            track_items = list(zip(tracks, track_groups * days))
+            rows += _bulk_insert(
+                DiseaseMedia,
+                (
+                    DiseaseMedia(
                         defect_track=track,
                         media_type=mtype,
-                        file_link=f"{settings.MEDIA_URL}demo/{frame_name}",
+                        file_link=track.snapshot_link,
+                        description=f"第 {views.views[items[0]['track_id']][0]} 帧",
                     )
-                    GroundTruthFrame.objects.create(
-                        track=track,
-                        frame_index=lab["frame_index"],
-                        time=lab["time"],
-                        bbox_x=lab["bbox_x"],
-                        bbox_y=lab["bbox_y"],
-                        bbox_width=lab["bbox_width"],
-                        bbox_height=lab["bbox_height"],
+                    for track, items in track_items
+                ),
+                batch_size,
+            )
+            if options["keyframe_iou"] is None:
+                rows += _bulk_insert(
+                    GroundTruthFrame,
+                    (
+                        GroundTruthFrame(
+                            track=track,
+                            batch_id=track.batch_id,
+                            frame_index=lab["frame_index"],
+                            time=lab["time"],
+                            bbox_x=lab["bbox_x"],
+                            bbox_y=lab["bbox_y"],
+                            bbox_width=lab["bbox_width"],
+                            bbox_height=lab["bbox_height"],
+                        )
+                        for track, items in track_items
+                        for lab in items
+                    ),
+                    batch_size,
+                )
+            else:
+                # 关键帧压缩：每条轨迹只压缩一次，各天复用同一 BLOB
+                packed = [
+                    trackdata.pack(
+                        [lab["frame_index"] for lab in items],
+                        [lab["time"] for lab in items],
+                        [[lab["bbox_x"], lab["bbox_y"], lab["bbox_width"], lab["bbox_height"]]
+                         for lab in items],
+                        options["keyframe_iou"],
                     )
+                    for items in track_groups
+                ]
+                rows += _bulk_insert(
+                    PackedTrackFrames,
+                    (
+                        PackedTrackFrames(
+                            track=track,
+                            frame_count=len(items),
+                            data=data,
+                            **trackdata.packed_fields(data),
+                        )
+                        for (track, items), data in zip(track_items, packed * days)
+                    ),
+                    batch_size,
+                )
+                stored = sum(trackdata.stored_boxes(data) for data in packed)
+                dense = sum(len(items) for items in track_groups)
+                self.stdout.write(
+                    f"Keyframes: {stored} of {dense} boxes stored per batch "
+                    f"({dense / max(stored, 1):.1f}x fewer)"
+                )
+
+            # bulk_create 不触发信号：统一重建计数、日汇总并更新数据版本
+            counters.rebuild()
+            rollups.rebuild()
+            versions.bump(
+                versions.GLOBAL_SCOPE, *(versions.batch_scope(batch.id) for batch in batches)
+            )
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"Loaded {rows} rows in {elapsed:.2f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)"
+        )
+
+        # 预先生成各批次的叠加框缓存
+        for batch in batches:
+            build_overlay(batch.id)
 
         self.stdout.write(self.style.SUCCESS("✅  Demo video, images, and GT labels generated!"))
@@ -0,0 +1,73 @@
+import argparse
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from web import formats, interchange
+
+
+def _size(value):
+    try:
+        return formats.parse_size(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size {value!r}, expected WIDTHxHEIGHT")
+
+
+def _pair(value):
+    source, sep, target = value.partition("=")
+    if not sep or not source or not target:
+        raise argparse.ArgumentTypeError(f"invalid mapping {value!r}, expected SOURCE=TARGET")
+    return source, target
+
+
+class Command(BaseCommand):
+    help = "Import COCO-JSON or MOTChallenge annotation files, one detection batch per file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="annotation files")
+        parser.add_argument("--format", choices=formats.FORMATS, default=None,
+                            help="file format (default: coco for .json, else mot)")
+        parser.add_argument("--resolution", type=_size, default=(1920, 1080),
+                            help="image size of MOT files as WIDTHxHEIGHT")
+        parser.add_argument("--fps", type=float, default=30, help="frame rate used for frame times")
+        parser.add_argument("--map", type=_pair, action="append", metavar="LABEL=TYPE",
+                            help="map a COCO category name or MOT class id to a disease type")
+        parser.add_argument("--map-file", help="JSON object of label to disease type mappings")
+        parser.add_argument("--create-types", action="store_true",
+                            help="create disease types missing from the dictionary")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="parsing processes (default: CPU count, 0 parses inline)")
+        parser.add_argument("--batch-size", type=int, default=interchange.DEFAULT_BATCH_SIZE,
+                            help="rows per bulk INSERT")
+        parser.add_argument("--airport", default="import", help="airport of the created batches")
+        parser.add_argument("--drone", default="import", help="drone id of the created batches")
+
+    def handle(self, *args, **options):
+        width, height = options["resolution"]
+        mapping = interchange.load_mapping(options["map"], options["map_file"])
+
+        def progress(path, batch, tracks, boxes):
+            self.stdout.write(f"  {path}: batch {batch.pk}, {tracks} tracks, {boxes} boxes")
+
+        started = time.perf_counter()
+        try:
+            batches, tracks, boxes = interchange.import_files(
+                options["paths"],
+                fmt=options["format"],
+                width=width,
+                height=height,
+                fps=options["fps"],
+                mapping=mapping,
+                create_types=options["create_types"],
+                workers=options["workers"],
+                batch_size=options["batch_size"],
+                batch_fields={"airport": options["airport"], "drone_id": options["drone"]},
+                progress=progress,
+            )
+        except (OSError, ValueError, KeyError) as exc:
+            raise CommandError(f"import failed: {exc}")
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {boxes} boxes in {tracks} tracks from {batches} files in {elapsed:.2f}s "
+            f"({boxes / max(elapsed, 1e-9):.0f} boxes/s)"
+        ))
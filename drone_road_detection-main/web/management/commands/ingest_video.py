@@ -0,0 +1,86 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from web import detectors, ingest, matching, pipeline
+from web.models import DefectTrack, DetectionBatch, DiseaseType
+
+
+class Command(BaseCommand):
+    help = "Detect and track defects in a batch's flight video and store them as defect tracks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("batch_id", type=int)
+        parser.add_argument("--video", help="video file (default: the file behind video_link)")
+        parser.add_argument("--detector", default=None,
+                            help="dotted path of the detector class (default: VIDEO_DETECTOR)")
+        parser.add_argument("--detector-options", type=json.loads, default=None,
+                            help="JSON object of keyword arguments for the detector")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="detector processes (default: CPU count, 0 detects inline)")
+        parser.add_argument("--chunk-size", type=int, default=ingest.DEFAULT_CHUNK_SIZE,
+                            help="boxes per insert transaction")
+        parser.add_argument("--min-iou", type=float, default=0.2,
+                            help="IoU linking a detection to a track's predicted box")
+        parser.add_argument("--max-age", type=int, default=5,
+                            help="frames a track survives without detections")
+        parser.add_argument("--min-hits", type=int, default=3,
+                            help="detections needed before a track is stored")
+        parser.add_argument("--match", action="store_true",
+                            help="match the new tracks against the previous batch afterwards")
+        parser.add_argument("--snapshots", action="store_true",
+                            help="store a cropped snapshot of every new track afterwards")
+
+    def handle(self, *args, **options):
+        batch = DetectionBatch.objects.filter(pk=options["batch_id"]).first()
+        if batch is None:
+            raise CommandError(f"unknown batch {options['batch_id']}")
+        if batch.status == pipeline.PROCESSING:
+            raise CommandError(f"batch {batch.pk} is already being processed")
+        if DefectTrack.objects.filter(batch=batch).exists():
+            raise CommandError(f"batch {batch.pk} already has defect tracks")
+        path = options["video"] or pipeline.video_path(batch)
+        if path is None:
+            raise CommandError(f"batch {batch.pk} has no local video, pass --video")
+
+        detector = options["detector"] or pipeline.detector_path()
+        try:
+            labels = detectors.load_detector(detector, **(options["detector_options"] or {})).labels
+        except (ImportError, AttributeError, TypeError, ValueError) as exc:
+            raise CommandError(f"cannot load detector {detector!r}: {exc}")
+        missing = set(labels) - set(DiseaseType.objects.values_list("name", flat=True))
+        if missing:
+            raise CommandError(f"unknown disease types: {', '.join(sorted(missing))}")
+
+        def progress(frames, elapsed):
+            self.stdout.write(f"  {frames} frames, {frames / max(elapsed, 1e-9):.1f} fps")
+
+        try:
+            stats = pipeline.ingest_video(
+                batch,
+                path,
+                detector=detector,
+                options=options["detector_options"],
+                workers=options["workers"],
+                chunk_size=options["chunk_size"],
+                tracker=pipeline.IouTracker(
+                    options["min_iou"], options["max_age"], options["min_hits"]
+                ),
+                progress=progress,
+            )
+        except (OSError, ValueError) as exc:
+            raise CommandError(f"ingestion failed: {exc}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {stats['frames']} frames in {stats['elapsed']:.2f}s "
+            f"({stats['fps']:.1f} fps): {stats['tracks']} tracks, {stats['boxes']} boxes"
+        ))
+        if options["snapshots"]:
+            result = pipeline.extract_snapshots(batch, path, workers=options["workers"])
+            self.stdout.write(
+                f"Stored {result['tracks']} track snapshots ({result['bytes'] / 1e3:.0f} kB)"
+            )
+        if options["match"]:
+            result = matching.match_batch(batch.pk)
+            self.stdout.write(
+                f"Matched {len(result.pairs)} tracks against batch {result.previous_batch}"
+            )
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from web import matching
+from web.models import DetectionBatch
+
+
+class Command(BaseCommand):
+    help = "Match defect tracks against the previous batch on the same route and set develop_trend"
+
+    def add_arguments(self, parser):
+        parser.add_argument("batch_ids", nargs="*", type=int)
+        parser.add_argument("--all", action="store_true",
+                            help="match every batch, oldest first")
+        parser.add_argument("--min-iou", type=float, default=matching.DEFAULT_MIN_IOU,
+                            help="minimum IoU of the mean boxes of a candidate pair")
+        parser.add_argument("--growth", type=float, default=matching.DEFAULT_GROWTH,
+                            help="relative area growth above which a defect is marked growing")
+
+    def handle(self, *args, **options):
+        if options["all"] == bool(options["batch_ids"]):
+            raise CommandError("pass batch ids or --all")
+        qs = DetectionBatch.objects.order_by("start_time", "pk")
+        if not options["all"]:
+            qs = qs.filter(pk__in=options["batch_ids"])
+            missing = set(options["batch_ids"]) - set(qs.values_list("pk", flat=True))
+            if missing:
+                raise CommandError(f"unknown batches: {sorted(missing)}")
+
+        for batch_id in qs.values_list("pk", flat=True):
+            started = time.perf_counter()
+            result = matching.match_batch(batch_id, options["min_iou"], options["growth"])
+            elapsed = time.perf_counter() - started
+            counts = {}
+            for trend in result.trends.values():
+                counts[trend] = counts.get(trend, 0) + 1
+            summary = ", ".join(f"{trend} {count}" for trend, count in sorted(counts.items()))
+            previous = "none" if result.previous_batch is None else result.previous_batch
+            self.stdout.write(
+                f"Batch {batch_id} (previous: {previous}): {len(result.pairs)} matched, "
+                f"{len(result.repaired)} repaired; {summary or 'no tracks'} in {elapsed:.2f}s"
+            )
+        self.stdout.write(self.style.SUCCESS("Done"))
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from web.models import DetectionBatch
+from web.purge import DEFAULT_CHUNK_SIZE, purge_batches
+
+
+class Command(BaseCommand):
+    help = "Delete detection batches with their tracks, frames, media rows and files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("batch_ids", nargs="*", type=int, help="batches to purge")
+        parser.add_argument("--all", action="store_true", help="purge every batch")
+        parser.add_argument("--expired", action="store_true", help="purge batches past expire_at")
+        parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                            help="rows per DELETE statement")
+        parser.add_argument("--keep-files", action="store_true", help="leave media files on disk")
+
+    def handle(self, *args, **options):
+        if options["all"]:
+            batch_ids = None
+        elif options["expired"]:
+            batch_ids = list(
+                DetectionBatch.objects.filter(expire_at__lte=timezone.now())
+                .values_list("pk", flat=True)
+            )
+        elif options["batch_ids"]:
+            batch_ids = options["batch_ids"]
+        else:
+            raise CommandError("Give batch ids, --expired or --all")
+
+        def progress(table, deleted):
+            self.stdout.write(f"  {table}: {deleted} rows deleted")
+
+        deleted, removed = purge_batches(
+            batch_ids,
+            chunk_size=options["chunk_size"],
+            progress=progress,
+            remove_files=not options["keep_files"],
+        )
+        batches = deleted.get(DetectionBatch._meta.db_table, 0)
+        self.stdout.write(self.style.SUCCESS(
+            f"Purged {batches} batches, {sum(deleted.values())} rows and {len(removed)} files"
+        ))
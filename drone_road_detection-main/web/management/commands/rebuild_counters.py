@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from web import counters
+
+
+class Command(BaseCommand):
+    help = "Rebuild the dashboard statistics counters from the source tables"
+
+    def handle(self, *args, **options):
+        rows = counters.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rows} counter rows"))
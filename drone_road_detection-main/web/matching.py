@@ -0,0 +1,321 @@
+"""Cross-batch defect matching that fills ``DefectTrack.develop_trend``.
+
+Each track of a batch is summarised by its mean normalised box and its
+time span in the video.  Tracks are compared with those of the previous
+batch flown from the same airport (the same route):
+
+* a pair is a candidate when the disease types agree, the mean boxes
+  overlap with IoU >= ``min_iou`` and the time spans overlap;
+* its cost is ``1 - box IoU * time IoU``;
+* candidate pairs are split into connected components and each component
+  is solved as a linear assignment problem.  ``scipy.optimize`` is used when
+  it is installed; otherwise a NumPy Hungarian solver handles the (small)
+  components.
+
+Matched tracks become :data:`GROWING` when their mean box area grew by
+more than ``growth`` and :data:`STABLE` otherwise.  Unmatched new tracks
+become :data:`NEW`.  Tracks of the previous batch with no match are
+marked :data:`REPAIRED`, which is what ``dashboard_stats`` counts as
+completed.  Matching is re-runnable: an old track marked repaired by an
+earlier run that now has a match gets back the trend of its own batch,
+and new tracks already marked repaired by a later batch stay repaired.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from django.db import transaction
+
+from . import counters, overlay, signals
+from .models import DefectTrack, DetectionBatch
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # pragma: no cover - depends on the environment
+    linear_sum_assignment = None
+
+GROWING = "扩大"
+STABLE = "无变化"
+REPAIRED = counters.COMPLETED_TREND
+NEW = "新增"
+
+DEFAULT_MIN_IOU = 0.3
+DEFAULT_GROWTH = 0.2
+
+# New tracks compared with every old track at once by :func:`candidates`.
+CANDIDATE_BLOCK = 512
+
+# Cost of pairs that must not be assigned.
+_FORBIDDEN = 1e6
+
+TrackSummary = namedtuple("TrackSummary", "pk disease_type box start end")
+
+MatchResult = namedtuple("MatchResult", "previous_batch pairs trends repaired")
+
+
+def previous_batch(batch_id):
+    """Return the id of the last earlier batch on the same route, or ``None``."""
+    batch = DetectionBatch.objects.filter(pk=batch_id).values("airport", "start_time").first()
+    if batch is None:
+        return None
+    return (
+        DetectionBatch.objects.filter(airport=batch["airport"], start_time__lt=batch["start_time"])
+        .order_by("-start_time", "-pk")
+        .values_list("pk", flat=True)
+        .first()
+    )
+
+
+def summarize(batch_id):
+    """Return the :class:`TrackSummary` arrays of every track of a batch
+    with at least one box."""
+    columns = overlay.batch_columns(batch_id)
+    types = dict(DefectTrack.objects.filter(batch_id=batch_id).values_list("pk", "disease_type_id"))
+    pks, inverse, counts = np.unique(columns.track_id, return_inverse=True, return_counts=True)
+
+    box = np.zeros((len(pks), 4))
+    np.add.at(box, inverse, columns.bbox)
+    box /= np.maximum(counts, 1)[:, None]
+
+    # Each frame covers half a frame period either side of its time, so
+    # single-frame tracks still have a span.
+    period = 1 / (overlay.batch_fps(batch_id) or 30.0)
+    time = np.where(np.isnan(columns.time), columns.frame_index * period, columns.time)
+    start = np.full(len(pks), np.inf)
+    end = np.full(len(pks), -np.inf)
+    np.minimum.at(start, inverse, time - period / 2)
+    np.maximum.at(end, inverse, time + period / 2)
+    return TrackSummary(
+        pks.astype(np.int64),
+        np.array([types.get(int(pk), -1) for pk in pks], np.int64),
+        box,
+        start,
+        end,
+    )
+
+
+def pairwise_iou(a, b):
+    """IoU of every box of ``a`` against every box of ``b`` (``x, y, w, h``)."""
+    a = a[:, None, :]
+    b = b[None, :, :]
+    width = np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    height = np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+    inter = np.clip(width, 0, None) * np.clip(height, 0, None)
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - inter
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(union > 0, inter / union, 0.0)
+
+
+def interval_iou(start_a, end_a, start_b, end_b):
+    """IoU of every ``[start, end]`` span of ``a`` against those of ``b``."""
+    inter = np.minimum(end_a[:, None], end_b[None, :]) - np.maximum(start_a[:, None], start_b[None, :])
+    union = np.maximum(end_a[:, None], end_b[None, :]) - np.minimum(start_a[:, None], start_b[None, :])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(union > 0, np.clip(inter, 0, None) / union, 0.0)
+
+
+def candidates(new, old, min_iou=DEFAULT_MIN_IOU, block=CANDIDATE_BLOCK):
+    """Return ``(rows, cols, costs)`` of the ``new`` x ``old`` pairs that
+    may match.  The dense comparison runs ``block`` new tracks at a time
+    to bound memory."""
+    rows, cols, costs = [], [], []
+    for offset in range(0, len(new.pk), block):
+        part = slice(offset, offset + block)
+        box_iou = pairwise_iou(new.box[part], old.box)
+        time_iou = interval_iou(new.start[part], new.end[part], old.start, old.end)
+        allowed = (
+            (new.disease_type[part, None] == old.disease_type[None, :])
+            & (box_iou >= min_iou)
+            & (time_iou > 0)
+        )
+        r, c = np.nonzero(allowed)
+        rows.append(r + offset)
+        cols.append(c)
+        costs.append(1 - box_iou[r, c] * time_iou[r, c])
+    if not rows:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0)
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(costs)
+
+
+def components(rows, cols, n, m):
+    """Label the connected components of the bipartite graph with edges
+    ``rows[k]`` -- ``cols[k]`` over ``n`` rows and ``m`` columns.
+
+    Returns ``(row_labels, column_labels)``; a component's label is the
+    smallest node id in it, rows numbered before columns.
+    """
+    labels = np.arange(n + m)
+    cols = cols + n
+    while True:
+        low = np.minimum(labels[rows], labels[cols])
+        previous = labels.copy()
+        np.minimum.at(labels, rows, low)
+        np.minimum.at(labels, cols, low)
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels[:n], labels[n:]
+
+
+def hungarian(cost):
+    """Minimum-cost assignment of a rectangular ``cost`` matrix.
+
+    Returns ``(rows, cols)`` like ``scipy.optimize.linear_sum_assignment``;
+    every row (or column, when there are fewer) is assigned.
+    """
+    cost = np.asarray(cost, np.float64)
+    if cost.shape[0] > cost.shape[1]:
+        cols, rows = hungarian(cost.T)
+        order = np.argsort(rows)
+        return rows[order], cols[order]
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    owner = np.zeros(m + 1, np.int64)  # row (1-based) assigned to each column
+    way = np.zeros(m + 1, np.int64)
+    for i in range(1, n + 1):
+        owner[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, bool)
+        while True:
+            used[j0] = True
+            i0 = owner[j0]
+            free = ~used
+            free[0] = False
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            better = free[1:] & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+            j1 = int(np.argmin(np.where(free, minv, np.inf)))
+            delta = minv[j1]
+            u[owner[used]] += delta
+            v[used] -= delta
+            minv[free] -= delta
+            j0 = j1
+            if owner[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            owner[j0] = owner[j1]
+            j0 = j1
+    cols = np.flatnonzero(owner[1:])
+    rows = owner[1:][cols] - 1
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+def assign(rows, cols, costs, n, m, missing=_FORBIDDEN):
+    """Minimum-cost matching over the candidate edges; returns matched
+    ``(rows, cols)``.  Components with a single edge are matched directly,
+    the others are solved as dense assignment problems.
+
+    ``missing`` is the cost of pairs without an edge.  The default favours
+    matching as many rows as possible; pass ``0`` with negative costs to
+    maximise the total weight instead.
+    """
+    row_labels, col_labels = components(rows, cols, n, m)
+    edge_labels = row_labels[rows]
+    labels, edge_counts = np.unique(edge_labels, return_counts=True)
+    single = np.isin(edge_labels, labels[edge_counts == 1])
+    matched_rows, matched_cols = [rows[single]], [cols[single]]
+
+    solve = linear_sum_assignment or hungarian
+    for label in labels[edge_counts > 1]:
+        edges = np.flatnonzero(edge_labels == label)
+        comp_rows = np.flatnonzero(row_labels == label)
+        comp_cols = np.flatnonzero(col_labels == label)
+        edge_rows = np.searchsorted(comp_rows, rows[edges])
+        edge_cols = np.searchsorted(comp_cols, cols[edges])
+        dense = np.full((len(comp_rows), len(comp_cols)), missing, np.float64)
+        dense[edge_rows, edge_cols] = costs[edges]
+        present = np.zeros(dense.shape, bool)
+        present[edge_rows, edge_cols] = True
+        r, c = solve(dense)
+        ok = present[r, c]
+        matched_rows.append(comp_rows[r[ok]])
+        matched_cols.append(comp_cols[c[ok]])
+    return np.concatenate(matched_rows), np.concatenate(matched_cols)
+
+
+def match(new, old, min_iou=DEFAULT_MIN_IOU, growth=DEFAULT_GROWTH):
+    """Match two :class:`TrackSummary` sets.
+
+    Returns ``(pairs, trends, repaired)``: matched ``(new_pk, old_pk)``
+    pairs, ``{new_pk: trend}`` and the old pks left unmatched.
+    """
+    rows, cols = assign(*candidates(new, old, min_iou), len(new.pk), len(old.pk))
+    area_new = new.box[rows, 2] * new.box[rows, 3]
+    area_old = old.box[cols, 2] * old.box[cols, 3]
+    grew = area_new > area_old * (1 + growth)
+    trends = {int(pk): NEW for pk in new.pk}
+    trends.update(
+        (int(pk), GROWING if g else STABLE) for pk, g in zip(new.pk[rows], grew)
+    )
+    repaired = np.setdiff1d(old.pk, old.pk[cols]).tolist()
+    pairs = list(zip(new.pk[rows].tolist(), old.pk[cols].tolist()))
+    return pairs, trends, repaired
+
+
+def _set_trends(trends):
+    """Store ``{pk: trend}`` with one UPDATE per trend value and apply the
+    completed-counter deltas the bulk update bypasses."""
+    stored = DefectTrack.objects.filter(pk__in=list(trends)).values_list("pk", "batch_id", "develop_trend")
+    deltas = {}
+    by_trend = {}
+    for pk, batch_id, old in stored:
+        new = trends[pk]
+        if new == old:
+            continue
+        by_trend.setdefault(new, []).append(pk)
+        delta = (new == REPAIRED) - (old == REPAIRED)
+        deltas[batch_id] = deltas.get(batch_id, 0) + delta
+    for trend, pks in by_trend.items():
+        for start in range(0, len(pks), 1000):
+            DefectTrack.objects.filter(pk__in=pks[start:start + 1000]).update(develop_trend=trend)
+    for batch_id, delta in deltas.items():
+        counters.apply_tracks(batch_id, completed=delta)
+    if by_trend:
+        signals.bulk_changed(*deltas)
+
+
+def _own_trends(batch_id, pks, min_iou, growth):
+    """Return the trends ``pks`` of ``batch_id`` get from matching their
+    batch against its predecessor, ignoring any later repair."""
+    previous = previous_batch(batch_id)
+    trends = {}
+    if previous is not None:
+        _, trends, _ = match(summarize(batch_id), summarize(previous), min_iou, growth)
+    return {pk: trends.get(pk, NEW) for pk in pks}
+
+
+def match_batch(batch_id, min_iou=DEFAULT_MIN_IOU, growth=DEFAULT_GROWTH):
+    """Compute ``develop_trend`` for the tracks of ``batch_id`` against the
+    previous batch on its route and mark unmatched old tracks repaired.
+
+    Returns a :class:`MatchResult`; without a previous batch every track
+    is :data:`NEW`.
+    """
+    previous = previous_batch(batch_id)
+    new = summarize(batch_id)
+    if previous is None:
+        pairs, trends, repaired = [], {int(pk): NEW for pk in new.pk}, []
+    else:
+        pairs, trends, repaired = match(new, summarize(previous), min_iou, growth)
+    with transaction.atomic():
+        updates = {**trends, **{pk: REPAIRED for pk in repaired}}
+        # Repairs seen by a later batch outlive re-matching this one.
+        updates.update(
+            (pk, REPAIRED)
+            for pk in DefectTrack.objects.filter(
+                batch_id=batch_id, develop_trend=REPAIRED
+            ).values_list("pk", flat=True)
+        )
+        reopened = list(
+            DefectTrack.objects.filter(
+                pk__in=[old_pk for _, old_pk in pairs], develop_trend=REPAIRED
+            ).values_list("pk", flat=True)
+        )
+        if reopened:
+            updates.update(_own_trends(previous, reopened, min_iou, growth))
+        _set_trends(updates)
+    return MatchResult(previous, pairs, trends, repaired)
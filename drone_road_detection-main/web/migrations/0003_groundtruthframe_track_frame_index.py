@@ -0,0 +1,17 @@
+# Generated by Django 4.2.1 on 2026-10-16 23:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0002_detectionbatch_temperature'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='groundtruthframe',
+            index=models.Index(fields=['track', 'frame_index'], name='gtf_track_frame_idx'),
+        ),
+    ]
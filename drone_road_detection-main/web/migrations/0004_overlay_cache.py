@@ -0,0 +1,48 @@
+# Generated by Django 4.2.1 on 2026-10-16 23:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0003_groundtruthframe_track_frame_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(help_text='如 batch:12', max_length=64, unique=True, verbose_name='范围')),
+                ('version', models.PositiveBigIntegerField(default=1, verbose_name='版本号')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '数据版本',
+                'verbose_name_plural': '数据版本',
+                'db_table': 'data_version',
+            },
+        ),
+        migrations.CreateModel(
+            name='OverlayCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(verbose_name='数据版本')),
+                ('variant', models.CharField(help_text='如 json 或 columnar|frame_index__gte=0', max_length=128, verbose_name='编码及窗口')),
+                ('content', models.BinaryField(verbose_name='内容')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='生成时间')),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='overlay_caches', to='web.detectionbatch', verbose_name='检测批次')),
+            ],
+            options={
+                'verbose_name': '叠加框缓存',
+                'verbose_name_plural': '叠加框缓存',
+                'db_table': 'overlay_cache',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='overlaycache',
+            constraint=models.UniqueConstraint(fields=('batch', 'version', 'variant'), name='overlay_cache_key'),
+        ),
+    ]
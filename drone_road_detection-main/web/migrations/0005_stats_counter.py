@@ -0,0 +1,60 @@
+# Generated by Django 4.2.1 on 2026-10-16 23:45
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def populate_counters(apps, schema_editor):
+    DetectionBatch = apps.get_model("web", "DetectionBatch")
+    DefectTrack = apps.get_model("web", "DefectTrack")
+    StatsCounter = apps.get_model("web", "StatsCounter")
+    per_batch = (
+        DefectTrack.objects.values("batch_id")
+        .annotate(
+            defects=Count("id"),
+            completed=Count("id", filter=Q(develop_trend="已修复")),
+        )
+        .order_by()
+    )
+    rows = [
+        StatsCounter(
+            key=f"batch:{r['batch_id']}",
+            defect_count=r["defects"],
+            completed_count=r["completed"],
+        )
+        for r in per_batch
+    ]
+    rows.append(
+        StatsCounter(
+            key="global",
+            inspection_count=DetectionBatch.objects.count(),
+            defect_count=sum(r.defect_count for r in rows),
+            completed_count=sum(r.completed_count for r in rows),
+        )
+    )
+    StatsCounter.objects.bulk_create(rows, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0004_overlay_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatsCounter',
+            fields=[
+                ('key', models.CharField(help_text='global 或 batch:<id>', max_length=64, primary_key=True, serialize=False, verbose_name='统计范围')),
+                ('inspection_count', models.IntegerField(default=0, verbose_name='巡检次数')),
+                ('defect_count', models.IntegerField(default=0, verbose_name='病害数')),
+                ('completed_count', models.IntegerField(default=0, verbose_name='已修复数')),
+            ],
+            options={
+                'verbose_name': '统计计数器',
+                'verbose_name_plural': '统计计数器',
+                'db_table': 'stats_counter',
+            },
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.2.1 on 2026-10-16 23:46
+
+from django.db import migrations, models
+from django.db.models import Count, F
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+
+
+def backfill_rollup(apps, schema_editor):
+    DefectTrack = apps.get_model("web", "DefectTrack")
+    DiseaseDailyRollup = apps.get_model("web", "DiseaseDailyRollup")
+    groups = (
+        DefectTrack.objects.annotate(day=TruncDate("batch__start_time"))
+        .values(
+            "day",
+            "disease_type_id",
+            "severity_id",
+            airport=F("batch__airport"),
+            drone_id=F("batch__drone_id"),
+        )
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    DiseaseDailyRollup.objects.bulk_create(
+        [DiseaseDailyRollup(**group) for group in groups], batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0005_stats_counter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiseaseDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='日期')),
+                ('airport', models.CharField(max_length=32, verbose_name='起降机场')),
+                ('drone_id', models.CharField(max_length=32, verbose_name='无人机编号')),
+                ('count', models.IntegerField(default=0, verbose_name='病害数')),
+                ('disease_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='web.diseasetype', verbose_name='病害类型')),
+                ('severity', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='web.severitylevel', verbose_name='严重程度')),
+            ],
+            options={
+                'verbose_name': '病害日汇总',
+                'verbose_name_plural': '病害日汇总',
+                'db_table': 'disease_daily_rollup',
+                'indexes': [models.Index(fields=['airport', 'day'], name='rollup_airport_day_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='diseasedailyrollup',
+            constraint=models.UniqueConstraint(fields=('day', 'airport', 'drone_id', 'disease_type', 'severity'), name='disease_rollup_key'),
+        ),
+        migrations.RunPython(backfill_rollup, migrations.RunPython.noop),
+    ]
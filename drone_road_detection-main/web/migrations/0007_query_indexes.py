@@ -0,0 +1,43 @@
+# Generated by Django 4.2.1 on 2026-10-16 23:49
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def fill_frame_batch(apps, schema_editor):
+    DefectTrack = apps.get_model("web", "DefectTrack")
+    GroundTruthFrame = apps.get_model("web", "GroundTruthFrame")
+    GroundTruthFrame.objects.update(
+        batch_id=Subquery(
+            DefectTrack.objects.filter(pk=OuterRef("track_id")).values("batch_id")[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0006_disease_daily_rollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groundtruthframe',
+            name='batch',
+            field=models.ForeignKey(db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='frames', to='web.detectionbatch', verbose_name='检测批次'),
+        ),
+        migrations.RunPython(fill_frame_batch, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='defecttrack',
+            index=models.Index(fields=['batch', 'develop_trend'], name='track_batch_trend_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='detectionbatch',
+            index=models.Index(fields=['-start_time'], name='batch_start_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='groundtruthframe',
+            index=models.Index(fields=['batch', 'frame_index', 'track'], name='gtf_batch_frame_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.1 on 2026-10-17 00:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0007_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PackedTrackFrames',
+            fields=[
+                ('track', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='packed_frames', serialize=False, to='web.defecttrack', verbose_name='缺陷轨迹')),
+                ('frame_count', models.PositiveIntegerField(verbose_name='帧数')),
+                ('data', models.BinaryField(verbose_name='打包帧数据')),
+            ],
+            options={
+                'verbose_name': '打包帧标注',
+                'verbose_name_plural': '打包帧标注',
+                'db_table': 'packed_track_frames',
+            },
+        ),
+    ]
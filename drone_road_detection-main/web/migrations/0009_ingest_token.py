@@ -0,0 +1,38 @@
+# Generated by Django 4.2.1 on 2026-10-17 00:12
+
+from django.db import migrations, models
+import web.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0008_packed_track_frames'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, verbose_name='名称')),
+                ('key', models.CharField(default=web.models._ingest_key, max_length=40, unique=True, verbose_name='令牌')),
+                ('drone_id', models.CharField(blank=True, help_text='留空表示可上传任意无人机的批次', max_length=32, verbose_name='无人机编号')),
+                ('is_active', models.BooleanField(default=True, verbose_name='启用')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+            ],
+            options={
+                'verbose_name': '上传令牌',
+                'verbose_name_plural': '上传令牌',
+                'db_table': 'ingest_token',
+            },
+        ),
+        migrations.RemoveIndex(
+            model_name='groundtruthframe',
+            name='gtf_track_frame_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='groundtruthframe',
+            constraint=models.UniqueConstraint(fields=('track', 'frame_index'), name='gtf_track_frame_uniq'),
+        ),
+    ]
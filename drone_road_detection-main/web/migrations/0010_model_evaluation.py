@@ -0,0 +1,65 @@
+# Generated by Django 4.2.1 on 2026-10-17 00:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0009_ingest_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ModelEvaluation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_name', models.CharField(max_length=64, verbose_name='模型名称')),
+                ('gt_count', models.PositiveIntegerField(verbose_name='标注框数')),
+                ('prediction_count', models.PositiveIntegerField(verbose_name='预测框数')),
+                ('precision', models.FloatField(help_text='IoU 阈值 0.5', verbose_name='精确率')),
+                ('recall', models.FloatField(help_text='IoU 阈值 0.5', verbose_name='召回率')),
+                ('map', models.FloatField(verbose_name='mAP@[.5:.95]')),
+                ('map50', models.FloatField(verbose_name='mAP@.5')),
+                ('mota', models.FloatField(verbose_name='MOTA')),
+                ('motp', models.FloatField(help_text='匹配框的平均 IoU', verbose_name='MOTP')),
+                ('idf1', models.FloatField(verbose_name='IDF1')),
+                ('id_switches', models.PositiveIntegerField(verbose_name='ID 切换次数')),
+                ('per_class', models.JSONField(default=dict, help_text='病害类型名称到 precision/recall/ap 等指标', verbose_name='分类指标')),
+                ('elapsed', models.FloatField(verbose_name='评估耗时(秒)')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='评估时间')),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='evaluations', to='web.detectionbatch', verbose_name='检测批次')),
+                ('report', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='evaluation', to='web.report', verbose_name='评估报表')),
+            ],
+            options={
+                'verbose_name': '模型评估',
+                'verbose_name_plural': '模型评估',
+                'db_table': 'model_evaluation',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PredictionFrame',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_name', models.CharField(max_length=64, verbose_name='模型名称')),
+                ('track', models.IntegerField(help_text='同一模型、批次内的跟踪编号', verbose_name='预测轨迹编号')),
+                ('score', models.FloatField(default=1.0, verbose_name='置信度')),
+                ('frame_index', models.PositiveIntegerField(verbose_name='帧序号')),
+                ('time', models.FloatField(blank=True, null=True, verbose_name='时间(秒)')),
+                ('bbox_x', models.FloatField(help_text='归一化坐标0-1', verbose_name='框左上角X')),
+                ('bbox_y', models.FloatField(help_text='归一化坐标0-1', verbose_name='框左上角Y')),
+                ('bbox_width', models.FloatField(help_text='归一化比例0-1', verbose_name='框宽度')),
+                ('bbox_height', models.FloatField(help_text='归一化比例0-1', verbose_name='框高度')),
+                ('batch', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='predictions', to='web.detectionbatch', verbose_name='检测批次')),
+                ('disease_type', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='web.diseasetype', verbose_name='病害类型')),
+            ],
+            options={
+                'verbose_name': '预测帧',
+                'verbose_name_plural': '预测帧',
+                'db_table': 'prediction_frame',
+                'indexes': [models.Index(fields=['batch', 'model_name', 'frame_index'], name='pred_batch_model_frame_idx')],
+            },
+        ),
+    ]
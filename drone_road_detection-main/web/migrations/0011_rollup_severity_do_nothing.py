@@ -0,0 +1,19 @@
+# Generated by Django 4.2.1 on 2026-10-17 00:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0010_model_evaluation'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='diseasedailyrollup',
+            name='severity',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='web.severitylevel', verbose_name='严重程度'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.1 on 2026-10-17 01:18
+
+from django.db import migrations, models
+
+from web.trackdata import PACKED_CHUNK_SIZE, frame_range
+
+
+def backfill_frame_range(apps, schema_editor):
+    PackedTrackFrames = apps.get_model("web", "PackedTrackFrames")
+    packed = PackedTrackFrames.objects.values_list("pk", "data").iterator(
+        chunk_size=PACKED_CHUNK_SIZE
+    )
+    for pk, data in packed:
+        span = frame_range(data)
+        if span is not None:
+            PackedTrackFrames.objects.filter(pk=pk).update(
+                first_frame=span[0], last_frame=span[1]
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('web', '0011_rollup_severity_do_nothing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='packedtrackframes',
+            name='first_frame',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='首帧'),
+        ),
+        migrations.AddField(
+            model_name='packedtrackframes',
+            name='last_frame',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='末帧'),
+        ),
+        migrations.RunPython(backfill_frame_range, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,5 @@
+import secrets
+
 from django.db import models
 
 class DiseaseType(models.Model):
@@ -85,9 +87,31 @@ class DetectionBatch(models.Model):
         verbose_name = "检测批次"
         verbose_name_plural = "检测批次"
         ordering = ["-start_time"]
+        indexes = [
+            models.Index(fields=["-start_time"], name="batch_start_time_idx"),
+        ]
     def __str__(self):
         return f"{self.airport}-{self.start_time:%Y%m%d%H%M}"
 
+def _ingest_key():
+    return secrets.token_hex(20)
+
+class IngestToken(models.Model):
+    """检测结果上传令牌，供无人机端调用 /api/ingest/ 接口"""
+    name = models.CharField("名称", max_length=64)
+    key = models.CharField("令牌", max_length=40, unique=True, default=_ingest_key)
+    drone_id = models.CharField(
+        "无人机编号", max_length=32, blank=True, help_text="留空表示可上传任意无人机的批次"
+    )
+    is_active = models.BooleanField("启用", default=True)
+    created_at = models.DateTimeField("创建时间", auto_now_add=True)
+    class Meta:
+        db_table = "ingest_token"
+        verbose_name = "上传令牌"
+        verbose_name_plural = "上传令牌"
+    def __str__(self):
+        return self.name
+
 class Report(models.Model):
     """病害检测报表"""
     batch = models.ForeignKey(DetectionBatch, on_delete=models.CASCADE, verbose_name="检测批次")
@@ -129,9 +153,34 @@ class DefectTrack(models.Model):
         db_table = "defect_track"
         verbose_name = "缺陷轨迹"
         verbose_name_plural = "缺陷轨迹"
+        indexes = [
+            # 批次内按修复状态统计
+            models.Index(fields=["batch", "develop_trend"], name="track_batch_trend_idx"),
+        ]
     def __str__(self):
         return self.unique_code
 
+class PackedTrackFrames(models.Model):
+    """按轨迹打包存储的帧标注，格式见 web.trackdata"""
+    track = models.OneToOneField(
+        DefectTrack,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="packed_frames",
+        verbose_name="缺陷轨迹",
+    )
+    frame_count = models.PositiveIntegerField("帧数")
+    # 首末帧与 BLOB 头部一致，按帧窗口筛选轨迹时无需读取 BLOB；空轨迹为空值
+    first_frame = models.PositiveIntegerField("首帧", null=True, blank=True)
+    last_frame = models.PositiveIntegerField("末帧", null=True, blank=True)
+    data = models.BinaryField("打包帧数据")
+    class Meta:
+        db_table = "packed_track_frames"
+        verbose_name = "打包帧标注"
+        verbose_name_plural = "打包帧标注"
+    def __str__(self):
+        return f"{self.track} ({self.frame_count} 帧)"
+
 class DiseaseMedia(models.Model):
     """病害相关媒体（截图、视频、报告附件等）"""
     defect_track = models.ForeignKey(DefectTrack, on_delete=models.CASCADE, related_name="media", verbose_name="病害轨迹")
@@ -153,6 +202,16 @@ class GroundTruthFrame(models.Model):
         related_name="frames",
         verbose_name="缺陷轨迹",
     )
+    # 冗余自 track.batch，使按批次、帧序号的查询可直接走索引
+    batch = models.ForeignKey(
+        DetectionBatch,
+        on_delete=models.CASCADE,
+        related_name="frames",
+        null=True,
+        editable=False,
+        db_index=False,  # 由 gtf_batch_frame_idx 覆盖
+        verbose_name="检测批次",
+    )
     frame_index = models.PositiveIntegerField("帧序号")
     time = models.FloatField("时间(秒)", null=True, blank=True)
     bbox_x = models.FloatField("框左上角X", help_text="归一化坐标0-1")
@@ -164,5 +223,158 @@ class GroundTruthFrame(models.Model):
         verbose_name = "缺陷帧标注"
         verbose_name_plural = "缺陷帧标注"
         ordering = ["frame_index"]
+        constraints = [
+            # 单条轨迹按帧序号读取；同一轨迹每帧只有一个框，重复上传时据此去重
+            models.UniqueConstraint(fields=["track", "frame_index"], name="gtf_track_frame_uniq"),
+        ]
+        indexes = [
+            # 按批次、帧序号顺序（及时间窗口）读取标注框，无需临时排序
+            models.Index(fields=["batch", "frame_index", "track"], name="gtf_batch_frame_idx"),
+        ]
     def __str__(self):
         return f"{self.track}-{self.frame_index}"
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 记住读取时的批次，保存时无需再查询一次旧批次
+        if "batch_id" in instance.__dict__:
+            instance._loaded_batch_id = instance.batch_id
+        return instance
+    def save(self, *args, **kwargs):
+        # batch 始终随所属轨迹，帧改挂到其他批次的轨迹时一并更新
+        if self.track_id is not None:
+            self.batch_id = self.track.batch_id
+        super().save(*args, **kwargs)
+
+class PredictionFrame(models.Model):
+    """检测模型在某一视频帧上的预测框，与缺陷帧标注对齐，用于评估模型"""
+    batch = models.ForeignKey(
+        DetectionBatch,
+        on_delete=models.CASCADE,
+        related_name="predictions",
+        db_index=False,  # 由 pred_batch_model_frame_idx 覆盖
+        verbose_name="检测批次",
+    )
+    model_name = models.CharField("模型名称", max_length=64)
+    track = models.IntegerField("预测轨迹编号", help_text="同一模型、批次内的跟踪编号")
+    disease_type = models.ForeignKey(
+        DiseaseType, on_delete=models.PROTECT, verbose_name="病害类型"
+    )
+    score = models.FloatField("置信度", default=1.0)
+    frame_index = models.PositiveIntegerField("帧序号")
+    time = models.FloatField("时间(秒)", null=True, blank=True)
+    bbox_x = models.FloatField("框左上角X", help_text="归一化坐标0-1")
+    bbox_y = models.FloatField("框左上角Y", help_text="归一化坐标0-1")
+    bbox_width = models.FloatField("框宽度", help_text="归一化比例0-1")
+    bbox_height = models.FloatField("框高度", help_text="归一化比例0-1")
+    class Meta:
+        db_table = "prediction_frame"
+        verbose_name = "预测帧"
+        verbose_name_plural = "预测帧"
+        indexes = [
+            # 按批次、模型读取全部预测框
+            models.Index(fields=["batch", "model_name", "frame_index"], name="pred_batch_model_frame_idx"),
+        ]
+    def __str__(self):
+        return f"{self.model_name}-{self.track}-{self.frame_index}"
+
+class ModelEvaluation(models.Model):
+    """检测模型在某一批次上的评估结果，随评估报表一同生成"""
+    batch = models.ForeignKey(
+        DetectionBatch, on_delete=models.CASCADE, related_name="evaluations", verbose_name="检测批次"
+    )
+    report = models.OneToOneField(
+        Report, on_delete=models.CASCADE, related_name="evaluation", verbose_name="评估报表"
+    )
+    model_name = models.CharField("模型名称", max_length=64)
+    gt_count = models.PositiveIntegerField("标注框数")
+    prediction_count = models.PositiveIntegerField("预测框数")
+    precision = models.FloatField("精确率", help_text="IoU 阈值 0.5")
+    recall = models.FloatField("召回率", help_text="IoU 阈值 0.5")
+    map = models.FloatField("mAP@[.5:.95]")
+    map50 = models.FloatField("mAP@.5")
+    mota = models.FloatField("MOTA")
+    motp = models.FloatField("MOTP", help_text="匹配框的平均 IoU")
+    idf1 = models.FloatField("IDF1")
+    id_switches = models.PositiveIntegerField("ID 切换次数")
+    per_class = models.JSONField("分类指标", default=dict, help_text="病害类型名称到 precision/recall/ap 等指标")
+    elapsed = models.FloatField("评估耗时(秒)")
+    created_at = models.DateTimeField("评估时间", auto_now_add=True)
+    class Meta:
+        db_table = "model_evaluation"
+        verbose_name = "模型评估"
+        verbose_name_plural = "模型评估"
+        ordering = ["-created_at"]
+    def __str__(self):
+        return f"{self.batch} - {self.model_name}"
+
+class DataVersion(models.Model):
+    """数据版本号，业务数据写入时递增，用于缓存失效"""
+    scope = models.CharField("范围", max_length=64, unique=True, help_text="如 batch:12")
+    version = models.PositiveBigIntegerField("版本号", default=1)
+    updated_at = models.DateTimeField("更新时间", auto_now=True)
+    class Meta:
+        db_table = "data_version"
+        verbose_name = "数据版本"
+        verbose_name_plural = "数据版本"
+    def __str__(self):
+        return f"{self.scope}@{self.version}"
+
+class OverlayCache(models.Model):
+    """检测批次叠加框数据的物化缓存，按批次和数据版本区分"""
+    batch = models.ForeignKey(
+        DetectionBatch, on_delete=models.CASCADE, related_name="overlay_caches", verbose_name="检测批次"
+    )
+    version = models.PositiveBigIntegerField("数据版本")
+    variant = models.CharField("编码及窗口", max_length=128, help_text="如 json 或 columnar|frame_index__gte=0")
+    content = models.BinaryField("内容")
+    created_at = models.DateTimeField("生成时间", auto_now_add=True)
+    class Meta:
+        db_table = "overlay_cache"
+        verbose_name = "叠加框缓存"
+        verbose_name_plural = "叠加框缓存"
+        constraints = [
+            models.UniqueConstraint(fields=["batch", "version", "variant"], name="overlay_cache_key"),
+        ]
+    def __str__(self):
+        return f"{self.batch_id}@{self.version}:{self.variant}"
+
+class StatsCounter(models.Model):
+    """仪表盘统计计数器，随批次和缺陷轨迹的写入增量维护"""
+    key = models.CharField("统计范围", max_length=64, primary_key=True, help_text="global 或 batch:<id>")
+    inspection_count = models.IntegerField("巡检次数", default=0)
+    defect_count = models.IntegerField("病害数", default=0)
+    completed_count = models.IntegerField("已修复数", default=0)
+    class Meta:
+        db_table = "stats_counter"
+        verbose_name = "统计计数器"
+        verbose_name_plural = "统计计数器"
+    def __str__(self):
+        return self.key
+
+class DiseaseDailyRollup(models.Model):
+    """病害类型按日汇总，按日期、机场、无人机、病害类型和严重程度预聚合"""
+    day = models.DateField("日期")
+    airport = models.CharField("起降机场", max_length=32)
+    drone_id = models.CharField("无人机编号", max_length=32)
+    disease_type = models.ForeignKey(DiseaseType, on_delete=models.CASCADE, verbose_name="病害类型")
+    # 删除严重程度时轨迹置空而非删除，其计数由 signals 并入 severity 为空的行
+    severity = models.ForeignKey(
+        SeverityLevel, on_delete=models.DO_NOTHING, null=True, blank=True, verbose_name="严重程度"
+    )
+    count = models.IntegerField("病害数", default=0)
+    class Meta:
+        db_table = "disease_daily_rollup"
+        verbose_name = "病害日汇总"
+        verbose_name_plural = "病害日汇总"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["day", "airport", "drone_id", "disease_type", "severity"],
+                name="disease_rollup_key",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["airport", "day"], name="rollup_airport_day_idx"),
+        ]
+    def __str__(self):
+        return f"{self.day} {self.airport} {self.disease_type}"
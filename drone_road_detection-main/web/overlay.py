@@ -0,0 +1,442 @@
+"""Helpers that turn frame annotations into ``/api/boxes/`` payloads.
+
+Annotations are read as plain tuples rather than model instances so that
+large batches can be grouped by ``frame_index`` and encoded on the fly.
+
+Two encodings are provided: the original JSON layout and a compact
+columnar binary layout (see :func:`encode_columnar`).  Payloads of finished
+batches are materialised in :class:`~web.models.OverlayCache`, keyed by the
+batch data version so that writes invalidate them (see ``web.signals``).
+Annotations of archived batches come from ``web.archive`` and packed
+tracks from ``web.trackdata`` instead of the ``GroundTruthFrame`` table.
+"""
+
+import json
+import math
+import struct
+
+import numpy as np
+from django.core.serializers.json import DjangoJSONEncoder
+
+from . import archive, trackdata, versions
+from .models import DetectionBatch, DefectTrack, GroundTruthFrame, OverlayCache
+
+# Rows fetched from the database per round-trip when streaming.
+STREAM_CHUNK_SIZE = 2000
+
+# Frames serialised per chunk handed to the streaming response.
+STREAM_FRAMES_PER_CHUNK = 200
+
+# Only batches in this status get a materialised overlay.
+CACHEABLE_STATUS = "done"
+
+COLUMNAR_CONTENT_TYPE = "application/x-boxes-columnar"
+COLUMNAR_MAGIC = b"BOXC"
+COLUMNAR_VERSION = 1
+
+FRAME_FIELDS = (
+    "frame_index",
+    "time",
+    "track_id",
+    "bbox_x",
+    "bbox_y",
+    "bbox_width",
+    "bbox_height",
+)
+
+
+def batch_fps(batch_id):
+    """Return the frame rate of ``batch_id`` or ``None`` if it is unknown."""
+    row = (
+        DetectionBatch.objects.filter(pk=batch_id)
+        .values_list("total_frames", "video_duration")
+        .first()
+    )
+    if not row or not row[0] or not row[1]:
+        return None
+    return row[0] / row[1]
+
+
+def resolve_window(batch_id, from_frame=None, to_frame=None, t0=None, t1=None):
+    """Translate a frame or time window into ``GroundTruthFrame`` lookups.
+
+    ``from_frame``/``to_frame`` are inclusive frame bounds.  ``t0``/``t1``
+    select the half-open time range ``[t0, t1)``; when the batch frame rate
+    is known they are converted to frame bounds so the query can use the
+    ``(batch, frame_index, track)`` index, otherwise ``time`` is filtered
+    directly.  Times must be finite.  Returns ``None`` when no bound was
+    given.
+    """
+    if t0 is not None or t1 is not None:
+        fps = batch_fps(batch_id) if batch_id else None
+        if fps is None:
+            lookups = {}
+            if t0 is not None:
+                lookups["time__gte"] = t0
+            if t1 is not None:
+                lookups["time__lt"] = t1
+            return lookups
+        # Tolerate float noise such as 0.1 * 30 == 3.0000000000000004.
+        if t0 is not None:
+            from_frame = max(from_frame or 0, math.ceil(t0 * fps - 1e-6))
+        if t1 is not None:
+            last = math.ceil(t1 * fps - 1e-6) - 1
+            to_frame = last if to_frame is None else min(to_frame, last)
+    # Bounds past the stored frame range select the same frames as the
+    # nearest representable one.
+    lookups = {}
+    if from_frame is not None:
+        lookups["frame_index__gte"] = min(max(0, from_frame), trackdata.MAX_FRAME_INDEX + 1)
+    if to_frame is not None:
+        lookups["frame_index__lte"] = min(max(-1, to_frame), trackdata.MAX_FRAME_INDEX)
+    return lookups or None
+
+
+def _array_source(batch_id):
+    """Return the module serving a batch's annotations outside the
+    ``GroundTruthFrame`` table, or ``None`` for plain row storage."""
+    if archive.is_archived(batch_id):
+        return archive
+    if trackdata.has_packed(batch_id):
+        return trackdata
+    return None
+
+
+def batch_columns(batch_id):
+    """Return :class:`trackdata.BatchColumns` of every box of a batch,
+    whatever its storage mode, sorted by ``(frame_index, track_id)``."""
+    if archive.is_archived(batch_id):
+        return archive.load(batch_id)
+    return trackdata.batch_columns(batch_id)
+
+
+def frame_queryset(batch_id=None, window=None):
+    """Return annotations for ``batch_id`` ordered for grouping by frame.
+
+    ``window`` is a lookup dict as returned by :func:`resolve_window`.
+    """
+    qs = GroundTruthFrame.objects.all()
+    if batch_id:
+        qs = qs.filter(batch_id=batch_id)
+    if window:
+        qs = qs.filter(**window)
+    return qs.order_by("frame_index", "track_id")
+
+
+def track_info(batch_id=None, window=None):
+    """Map track id to ``(label, start_frame, end_frame)``.
+
+    Batches served from arrays map every track of the batch rather than
+    decoding their boxes a second time to find those inside ``window``.
+    """
+    qs = DefectTrack.objects.all()
+    if batch_id:
+        qs = qs.filter(batch_id=batch_id)
+    if window and _array_source(batch_id) is None:
+        qs = qs.filter(
+            id__in=frame_queryset(batch_id, window).order_by().values("track_id")
+        )
+    return {
+        pk: (label, start, end)
+        for pk, label, start, end in qs.values_list(
+            "id", "disease_type__name", "start_frame", "end_frame"
+        ).iterator(chunk_size=STREAM_CHUNK_SIZE)
+    }
+
+
+def batch_video(batch_id):
+    """Return the video link stored on ``batch_id``."""
+    link = (
+        DetectionBatch.objects.filter(pk=batch_id)
+        .values_list("video_link", flat=True)
+        .first()
+    )
+    return link or ""
+
+
+def video_link(batch_id=None):
+    """Return the video of the batch owning the first annotated frame."""
+    source = _array_source(batch_id)
+    if source is not None:
+        return batch_video(batch_id) if source.has_frames(batch_id) else ""
+    link = (
+        frame_queryset(batch_id)
+        .values_list("batch__video_link", flat=True)
+        .first()
+    )
+    return link or ""
+
+
+def payload_video(batch_id=None, window=None, has_frames=True):
+    """Return the ``video`` value of a boxes payload.
+
+    Windowed requests always carry the batch video so the player can start
+    before any window containing annotations has been fetched.
+    """
+    if window and batch_id:
+        return batch_video(batch_id)
+    return video_link(batch_id) if has_frames else ""
+
+
+def iter_frame_rows(batch_id=None, window=None):
+    """Yield annotation tuples in :data:`FRAME_FIELDS` order.
+
+    Archived batches are read from their cold-storage file and batches
+    with packed tracks are merged from both storage modes.
+    """
+    source = _array_source(batch_id)
+    if source is not None:
+        return source.iter_rows(batch_id, window)
+    return (
+        frame_queryset(batch_id, window)
+        .values_list(*FRAME_FIELDS)
+        .iterator(chunk_size=STREAM_CHUNK_SIZE)
+    )
+
+
+def group_frames(rows, tracks):
+    """Group ordered annotation rows into the ``frames`` entries of the API.
+
+    Only the boxes of the frame currently being assembled are held in
+    memory, so the input may be an arbitrarily long iterator.
+    """
+    current = None
+    for frame_index, time, track_id, x, y, w, h in rows:
+        if current is None or current["frame"] != frame_index:
+            if current is not None:
+                yield current
+            current = {"frame": frame_index, "time": time, "boxes": []}
+        label, start, end = tracks[track_id]
+        current["boxes"].append(
+            {
+                "track": track_id,
+                "x": x,
+                "y": y,
+                "w": w,
+                "h": h,
+                "label": label,
+                "start": start,
+                "end": end,
+            }
+        )
+    if current is not None:
+        yield current
+
+
+def build_frames(batch_id=None, window=None):
+    """Return the complete ``frames`` list for ``batch_id``."""
+    return list(
+        group_frames(
+            iter_frame_rows(batch_id, window), track_info(batch_id, window)
+        )
+    )
+
+
+def _dumps(value):
+    return json.dumps(value, cls=DjangoJSONEncoder)
+
+
+def iter_json(video, frames):
+    """Serialise a boxes payload incrementally.
+
+    The concatenated output is identical to what :class:`JsonResponse`
+    produces for ``{"video": video, "frames": list(frames)}``.
+    """
+    yield '{"video": %s, "frames": [' % _dumps(video)
+    parts = []
+    first = True
+    for frame in frames:
+        parts.append(_dumps(frame) if first else ", " + _dumps(frame))
+        first = False
+        if len(parts) >= STREAM_FRAMES_PER_CHUNK:
+            yield "".join(parts)
+            parts = []
+    parts.append("]}")
+    yield "".join(parts)
+
+
+def stream_json(batch_id=None, window=None):
+    """Stream the JSON boxes payload for ``batch_id`` chunk by chunk."""
+    frames = group_frames(
+        iter_frame_rows(batch_id, window), track_info(batch_id, window)
+    )
+    return iter_json(payload_video(batch_id, window), frames)
+
+
+_COLUMNAR_ROW = np.dtype(
+    [("frame", "<u4"), ("time", "<f8"), ("track", "<i8"), ("bbox", "<f4", (4,))]
+)
+
+
+def encode_columnar(video, rows, tracks):
+    """Encode annotation rows as a struct-of-arrays binary payload.
+
+    Layout (little endian, every array aligned to its element size)::
+
+        magic "BOXC" | uint8 version | 3 pad bytes | uint32 header length
+        header JSON {"video", "labels", "tracks": [[id, label, start, end]]}
+        zero padding to a multiple of 8 bytes
+        uint32 frame count F | uint32 box count B
+        float64 time[F]          (NaN when the frame has no time)
+        uint32  frame_index[F]
+        uint32  box_offset[F + 1] (boxes of frame i are offset[i]:offset[i+1])
+        uint32  box_track[B]      (index into header "tracks")
+        float32 bbox[B * 4]       (x, y, w, h)
+
+    ``rows`` must be ordered by frame as yielded by :func:`iter_frame_rows`.
+    """
+    data = np.fromiter(
+        (
+            (frame, math.nan if time is None else time, track, (x, y, w, h))
+            for frame, time, track, x, y, w, h in rows
+        ),
+        dtype=_COLUMNAR_ROW,
+    )
+    frames, starts = np.unique(data["frame"], return_index=True)
+    offsets = np.append(starts, len(data)).astype("<u4")
+    track_ids = np.unique(data["track"])
+    labels = []
+    header_tracks = []
+    for pk in track_ids.tolist():
+        label, start, end = tracks[pk]
+        if label not in labels:
+            labels.append(label)
+        header_tracks.append([pk, labels.index(label), start, end])
+    header = json.dumps(
+        {"video": video, "labels": labels, "tracks": header_tracks},
+        ensure_ascii=False,
+    ).encode("utf-8")
+    padding = b"\0" * (-(12 + len(header)) % 8)
+    return b"".join(
+        [
+            COLUMNAR_MAGIC,
+            struct.pack("<B3xI", COLUMNAR_VERSION, len(header)),
+            header,
+            padding,
+            struct.pack("<II", len(frames), len(data)),
+            data["time"][starts].tobytes(),
+            frames.astype("<u4").tobytes(),
+            offsets.tobytes(),
+            np.searchsorted(track_ids, data["track"]).astype("<u4").tobytes(),
+            data["bbox"].tobytes(),
+        ]
+    )
+
+
+def build_columnar(batch_id=None, window=None):
+    """Return the columnar boxes payload for ``batch_id``."""
+    rows = list(iter_frame_rows(batch_id, window))
+    video = payload_video(batch_id, window, has_frames=bool(rows))
+    return encode_columnar(video, rows, track_info(batch_id, window))
+
+
+def decode_columnar(payload):
+    """Decode :func:`encode_columnar` output back into the JSON layout."""
+    if payload[:4] != COLUMNAR_MAGIC:
+        raise ValueError("not a columnar boxes payload")
+    version, header_len = struct.unpack_from("<B3xI", payload, 4)
+    if version != COLUMNAR_VERSION:
+        raise ValueError("unsupported columnar version %s" % version)
+    header = json.loads(payload[12:12 + header_len].decode("utf-8"))
+    offset = 12 + header_len
+    offset += -offset % 8
+    frame_count, box_count = struct.unpack_from("<II", payload, offset)
+    offset += 8
+
+    def take(dtype, count):
+        nonlocal offset
+        arr = np.frombuffer(payload, dtype=dtype, count=count, offset=offset)
+        offset += arr.nbytes
+        return arr
+
+    times = take("<f8", frame_count)
+    frames = take("<u4", frame_count)
+    box_offsets = take("<u4", frame_count + 1)
+    box_tracks = take("<u4", box_count)
+    bboxes = take("<f4", box_count * 4).reshape(-1, 4)
+
+    tracks = header["tracks"]
+    labels = header["labels"]
+    result = []
+    for i in range(frame_count):
+        boxes = []
+        for j in range(box_offsets[i], box_offsets[i + 1]):
+            pk, label, start, end = tracks[box_tracks[j]]
+            x, y, w, h = bboxes[j].tolist()
+            boxes.append(
+                {
+                    "track": pk,
+                    "x": x,
+                    "y": y,
+                    "w": w,
+                    "h": h,
+                    "label": labels[label],
+                    "start": start,
+                    "end": end,
+                }
+            )
+        time = float(times[i])
+        result.append(
+            {
+                "frame": int(frames[i]),
+                "time": None if math.isnan(time) else time,
+                "boxes": boxes,
+            }
+        )
+    return {"video": header["video"], "frames": result}
+
+
+def build_payload(batch_id, encoding="json", window=None):
+    """Return the encoded boxes payload for ``batch_id`` as bytes."""
+    if encoding == "columnar":
+        return build_columnar(batch_id, window)
+    return "".join(stream_json(batch_id, window)).encode("utf-8")
+
+
+def cache_variant(encoding, window=None):
+    """Return the :class:`OverlayCache` variant key of a request."""
+    parts = [encoding]
+    parts.extend(f"{key}={value}" for key, value in sorted((window or {}).items()))
+    return "|".join(parts)
+
+
+def cached_payload(batch_id, encoding="json", window=None):
+    """Return the materialised overlay of a batch as bytes.
+
+    The artifact is built on first request and stored under the current
+    data version of the batch.  Returns ``None`` for windowed requests and
+    for batches that are not finished, which are always computed live:
+    only the full-batch variants are stored, so the number of rows per
+    batch stays fixed whatever windows clients ask for.
+    """
+    if window:
+        return None
+    status = (
+        DetectionBatch.objects.filter(pk=batch_id)
+        .values_list("status", flat=True)
+        .first()
+    )
+    if status != CACHEABLE_STATUS:
+        return None
+    version = versions.current(versions.batch_scope(batch_id))
+    variant = cache_variant(encoding, window)
+    content = (
+        OverlayCache.objects.filter(batch_id=batch_id, version=version, variant=variant)
+        .values_list("content", flat=True)
+        .first()
+    )
+    if content is None:
+        content = build_payload(batch_id, encoding, window)
+        OverlayCache.objects.get_or_create(
+            batch_id=batch_id,
+            version=version,
+            variant=variant,
+            defaults={"content": content},
+        )
+    return bytes(content)
+
+
+def build_overlay(batch_id):
+    """Materialise the full overlay of ``batch_id`` in every encoding."""
+    for encoding in ("json", "columnar"):
+        cached_payload(batch_id, encoding)
@@ -0,0 +1,307 @@
+"""Video ingestion: from a flight video to ``DefectTrack`` rows.
+
+:func:`ingest_video` streams the frames of a batch's video with
+``imageio``, runs a detector from ``web.detectors`` on them in a process
+pool, links the detections into tracks with :class:`IouTracker` and
+stores the tracks through ``web.ingest`` as they are confirmed, so
+memory does not grow with the length of the video.  The batch is
+``processing`` while this runs and ``done`` (or ``failed``) afterwards.
+
+:func:`extract_snapshots` is the snapshot stage run after it (or on any
+batch with labelled boxes): it picks the best box of every track, crops
+it out of the video with a margin and replaces the track's image media
+with that one bounded-size crop.
+"""
+
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import imageio
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+
+from . import detectors, ingest, matching, overlay, signals
+from .evaluation import greedy_match
+from .models import DefectTrack, DiseaseMedia, MediaType
+from .purge import chunks, delete_rows, media_path, remove_files_on_commit, unreferenced
+from .snapshots import (
+    SNAPSHOT_DIR,
+    SNAPSHOT_MARGIN,
+    SNAPSHOT_SIZE,
+    SnapshotStore,
+    best_boxes,
+    crop,
+    worker_context,
+)
+
+DEFAULT_DETECTOR = "web.detectors.ContrastDetector"
+
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+
+
+def detector_path():
+    """Dotted path of the configured detector class."""
+    return getattr(settings, "VIDEO_DETECTOR", DEFAULT_DETECTOR)
+
+
+def video_path(batch):
+    """Return the local file of a batch's ``video_link``, or ``None``."""
+    path = media_path(batch.video_link)
+    return path if path is not None and path.is_file() else None
+
+
+def read_frames(path):
+    """Return ``(fps, frames)`` where ``frames`` yields ``(frame_index, rgb)``
+    while the video is decoded."""
+    reader = imageio.get_reader(str(path), "ffmpeg")
+    fps = reader.get_meta_data().get("fps") or None
+
+    def frames():
+        with reader:
+            yield from enumerate(reader)
+
+    return fps, frames()
+
+
+def detect_frames(frames, detector=None, options=None, workers=None):
+    """Yield ``(frame_index, Detections)`` in frame order, with up to two
+    frames per worker in flight (inline with ``workers=0``)."""
+    path = detector or detector_path()
+    options = options or {}
+    workers = os.cpu_count() if workers is None else workers
+    if not workers:
+        instance = detectors.load_detector(path, **options)
+        for frame_index, frame in frames:
+            yield frame_index, instance.detect(frame)
+        return
+    with ProcessPoolExecutor(
+        workers,
+        mp_context=worker_context(),
+        initializer=detectors.init_worker,
+        initargs=(path, options),
+    ) as executor:
+        pending = deque()
+        for frame_index, frame in frames:
+            pending.append(executor.submit(detectors.detect_in_worker, frame_index, frame))
+            if len(pending) > 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class IouTracker:
+    """Link per-frame detections into tracks.
+
+    Each track predicts its next box by constant velocity; detections of
+    the same label are assigned to the predictions greedily by IoU (at
+    least ``min_iou``).  A track is confirmed after ``min_hits``
+    detections and dropped after ``max_age`` frames without one;
+    unconfirmed tracks are discarded.  :meth:`update` returns the rows of
+    confirmed tracks as ``(track, frame, time, bbox, label, severity)``.
+    """
+
+    def __init__(self, min_iou=0.2, max_age=5, min_hits=3):
+        self.min_iou = min_iou
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.confirmed = 0
+        self._box = np.empty((0, 4))
+        self._velocity = np.empty((0, 4))
+        self._last = np.empty(0, np.int64)
+        self._hits = np.empty(0, np.int64)
+        self._labels = []
+        self._ids = []  # confirmed id, or None
+        self._pending = []  # rows buffered until confirmation
+
+    def _row(self, k, frame_index, time, box):
+        return (str(self._ids[k]), frame_index, time, box.tolist(), self._labels[k], None)
+
+    def update(self, frame_index, detections, time=None):
+        boxes = np.asarray(detections.boxes, np.float64).reshape(-1, 4)
+        labels = list(detections.labels)
+        predicted = self._box + self._velocity * (frame_index - self._last)[:, None]
+        iou = matching.pairwise_iou(predicted, boxes)
+        same = np.array(self._labels, object)[:, None] == np.array(labels, object)[None, :]
+        tracks, dets = np.nonzero((iou >= self.min_iou) & same)
+        order = np.argsort(-iou[tracks, dets], kind="stable")
+        owner = greedy_match(tracks[order], dets[order], len(self._labels), len(labels))
+
+        rows = []
+        for d in np.flatnonzero(owner >= 0).tolist():
+            k = int(owner[d])
+            self._velocity[k] = (boxes[d] - self._box[k]) / max(frame_index - self._last[k], 1)
+            self._box[k] = boxes[d]
+            self._last[k] = frame_index
+            self._hits[k] += 1
+            if self._ids[k] is None:
+                self._pending[k].append((frame_index, time, boxes[d]))
+            else:
+                rows.append(self._row(k, frame_index, time, boxes[d]))
+
+        new = np.flatnonzero(owner < 0)
+        keep = np.flatnonzero(frame_index - self._last <= self.max_age).tolist()
+        self._box = np.concatenate([self._box[keep], boxes[new]])
+        self._velocity = np.concatenate([self._velocity[keep], np.zeros((len(new), 4))])
+        self._last = np.concatenate([self._last[keep], np.full(len(new), frame_index)])
+        self._hits = np.concatenate([self._hits[keep], np.ones(len(new), np.int64)])
+        self._labels = [self._labels[k] for k in keep] + [labels[d] for d in new.tolist()]
+        self._ids = [self._ids[k] for k in keep] + [None] * len(new)
+        self._pending = [self._pending[k] for k in keep] + [
+            [(frame_index, time, boxes[d])] for d in new.tolist()
+        ]
+
+        for k in np.flatnonzero(self._hits >= self.min_hits).tolist():
+            if self._ids[k] is None:
+                self.confirmed += 1
+                self._ids[k] = self.confirmed
+                rows.extend(self._row(k, *row) for row in self._pending[k])
+                self._pending[k] = None
+        return rows
+
+
+def _set_status(batch, status, **fields):
+    batch.status = status
+    for name, value in fields.items():
+        setattr(batch, name, value)
+    batch.save(update_fields=["status", *fields])
+
+
+def ingest_video(batch, path=None, detector=None, options=None, workers=None,
+                 chunk_size=ingest.DEFAULT_CHUNK_SIZE, tracker=None, progress=None):
+    """Detect and track the defects of ``batch``'s video and store them.
+
+    ``path`` defaults to the file behind ``video_link``.  ``progress(frames,
+    elapsed)`` is called every 100 frames.  Returns a dict with the
+    ``frames`` decoded, ``tracks`` and ``boxes`` stored, ``elapsed``
+    seconds and ``fps``.
+    """
+    path = path or video_path(batch)
+    if path is None:
+        raise ValueError(f"batch {batch.pk} has no local video")
+    tracker = tracker or IouTracker()
+    fps, frames = read_frames(path)
+    count = 0
+    started = time.perf_counter()
+
+    def rows():
+        nonlocal count
+        for frame_index, detections in detect_frames(frames, detector, options, workers):
+            frame_time = round(frame_index / fps, 3) if fps else None
+            yield from tracker.update(frame_index, detections, frame_time)
+            count = frame_index + 1
+            if progress is not None and count % 100 == 0:
+                progress(count, time.perf_counter() - started)
+
+    _set_status(batch, PROCESSING)
+    try:
+        stats = ingest.ingest_rows(batch, rows(), chunk_size)
+    except BaseException:
+        _set_status(batch, FAILED)
+        raise
+    elapsed = time.perf_counter() - started
+    _set_status(
+        batch,
+        DONE,
+        total_frames=count,
+        video_duration=round(count / fps, 3) if fps else batch.video_duration,
+    )
+    return {
+        "frames": count,
+        "tracks": stats["tracks"],
+        "boxes": stats["frames"],
+        "elapsed": elapsed,
+        "fps": count / elapsed if elapsed else 0.0,
+    }
+
+
+def _image_type():
+    return MediaType.objects.get_or_create(code="image", defaults={"name": "图片"})[0]
+
+
+def extract_snapshots(batch, path=None, margin=SNAPSHOT_MARGIN, max_size=SNAPSHOT_SIZE,
+                      workers=None, remove_files=True, chunk_size=ingest.DEFAULT_CHUNK_SIZE):
+    """Store one cropped snapshot per track of ``batch``.
+
+    The best box of each track (see ``snapshots.view_score``) is cut out of
+    the video with ``margin`` and downscaled to ``max_size``; the video is
+    decoded only up to the last frame needed.  The crop becomes the
+    track's ``snapshot_link`` and its only image ``DiseaseMedia``; files
+    of the replaced rows nothing else refers to are deleted on commit
+    unless ``remove_files`` is false.  Returns a dict with the number of
+    ``tracks``, ``files`` and ``bytes`` written, media rows ``replaced``
+    and ``elapsed`` seconds.
+    """
+    path = path or video_path(batch)
+    if path is None:
+        raise ValueError(f"batch {batch.pk} has no local video")
+    started = time.perf_counter()
+    columns = overlay.batch_columns(batch.pk)
+    wanted = {}
+    for i in best_boxes(columns.track_id, columns.bbox).tolist():
+        wanted.setdefault(int(columns.frame_index[i]), []).append(
+            (int(columns.track_id[i]), columns.bbox[i].tolist())
+        )
+    frame_of = {track: frame for frame, views in wanted.items() for track, _ in views}
+
+    with SnapshotStore(
+        Path(settings.MEDIA_ROOT) / SNAPSHOT_DIR,
+        f"{settings.MEDIA_URL}{SNAPSHOT_DIR}/",
+        workers=workers,
+        max_size=max_size,
+    ) as store:
+        _, frames = read_frames(path)
+        try:
+            for frame_index, img in frames:
+                if not wanted:
+                    break
+                for track, bbox in wanted.pop(frame_index, ()):
+                    store.put(track, crop(img, bbox, margin))
+        finally:
+            frames.close()
+
+    tracks = list(store.urls)
+    image = _image_type()
+    with transaction.atomic():
+        old = DiseaseMedia.objects.filter(defect_track_id__in=tracks, media_type=image)
+        pks, links = [], set()
+        for pk, link in old.values_list("pk", "file_link").iterator(chunk_size=chunk_size):
+            pks.append(pk)
+            links.add(link)
+        links.update(
+            DefectTrack.objects.filter(pk__in=tracks).values_list("snapshot_link", flat=True)
+        )
+        for chunk in chunks(pks, chunk_size):
+            delete_rows(DiseaseMedia, chunk)
+        DiseaseMedia.objects.bulk_create(
+            [
+                DiseaseMedia(
+                    defect_track_id=track,
+                    media_type=image,
+                    file_link=store.urls[track],
+                    description=f"第 {frame_of[track]} 帧",
+                )
+                for track in tracks
+            ],
+            batch_size=chunk_size,
+        )
+        DefectTrack.objects.bulk_update(
+            [DefectTrack(pk=track, snapshot_link=store.urls[track]) for track in tracks],
+            ["snapshot_link"],
+            batch_size=chunk_size,
+        )
+        signals.bulk_changed(batch.pk)
+        if remove_files:
+            remove_files_on_commit(unreferenced(links), [])
+    return {
+        "tracks": len(tracks),
+        "files": store.files,
+        "bytes": store.bytes,
+        "replaced": len(pks),
+        "elapsed": time.perf_counter() - started,
+    }
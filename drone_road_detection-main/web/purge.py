@@ -0,0 +1,210 @@
+"""Bulk purge of detection batches and their annotation trees.
+
+Django's cascade collector loads every related row into Python before it
+deletes anything.  :func:`purge_batches` instead selects primary keys a
+chunk at a time and removes them with raw ``DELETE ... WHERE id IN (...)``
+statements in dependency order::
+
+    DiseaseMedia, GroundTruthFrame, PackedTrackFrames -> DefectTrack
+    -> PredictionFrame, ModelEvaluation -> Report, OverlayCache
+    -> DetectionBatch
+
+Each chunk is its own transaction, and the derived tables are adjusted
+in the same transaction as the rows they count. An interrupted purge
+therefore leaves counters and rollups consistent and can simply be rerun.
+Media files are unlinked after commit once no remaining row references
+them, since content-addressed snapshots are shared between batches; the
+archive files of purged batches (see ``web.archive``) go with them.
+"""
+
+from collections import Counter
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import counters, rollups, versions
+from .models import (
+    DataVersion,
+    DefectTrack,
+    DetectionBatch,
+    DiseaseMedia,
+    GroundTruthFrame,
+    ModelEvaluation,
+    OverlayCache,
+    PackedTrackFrames,
+    PredictionFrame,
+    Report,
+    StatsCounter,
+)
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def media_path(link):
+    """Return the file under ``MEDIA_ROOT`` served at ``link``, or ``None``."""
+    if not link or not link.startswith(settings.MEDIA_URL):
+        return None
+    root = Path(settings.MEDIA_ROOT).resolve()
+    path = (root / link[len(settings.MEDIA_URL):]).resolve()
+    return path if path.is_relative_to(root) and path != root else None
+
+
+def chunks(items, size):
+    """Yield successive slices of at most ``size`` items."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def delete_rows(model, pks):
+    """Delete ``pks`` of ``model`` with one raw statement; no signals fire."""
+    if not pks:
+        return 0
+    qn = connection.ops.quote_name
+    placeholders = ", ".join(["%s"] * len(pks))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {qn(model._meta.db_table)} "
+            f"WHERE {qn(model._meta.pk.column)} IN ({placeholders})",
+            list(pks),
+        )
+        return cursor.rowcount
+
+
+def unreferenced(links):
+    """Return the links of ``links`` that no remaining row points at."""
+    links = set(filter(None, links))
+    if not links:
+        return set()
+    used = set(DiseaseMedia.objects.filter(file_link__in=links).values_list("file_link", flat=True))
+    used.update(DefectTrack.objects.filter(snapshot_link__in=links).values_list("snapshot_link", flat=True))
+    used.update(DetectionBatch.objects.filter(video_link__in=links).values_list("video_link", flat=True))
+    return links - used
+
+
+def remove_files_on_commit(links, removed):
+    """Unlink the media files of ``links`` once the transaction commits,
+    appending each removed link to ``removed``."""
+    def remove():
+        for link in links:
+            path = media_path(link)
+            if path is not None and path.is_file():
+                path.unlink()
+                removed.append(link)
+
+    if links:
+        transaction.on_commit(remove)
+
+
+def _remove_archives_on_commit(batch_ids):
+    from . import archive  # archive imports this module
+
+    transaction.on_commit(lambda: archive.remove_archives(batch_ids))
+
+
+class _Purge:
+    def __init__(self, chunk_size, progress, remove_files):
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.remove_files = remove_files
+        self.deleted = Counter()
+        self.removed_files = []
+
+    def _report(self, model, count):
+        table = model._meta.db_table
+        self.deleted[table] += count
+        if self.progress is not None and count:
+            self.progress(table, self.deleted[table])
+
+    def _release(self, links):
+        if self.remove_files:
+            remove_files_on_commit(unreferenced(links), self.removed_files)
+
+    def _delete_chunked(self, model, queryset, fields=("pk",), after=None):
+        """Delete ``queryset`` chunk by chunk; ``after(rows)`` receives the
+        selected ``fields`` of each chunk inside the chunk's transaction."""
+        while True:
+            with transaction.atomic():
+                rows = list(queryset.values_list(*fields)[: self.chunk_size])
+                if not rows:
+                    return
+                self._report(model, delete_rows(model, [row[0] for row in rows]))
+                if after is not None:
+                    after(rows)
+
+    def _forget_tracks(self, batch_keys):
+        def after(rows):
+            defects, completed, groups = Counter(), Counter(), Counter()
+            for _, batch_id, disease_type_id, severity_id, trend, _ in rows:
+                defects[batch_id] += 1
+                completed[batch_id] += trend == counters.COMPLETED_TREND
+                groups[batch_id, disease_type_id, severity_id] += 1
+            for batch_id, count in defects.items():
+                counters.apply_tracks(batch_id, defects=-count, completed=-completed[batch_id])
+            for (batch_id, disease_type_id, severity_id), count in groups.items():
+                rollups.apply(batch_keys.get(batch_id), disease_type_id, severity_id, -count)
+            self._release(row[5] for row in rows)
+
+        return after
+
+    def batches(self, batch_ids):
+        tracks = DefectTrack.objects.filter(batch_id__in=batch_ids)
+        batch_keys = {
+            pk: (timezone.localtime(start).date(), airport, drone_id)
+            for pk, start, airport, drone_id in DetectionBatch.objects.filter(
+                pk__in=batch_ids
+            ).values_list("pk", "start_time", "airport", "drone_id")
+        }
+
+        self._delete_chunked(
+            DiseaseMedia,
+            DiseaseMedia.objects.filter(defect_track__in=tracks),
+            ("pk", "file_link"),
+            lambda rows: self._release(row[1] for row in rows),
+        )
+        self._delete_chunked(GroundTruthFrame, GroundTruthFrame.objects.filter(track__in=tracks))
+        self._delete_chunked(PackedTrackFrames, PackedTrackFrames.objects.filter(track__in=tracks))
+        self._delete_chunked(
+            DefectTrack,
+            tracks,
+            ("pk", "batch_id", "disease_type_id", "severity_id", "develop_trend", "snapshot_link"),
+            self._forget_tracks(batch_keys),
+        )
+        DefectTrack.objects.filter(report__batch_id__in=batch_ids).update(report=None)
+        self._delete_chunked(PredictionFrame, PredictionFrame.objects.filter(batch_id__in=batch_ids))
+        self._delete_chunked(ModelEvaluation, ModelEvaluation.objects.filter(batch_id__in=batch_ids))
+        self._delete_chunked(Report, Report.objects.filter(batch_id__in=batch_ids))
+        self._delete_chunked(OverlayCache, OverlayCache.objects.filter(batch_id__in=batch_ids))
+
+        scopes = [versions.batch_scope(pk) for pk in batch_ids]
+        keys = [counters.batch_key(pk) for pk in batch_ids]
+        with transaction.atomic():
+            rows = list(DetectionBatch.objects.filter(pk__in=batch_ids).values_list("pk", "video_link"))
+            count = delete_rows(DetectionBatch, [pk for pk, _ in rows])
+            counters.apply(counters.GLOBAL_KEY, inspections=-count)
+            delete_rows(StatsCounter, keys)
+            delete_rows(
+                DataVersion,
+                list(DataVersion.objects.filter(scope__in=scopes).values_list("pk", flat=True)),
+            )
+            versions.bump(versions.GLOBAL_SCOPE)
+            self._report(DetectionBatch, count)
+            self._release(link for _, link in rows)
+            _remove_archives_on_commit([pk for pk, _ in rows])
+
+
+def purge_batches(batch_ids=None, chunk_size=DEFAULT_CHUNK_SIZE, progress=None, remove_files=True):
+    """Delete ``batch_ids`` (every batch if ``None``) and their subtrees.
+
+    ``progress(table, deleted_so_far)`` is called after every chunk.
+    Returns ``(deleted, removed_files)``: rows deleted per table and the
+    links of the media files that were unlinked.
+    """
+    qs = DetectionBatch.objects.order_by("pk")
+    if batch_ids is not None:
+        qs = qs.filter(pk__in=list(batch_ids))
+    purge = _Purge(chunk_size, progress, remove_files)
+    for group in chunks(list(qs.values_list("pk", flat=True)), chunk_size):
+        purge.batches(group)
+    return dict(purge.deleted), purge.removed_files
@@ -0,0 +1,120 @@
+"""Daily disease-type rollups behind ``/api/disease_types/``.
+
+Tracks are pre-aggregated per (day, airport, drone_id, disease_type,
+severity) where ``day`` is the local date of the batch take-off.  The
+receivers in ``web.signals`` keep the rollup current; :func:`rebuild`
+backfills it from the source tables.
+"""
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import DefectTrack, DetectionBatch, DiseaseDailyRollup
+
+
+def batch_key(batch_id):
+    """Return ``(day, airport, drone_id)`` of a batch or ``None``."""
+    row = (
+        DetectionBatch.objects.filter(pk=batch_id)
+        .values_list("start_time", "airport", "drone_id")
+        .first()
+    )
+    if row is None:
+        return None
+    start_time, airport, drone_id = row
+    return timezone.localtime(start_time).date(), airport, drone_id
+
+
+def apply(key, disease_type_id, severity_id, delta):
+    """Add ``delta`` tracks to one rollup row, dropping rows that reach 0."""
+    if key is None or not delta:
+        return
+    day, airport, drone_id = key
+    lookup = dict(
+        day=day,
+        airport=airport,
+        drone_id=drone_id,
+        disease_type_id=disease_type_id,
+        severity_id=severity_id,
+    )
+    with transaction.atomic():
+        DiseaseDailyRollup.objects.get_or_create(**lookup)
+        rows = DiseaseDailyRollup.objects.filter(**lookup)
+        rows.update(count=F("count") + delta)
+        rows.filter(count__lte=0).delete()
+
+
+def apply_batch(batch_id, key, sign):
+    """Add (``sign=1``) or remove (``sign=-1``) every track of a batch
+    under ``key``; used when the batch key changes or after bulk writes."""
+    groups = (
+        DefectTrack.objects.filter(batch_id=batch_id)
+        .values("disease_type_id", "severity_id")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    with transaction.atomic():
+        for group in groups:
+            apply(key, group["disease_type_id"], group["severity_id"], sign * group["count"])
+
+
+def fold_severity(severity_id):
+    """Move the counts of a severity level about to be deleted to the
+    ``severity=NULL`` rows, as its tracks' severity is set to NULL."""
+    rows = DiseaseDailyRollup.objects.filter(severity_id=severity_id)
+    with transaction.atomic():
+        for day, airport, drone_id, disease_type_id, count in list(
+            rows.values_list("day", "airport", "drone_id", "disease_type_id", "count")
+        ):
+            apply((day, airport, drone_id), disease_type_id, None, count)
+        rows.delete()
+
+
+@transaction.atomic
+def rebuild(since=None, until=None):
+    """Recompute the rollup, optionally limited to ``[since, until]`` days."""
+    existing = DiseaseDailyRollup.objects.all()
+    tracks = DefectTrack.objects.annotate(day=TruncDate("batch__start_time"))
+    if since:
+        existing = existing.filter(day__gte=since)
+        tracks = tracks.filter(day__gte=since)
+    if until:
+        existing = existing.filter(day__lte=until)
+        tracks = tracks.filter(day__lte=until)
+    existing.delete()
+    groups = (
+        tracks.values(
+            "day",
+            "disease_type_id",
+            "severity_id",
+            airport=F("batch__airport"),
+            drone_id=F("batch__drone_id"),
+        )
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    rows = DiseaseDailyRollup.objects.bulk_create(
+        (DiseaseDailyRollup(**group) for group in groups), batch_size=500
+    )
+    return len(rows)
+
+
+def distribution(since=None, until=None, airport=None):
+    """Return ``[(disease type name, count)]`` ordered by count.
+
+    There is one row per disease type, so they are sorted here rather than
+    by an ``ORDER BY`` on the aggregate, which SQLite can only answer with a
+    temporary sort.
+    """
+    qs = DiseaseDailyRollup.objects.all()
+    if since:
+        qs = qs.filter(day__gte=since)
+    if until:
+        qs = qs.filter(day__lte=until)
+    if airport:
+        qs = qs.filter(airport=airport)
+    qs = qs.values("disease_type__name").annotate(total=Sum("count")).order_by()
+    rows = [(row["disease_type__name"], row["total"]) for row in qs]
+    return sorted(rows, key=lambda row: (-row[1], row[0]))
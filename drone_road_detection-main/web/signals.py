@@ -0,0 +1,260 @@
+"""Signal receivers keeping derived data in step with the web models.
+
+Counters and rollups are adjusted as rows are written.  Data versions and
+overlay caches are only invalidated once per transaction: receivers
+collect the touched batches and :func:`changed` flushes them when the
+transaction commits, so bulk ORM writes and cascading deletes cost a
+constant number of invalidation queries.  Bulk and raw writes, which fire
+no receivers, report the batches they touched through :func:`bulk_changed`.
+"""
+
+import threading
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import counters, db, rollups, versions
+from .models import (
+    DataVersion,
+    DefectTrack,
+    DetectionBatch,
+    DiseaseDailyRollup,
+    DiseaseMedia,
+    DiseaseType,
+    GroundTruthFrame,
+    IngestToken,
+    MediaType,
+    ModelEvaluation,
+    OverlayCache,
+    PackedTrackFrames,
+    PredictionFrame,
+    ReportType,
+    SeverityLevel,
+    StatsCounter,
+    WeatherType,
+)
+
+# Tables derived from the others, or never shown by the APIs; writing them
+# must not bump versions.
+DERIVED_MODELS = (
+    DataVersion,
+    OverlayCache,
+    StatsCounter,
+    DiseaseDailyRollup,
+    IngestToken,
+    PredictionFrame,
+    ModelEvaluation,
+)
+
+# Lookup tables whose names are embedded in every batch payload.
+DICTIONARY_MODELS = (DiseaseType, WeatherType, SeverityLevel, ReportType, MediaType)
+
+
+@receiver(connection_created)
+def _tune_sqlite(sender, connection, **kwargs):
+    pragmas = getattr(settings, "SQLITE_PRAGMAS", None)
+    if connection.vendor == "sqlite" and pragmas:
+        with connection.cursor() as cursor:
+            db.apply_pragmas(cursor, pragmas)
+
+
+_pending = threading.local()
+
+
+def _flush():
+    changes = _pending.__dict__.pop("changes", None)
+    if changes is None:
+        return
+    batch_ids = sorted(changes["batches"])
+    scopes = [versions.GLOBAL_SCOPE] + [versions.batch_scope(pk) for pk in batch_ids]
+    if changes["dictionary"]:
+        versions.bump(*scopes, versions.DICTIONARY_SCOPE)
+        OverlayCache.objects.all().delete()
+    else:
+        versions.bump(*scopes)
+        if batch_ids:
+            OverlayCache.objects.filter(batch_id__in=batch_ids).delete()
+
+
+def _flush_scheduled():
+    return any(func is _flush for _, func, _ in connection.run_on_commit)
+
+
+def changed(batch_id=None, dictionary=False):
+    """Invalidate the global scope, ``batch_id`` and, with ``dictionary``,
+    every overlay once the current transaction commits (immediately in
+    autocommit mode)."""
+    changes = getattr(_pending, "changes", None)
+    # A rolled back transaction discards the flush along with its writes.
+    fresh = changes is None or not (connection.in_atomic_block and _flush_scheduled())
+    if fresh:
+        changes = _pending.changes = {"batches": set(), "dictionary": False}
+    if batch_id is not None:
+        changes["batches"].add(batch_id)
+    changes["dictionary"] |= dictionary
+    if fresh:
+        transaction.on_commit(_flush)
+
+
+def bulk_changed(*batch_ids):
+    """Record a change to ``batch_ids`` made by bulk or raw writes, which
+    fire no receivers; see :func:`changed`."""
+    for batch_id in batch_ids:
+        changed(batch_id)
+    if not batch_ids:
+        changed()
+
+
+def _web_model_changed(sender, **kwargs):
+    changed(dictionary=sender in DICTIONARY_MODELS)
+
+
+# Connected per model rather than for every sender, so that tables without
+# receivers (caches, counters, versions) can be deleted in bulk.
+for _model in apps.get_app_config("web").get_models():
+    if _model not in DERIVED_MODELS:
+        for _signal in (post_save, post_delete):
+            _signal.connect(_web_model_changed, sender=_model)
+
+
+def _is_completed(trend):
+    return 1 if trend == counters.COMPLETED_TREND else 0
+
+
+@receiver(pre_save, sender=DetectionBatch)
+def _batch_saving(sender, instance, **kwargs):
+    instance._stored_rollup_key = rollups.batch_key(instance.pk) if instance.pk else None
+
+
+@receiver(post_save, sender=DetectionBatch)
+def _batch_saved(sender, instance, created, **kwargs):
+    if created:
+        counters.apply(counters.GLOBAL_KEY, inspections=1)
+    else:
+        # Moving a batch to another day/airport/drone moves its rollup counts.
+        old_key = getattr(instance, "_stored_rollup_key", None)
+        new_key = rollups.batch_key(instance.pk)
+        if old_key != new_key:
+            rollups.apply_batch(instance.pk, old_key, -1)
+            rollups.apply_batch(instance.pk, new_key, 1)
+    changed(instance.pk)
+
+
+@receiver(post_delete, sender=DetectionBatch)
+def _batch_deleted(sender, instance, **kwargs):
+    counters.apply(counters.GLOBAL_KEY, inspections=-1)
+    StatsCounter.objects.filter(key=counters.batch_key(instance.pk)).delete()
+    changed(instance.pk)
+
+
+@receiver(pre_save, sender=DefectTrack)
+def _track_saving(sender, instance, **kwargs):
+    # Remember the stored row so post_save can apply deltas.
+    instance._stored_state = None
+    if instance.pk:
+        instance._stored_state = (
+            DefectTrack.objects.filter(pk=instance.pk)
+            .values_list("batch_id", "develop_trend", "disease_type_id", "severity_id")
+            .first()
+        )
+
+
+@receiver(post_save, sender=DefectTrack)
+def _track_saved(sender, instance, created, **kwargs):
+    stored = getattr(instance, "_stored_state", None)
+    completed = _is_completed(instance.develop_trend)
+    if created or stored is None:
+        counters.apply_tracks(instance.batch_id, defects=1, completed=completed)
+        rollups.apply(
+            rollups.batch_key(instance.batch_id),
+            instance.disease_type_id,
+            instance.severity_id,
+            1,
+        )
+    else:
+        old_batch, old_trend, old_type, old_severity = stored
+        if (old_batch, old_type, old_severity) != (
+            instance.batch_id,
+            instance.disease_type_id,
+            instance.severity_id,
+        ):
+            rollups.apply(rollups.batch_key(old_batch), old_type, old_severity, -1)
+            rollups.apply(
+                rollups.batch_key(instance.batch_id),
+                instance.disease_type_id,
+                instance.severity_id,
+                1,
+            )
+        if old_batch != instance.batch_id:
+            GroundTruthFrame.objects.filter(track=instance).update(batch_id=instance.batch_id)
+            counters.apply_tracks(old_batch, defects=-1, completed=-_is_completed(old_trend))
+            counters.apply_tracks(instance.batch_id, defects=1, completed=completed)
+            changed(old_batch)
+        else:
+            counters.apply_tracks(
+                instance.batch_id, completed=completed - _is_completed(old_trend)
+            )
+    changed(instance.batch_id)
+
+
+@receiver(post_delete, sender=DefectTrack)
+def _track_deleted(sender, instance, **kwargs):
+    counters.apply_tracks(
+        instance.batch_id, defects=-1, completed=-_is_completed(instance.develop_trend)
+    )
+    rollups.apply(
+        rollups.batch_key(instance.batch_id),
+        instance.disease_type_id,
+        instance.severity_id,
+        -1,
+    )
+    changed(instance.batch_id)
+
+
+def _track_batch(track_id):
+    return (
+        DefectTrack.objects.filter(pk=track_id)
+        .values_list("batch_id", flat=True)
+        .first()
+    )
+
+
+@receiver(pre_delete, sender=SeverityLevel)
+def _severity_deleting(sender, instance, **kwargs):
+    # Tracks keep their rows with severity NULL; so do their rollup counts.
+    rollups.fold_severity(instance.pk)
+
+
+@receiver(pre_save, sender=GroundTruthFrame)
+def _frame_saving(sender, instance, **kwargs):
+    # A frame moved to a track of another batch leaves its old batch too.
+    # Instances read from the database remember their batch (``from_db``).
+    if instance.pk and not hasattr(instance, "_loaded_batch_id"):
+        instance._loaded_batch_id = (
+            GroundTruthFrame.objects.filter(pk=instance.pk)
+            .values_list("batch_id", flat=True)
+            .first()
+        )
+
+
+@receiver([post_save, post_delete], sender=GroundTruthFrame)
+def _frame_changed(sender, instance, **kwargs):
+    stored = getattr(instance, "_loaded_batch_id", None)
+    if stored is not None and stored != instance.batch_id:
+        changed(stored)
+    changed(instance.batch_id)
+    instance._loaded_batch_id = instance.batch_id
+
+
+@receiver([post_save, post_delete], sender=DiseaseMedia)
+def _media_changed(sender, instance, **kwargs):
+    changed(_track_batch(instance.defect_track_id))
+
+
+@receiver([post_save, post_delete], sender=PackedTrackFrames)
+def _packed_frames_changed(sender, instance, **kwargs):
+    changed(_track_batch(instance.track_id))
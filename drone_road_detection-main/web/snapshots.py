@@ -0,0 +1,213 @@
+"""Content-addressed JPEG snapshot store.
+
+Snapshots are encoded in a process pool and stored under
+``<root>/<sha[:2]>/<sha>.jpg`` where ``sha`` is the SHA-256 of the encoded
+bytes, so identical frames -- the same video frame shared by several
+batches or tracks -- are written once and share one URL.
+
+Track snapshots are crops rather than whole frames: :class:`BestViews`
+keeps, per track, the frame with the largest and most central box and
+:func:`crop` cuts that box plus a margin out of it; the store downscales
+crops to at most ``max_size`` pixels before encoding.
+"""
+
+import hashlib
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import imageio
+import numpy as np
+
+SNAPSHOT_DIR = "snapshots"
+JPEG_QUALITY = 85
+# Margin around a cropped box, as a fraction of its width and height, and
+# the longest side of a stored crop in pixels.
+SNAPSHOT_MARGIN = 0.25
+SNAPSHOT_SIZE = 320
+
+
+def relative_path(digest):
+    """Return the path of a snapshot relative to the store root."""
+    return f"{digest[:2]}/{digest}.jpg"
+
+
+def view_scores(bbox):
+    """Return ``(area, offset)`` of ``(N, 4)`` normalised ``x, y, w, h`` boxes:
+    the area visible in the frame and how far the visible part is from the
+    frame centre."""
+    x, y, w, h = np.asarray(bbox, np.float64).reshape(-1, 4).T
+    left, top = np.maximum(x, 0.0), np.maximum(y, 0.0)
+    right, bottom = np.minimum(x + w, 1.0), np.minimum(y + h, 1.0)
+    area = np.round(np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None), 6)
+    return area, np.abs(left + right - 1) + np.abs(top + bottom - 1)
+
+
+def view_score(bbox):
+    """Rank one box as a snapshot of its track, higher being better.
+
+    The visible area counts first; among equal areas the box nearest the
+    frame centre wins, as boxes on the border are often cut off.
+    """
+    area, offset = view_scores(bbox)
+    return float(area[0]), -float(offset[0])
+
+
+def best_boxes(track_id, bbox):
+    """Return the index of the best box of each track by :func:`view_score`,
+    the first of equally good boxes winning."""
+    track_id = np.asarray(track_id)
+    if not len(track_id):
+        return np.empty(0, np.int64)
+    area, offset = view_scores(bbox)
+    order = np.lexsort((np.arange(len(track_id)), offset, -area, track_id))
+    first = np.ones(len(order), bool)
+    first[1:] = track_id[order][1:] != track_id[order][:-1]
+    return order[first]
+
+
+def crop(img, bbox, margin=SNAPSHOT_MARGIN):
+    """Return the part of ``img`` showing the normalised ``bbox`` widened by
+    ``margin`` of its size on each side, clipped to the frame."""
+    height, width = img.shape[:2]
+    x, y, w, h = bbox
+    x0 = int(np.clip(np.floor((x - margin * w) * width), 0, width - 1))
+    y0 = int(np.clip(np.floor((y - margin * h) * height), 0, height - 1))
+    x1 = int(np.clip(np.ceil((x + (1 + margin) * w) * width), x0 + 1, width))
+    y1 = int(np.clip(np.ceil((y + (1 + margin) * h) * height), y0 + 1, height))
+    return img[y0:y1, x0:x1]
+
+
+def fit(img, max_size):
+    """Downscale ``img`` so that its longest side is at most ``max_size``."""
+    height, width = img.shape[:2]
+    if not max_size or max(height, width) <= max_size:
+        return img
+    scale = max_size / max(height, width)
+    size = (max(round(width * scale), 1), max(round(height * scale), 1))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+class BestViews:
+    """Keep the best crop seen so far of each track.
+
+    ``offer(key, frame_index, img, bbox)`` is called for every labelled box
+    while frames stream past; only a crop that beats the track's current
+    one (by :func:`view_score`, earlier frames winning ties) is copied, so
+    memory is bounded by one crop per track.  ``views`` maps each key to
+    ``(frame_index, bbox, crop)``.
+    """
+
+    def __init__(self, margin=SNAPSHOT_MARGIN):
+        self.margin = margin
+        self.views = {}
+        self._scores = {}
+
+    def offer(self, key, frame_index, img, bbox):
+        score = view_score(bbox)
+        if key in self._scores and score <= self._scores[key]:
+            return False
+        self._scores[key] = score
+        self.views[key] = (frame_index, tuple(bbox), crop(img, bbox, self.margin).copy())
+        return True
+
+
+def encode_and_store(root, img, quality=JPEG_QUALITY, max_size=None):
+    """Encode ``img`` as JPEG and store it unless the content exists.
+
+    ``img`` is first downscaled to ``max_size`` (see :func:`fit`).  Returns
+    ``(digest, size, written)``.  Files are written to a temporary name and
+    renamed into place, so concurrent writers of the same content never
+    expose a partial file.
+    """
+    img = fit(img, max_size)
+    data = imageio.imwrite("<bytes>", img, format="jpg", quality=quality)
+    digest = hashlib.sha256(data).hexdigest()
+    path = Path(root) / relative_path(digest)
+    if path.exists():
+        return digest, len(data), False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+    return digest, len(data), True
+
+
+def worker_context():
+    """Start workers from a clean process rather than forking the caller.
+
+    A forked worker would inherit open descriptors such as the stdin pipe
+    of the ffmpeg video writer, which then never sees EOF.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+class SnapshotStore:
+    """Encode snapshots in parallel and resolve them to media URLs.
+
+    ``put(key, img)`` schedules a frame; once the store is closed (or used
+    as a context manager) ``urls[key]`` holds its URL.  At most
+    ``max_pending`` frames are in flight, which bounds memory.  With
+    ``workers=0`` frames are encoded inline.  ``max_size`` bounds the
+    longest side of the stored images.
+    """
+
+    def __init__(self, root, url_prefix, workers=None, quality=JPEG_QUALITY, max_pending=None,
+                 max_size=None):
+        self.root = Path(root)
+        self.url_prefix = url_prefix.rstrip("/") + "/"
+        self.quality = quality
+        self.max_size = max_size
+        self.urls = {}
+        self.files = 0
+        self.bytes = 0
+        self.duplicates = 0
+        workers = os.cpu_count() if workers is None else workers
+        self._executor = (
+            ProcessPoolExecutor(workers, mp_context=worker_context()) if workers else None
+        )
+        self._max_pending = max_pending or 2 * max(workers, 1)
+        self._pending = deque()
+
+    def put(self, key, img):
+        """Schedule ``img`` (copied, as callers may reuse their buffer)."""
+        img = np.array(img, copy=True)
+        if self._executor is None:
+            future = Future()
+            future.set_result(encode_and_store(self.root, img, self.quality, self.max_size))
+        else:
+            future = self._executor.submit(
+                encode_and_store, self.root, img, self.quality, self.max_size
+            )
+        self._pending.append((key, future))
+        while len(self._pending) > self._max_pending:
+            self._collect()
+
+    def _collect(self):
+        key, future = self._pending.popleft()
+        digest, size, written = future.result()
+        self.urls[key] = self.url_prefix + relative_path(digest)
+        if written:
+            self.files += 1
+            self.bytes += size
+        else:
+            self.duplicates += 1
+
+    def close(self):
+        """Wait for every scheduled snapshot and shut the pool down."""
+        try:
+            while self._pending:
+                self._collect()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -167,22 +167,98 @@ document.addEventListener('DOMContentLoaded', () => {
     const ctx = canvas.getContext('2d');
     const replayBtn = document.getElementById('replayButton');
 
+    // Annotations are fetched in time windows so the first overlay does not
+    // wait for the whole flight; upcoming windows are prefetched on playback
+    // and on seek.
+    const WINDOW_SECONDS = 10;
     let frameMap = new Map();
+    let loadedWindows = new Set();
+    let currentBatch = null;
 
-    function loadBatch(batchId) {
-        frameMap = new Map();
-        fetch(`/api/boxes/?batch=${batchId}`)
-            .then(resp => resp.json())
-            .then(data => {
-                data.frames.forEach(f => {
-                    frameMap.set(Math.round(f.time * 1000), f.boxes);
-                });
-                if (data.video) {
-                    video.src = data.video;
-                    video.load();
-                    video.play().catch(() => {});
+    // Decode the columnar /api/boxes/ payload (see web/overlay.py
+    // encode_columnar) into typed arrays viewing the response buffer.
+    // Typed arrays use the platform byte order, which is little endian on
+    // every browser we target.
+    function decodeColumnar(buffer) {
+        const view = new DataView(buffer);
+        const headerLength = view.getUint32(8, true);
+        const header = JSON.parse(
+            new TextDecoder().decode(new Uint8Array(buffer, 12, headerLength))
+        );
+        let offset = 12 + headerLength;
+        offset += (8 - offset % 8) % 8;
+        const frameCount = view.getUint32(offset, true);
+        const boxCount = view.getUint32(offset + 4, true);
+        offset += 8;
+        const times = new Float64Array(buffer, offset, frameCount);
+        offset += frameCount * 8;
+        const frames = new Uint32Array(buffer, offset, frameCount);
+        offset += frameCount * 4;
+        const offsets = new Uint32Array(buffer, offset, frameCount + 1);
+        offset += (frameCount + 1) * 4;
+        const boxTracks = new Uint32Array(buffer, offset, boxCount);
+        offset += boxCount * 4;
+        const bboxes = new Float32Array(buffer, offset, boxCount * 4);
+        return {
+            video: header.video,
+            labels: header.labels,
+            tracks: header.tracks,
+            frames,
+            times,
+            offsets,
+            boxTracks,
+            bboxes
+        };
+    }
+
+    function fetchWindow(batchId, index) {
+        if (index < 0 || loadedWindows.has(index)) {
+            return Promise.resolve(null);
+        }
+        loadedWindows.add(index);
+        const t0 = index * WINDOW_SECONDS;
+        const t1 = t0 + WINDOW_SECONDS;
+        return fetch(`/api/boxes/?batch=${batchId}&t0=${t0}&t1=${t1}&format=columnar`)
+            .then(resp => resp.arrayBuffer())
+            .then(buffer => {
+                if (batchId !== currentBatch) {
+                    return null;
                 }
+                const data = decodeColumnar(buffer);
+                for (let i = 0; i < data.frames.length; i++) {
+                    frameMap.set(Math.round(data.times[i] * 1000), {
+                        data,
+                        begin: data.offsets[i],
+                        end: data.offsets[i + 1]
+                    });
+                }
+                return data;
+            })
+            .catch(() => {
+                loadedWindows.delete(index);
+                return null;
             });
+    }
+
+    function ensureWindows(time) {
+        if (currentBatch === null) return;
+        const index = Math.floor(time / WINDOW_SECONDS);
+        fetchWindow(currentBatch, index);
+        fetchWindow(currentBatch, index + 1);
+    }
+
+    function loadBatch(batchId) {
+        currentBatch = batchId;
+        frameMap = new Map();
+        loadedWindows = new Set();
+        fetchWindow(batchId, 0).then(data => {
+            if (data && data.video) {
+                video.src = data.video;
+                video.load();
+                video.play().catch(() => {});
+            }
+        });
+        fetchWindow(batchId, 1);
 
         fetch(`/api/tracks/?batch=${batchId}`)
             .then(resp => resp.json())
@@ -194,6 +270,11 @@ document.addEventListener('DOMContentLoaded', () => {
                     item.className = 'track-item';
                     const img = document.createElement('img');
                     img.src = t.snapshot;
+                    if (t.srcset) {
+                        img.srcset = t.srcset;
+                        img.sizes = '(min-width: 800px) 20vw, 160px';
+                    }
+                    img.loading = 'lazy';
                     item.appendChild(img);
                     const caption = document.createElement('span');
                     const severityText = t.severity ? ` - ${t.severity}` : '';
@@ -227,16 +308,20 @@ document.addEventListener('DOMContentLoaded', () => {
         '沉陷': '#ffff00'
     };
 
-    function drawBoxes(context, w, h, boxes) {
+    function drawBoxes(context, w, h, entry) {
+        const { data, begin, end } = entry;
         context.lineWidth = 2;
         context.font = '16px sans-serif';
-        boxes.forEach(b => {
-            const color = colorMap[b.label] || '#00ff00';
+        for (let i = begin; i < end; i++) {
+            const label = data.labels[data.tracks[data.boxTracks[i]][1]];
+            const x = data.bboxes[i * 4];
+            const y = data.bboxes[i * 4 + 1];
+            const color = colorMap[label] || '#00ff00';
             context.strokeStyle = color;
             context.fillStyle = color;
-            context.strokeRect(b.x * w, b.y * h, b.w * w, b.h * h);
-            context.fillText(b.label, b.x * w, b.y * h - 4);
-        });
+            context.strokeRect(x * w, y * h, data.bboxes[i * 4 + 2] * w, data.bboxes[i * 4 + 3] * h);
+            context.fillText(label, x * w, y * h - 4);
+        }
     }
 
     function adjustCanvasSize() {
@@ -251,9 +336,9 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function drawFrameAt(time) {
         ctx.clearRect(0, 0, canvas.width, canvas.height);
-        const boxes = frameMap.get(Math.round(time * 1000));
-        if (boxes) {
-            drawBoxes(ctx, canvas.width, canvas.height, boxes);
+        const entry = frameMap.get(Math.round(time * 1000));
+        if (entry) {
+            drawBoxes(ctx, canvas.width, canvas.height, entry);
         }
     }
 
@@ -281,6 +366,9 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    video.addEventListener('timeupdate', () => ensureWindows(video.currentTime));
+    video.addEventListener('seeking', () => ensureWindows(video.currentTime));
+
     video.addEventListener('pause', () => {
         ctx.clearRect(0, 0, canvas.width, canvas.height);
     });
@@ -0,0 +1,233 @@
+"""Synthetic road video rendering for demo and load-test data.
+
+``RoadRenderer`` is the production renderer: the scrolling background is a
+precomputed strip served as zero-copy views, active defects are found with
+an ``IntervalIndex`` and their bounding boxes are computed together with
+NumPy.  ``reference_frames`` is the original per-frame implementation; it
+is kept for the equivalence tests and the ``bench_render`` command.
+"""
+
+import cv2
+import numpy as np
+
+GRASS_COLOR = (34, 139, 34)
+ROAD_COLOR = (50, 50, 50)
+DASH_COLOR = (255, 255, 255)
+DASH_PERIOD = 80  # px between the starts of two lane dashes
+DASH_LENGTH = 40  # px
+SCROLL_SPEED = 20  # px per frame
+LINE_SEGMENTS = 8
+
+SHAPE_CIRCLE = 0
+SHAPE_LINE = 1
+
+
+def random_defects(duration, width, height):
+    """Return random defect trajectories as dicts, 2-10 per defect class."""
+    road_left, road_right = width // 4, width * 3 // 4
+    defects = []
+
+    def add_defects(label, shape, base_kwargs):
+        cnt = np.random.randint(2, 11)
+        for _ in range(cnt):
+            start_t = float(np.random.uniform(0, max(0.1, duration - 1)))
+            end_t = float(min(duration, start_t + np.random.uniform(0.5, 1.5)))
+            x_pos = int(np.random.randint(road_left + 50, road_right - 50))
+            defects.append(
+                dict(label=label, shape=shape, start=start_t, end=end_t,
+                     x=x_pos, start_y=height + 150, end_y=-150, **base_kwargs)
+            )
+
+    add_defects("裂缝", "line", {"length": 300, "thickness": 8, "color": (30, 30, 30)})
+    add_defects("坑槽", "circle", {"size": 120, "color": (80, 80, 80)})
+    return defects
+
+
+def _label(frame_index, time_sec, box, width, height, defect, track_id):
+    x, y, w, h = (int(v) for v in box)
+    return dict(frame_index=frame_index,
+                time=round(time_sec, 3),
+                bbox_x=x / width,
+                bbox_y=y / height,
+                bbox_width=w / width,
+                bbox_height=h / height,
+                label=defect["label"],
+                track_id=track_id)
+
+
+class IntervalIndex:
+    """Stabbing queries over closed ``[start, end]`` intervals.
+
+    Intervals are sorted by start; since no interval is longer than
+    ``span``, the ones containing ``t`` all start in ``[t - span, t]`` and
+    are located with two binary searches.
+    """
+
+    def __init__(self, starts, ends):
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        self._order = np.argsort(starts, kind="stable")
+        self._starts = starts[self._order]
+        self._ends = ends[self._order]
+        # Widened slightly so ``t - span`` cannot round past a matching start.
+        self._span = float((ends - starts).max()) * (1 + 1e-9) + 1e-9 if len(starts) else 0.0
+
+    def active(self, t):
+        """Return the ids of the intervals containing ``t``, ascending."""
+        hi = np.searchsorted(self._starts, t, side="right")
+        lo = np.searchsorted(self._starts, t - self._span, side="left")
+        hits = self._order[lo:hi][self._ends[lo:hi] >= t]
+        hits.sort()
+        return hits
+
+
+class RoadRenderer:
+    """Render frames of the synthetic road flight over ``defects``."""
+
+    def __init__(self, defects, width, height, fps):
+        self.defects = defects
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self._strip = self._background_strip()
+        self._canvas = np.empty((height, width, 3), np.uint8)
+        self._index = IntervalIndex([d["start"] for d in defects], [d["end"] for d in defects])
+
+        self._start = np.array([d["start"] for d in defects], np.float64)
+        self._duration = np.array([d["end"] - d["start"] for d in defects], np.float64)
+        self._x = np.array([d["x"] for d in defects], np.int64)
+        self._start_y = np.array([d["start_y"] for d in defects], np.float64)
+        self._travel = np.array([d["end_y"] - d["start_y"] for d in defects], np.float64)
+        self._shape = np.array(
+            [SHAPE_CIRCLE if d["shape"] == "circle" else SHAPE_LINE for d in defects], np.int8
+        )
+        self._radius = np.array([d.get("size", 0) // 2 for d in defects], np.int64)
+        self._length = np.array([d.get("length", 0) for d in defects], np.float64)
+        self._thickness = np.array([d.get("thickness", 0) for d in defects], np.int64)
+
+    def _background_strip(self):
+        """Grass, road and one extra dash period of rows to scroll through."""
+        width, height = self.width, self.height
+        strip = np.empty((height + DASH_PERIOD, width, 3), np.uint8)
+        strip[:] = GRASS_COLOR
+        strip[:, width // 4:width * 3 // 4] = ROAD_COLOR
+        rows = np.arange(len(strip)) % DASH_PERIOD < DASH_LENGTH
+        strip[rows, width // 2 - 5:width // 2 + 5] = DASH_COLOR
+        strip.flags.writeable = False
+        return strip
+
+    def background(self, frame_index):
+        """Return the background of ``frame_index`` as a view of the strip."""
+        offset = (frame_index * SCROLL_SPEED) % DASH_PERIOD
+        return self._strip[offset:offset + self.height]
+
+    def boxes(self, ids, time_sec):
+        """Centres, polyline points and clipped boxes of defects ``ids``.
+
+        Returns ``(cx, cy, points, boxes)`` where ``points`` has shape
+        ``(len(ids), LINE_SEGMENTS, 2)`` (meaningful for lines only) and
+        ``boxes`` holds ``x, y, w, h`` pixel rows.
+        """
+        ratio = (time_sec - self._start[ids]) / self._duration[ids]
+        cx = self._x[ids]
+        cy = np.trunc(self._start_y[ids] + ratio * self._travel[ids]).astype(np.int64)
+
+        # Zig-zag crack polyline, truncated like ``int()`` on each vertex.
+        i = np.arange(LINE_SEGMENTS)
+        amp = self._thickness[ids] * 2
+        length = self._length[ids]
+        points = np.empty((len(ids), LINE_SEGMENTS, 2), np.int64)
+        points[..., 0] = cx[:, None] + np.where(i % 2, -1, 1)[None, :] * amp[:, None]
+        points[..., 1] = np.trunc(
+            cy[:, None] - length[:, None] / 2 + i[None, :] * length[:, None] / (LINE_SEGMENTS - 1)
+        )
+
+        pad = self._thickness[ids]
+        line_min = points.min(axis=1) - pad[:, None]
+        line_size = points.max(axis=1) - points.min(axis=1) + 1 + 2 * pad[:, None]
+        r = self._radius[ids]
+        circle = (self._shape[ids] == SHAPE_CIRCLE)[:, None]
+        origin = np.where(circle, np.stack([cx - r, cy - r], axis=1), line_min)
+        size = np.where(circle, np.stack([2 * r, 2 * r], axis=1), line_size)
+
+        # Clip to the frame; the size is clipped against the clipped origin.
+        origin = np.maximum(origin, 0)
+        size = np.minimum(size, np.array([self.width, self.height]) - origin)
+        boxes = np.concatenate([origin, size], axis=1)
+        return cx, cy, points, boxes
+
+    def render(self, frame_index):
+        """Return ``(img, labels)`` for ``frame_index``.
+
+        Frames without defects are read-only views of the background strip;
+        the others are drawn into a canvas that is reused by the next call,
+        so callers must consume ``img`` before rendering another frame.
+        """
+        time_sec = frame_index / self.fps
+        ids = self._index.active(time_sec)
+        view = self.background(frame_index)
+        if not len(ids):
+            return view, []
+
+        img = self._canvas
+        np.copyto(img, view)
+        cx, cy, points, boxes = self.boxes(ids, time_sec)
+        labels = []
+        for k, idx in enumerate(ids):
+            defect = self.defects[idx]
+            if self._shape[idx] == SHAPE_CIRCLE:
+                cv2.circle(img, (int(cx[k]), int(cy[k])), int(self._radius[idx]), defect["color"], -1)
+            else:
+                cv2.polylines(img, [points[k].astype(np.int32)], False, defect["color"],
+                              int(self._thickness[idx]))
+            labels.append(_label(frame_index, time_sec, boxes[k], self.width, self.height,
+                                 defect, int(idx)))
+        return img, labels
+
+    def frames(self, total_frames):
+        """Yield ``(frame_index, img, labels)`` for the first ``total_frames``."""
+        for t in range(total_frames):
+            img, labels = self.render(t)
+            yield t, img, labels
+
+
+def reference_frames(defects, width, height, fps, total_frames):
+    """The original scalar renderer, yielding ``(frame_index, img, labels)``."""
+    road_left, road_right = width // 4, width * 3 // 4
+    for t in range(total_frames):
+        img = np.full((height, width, 3), GRASS_COLOR, np.uint8)
+        img[:, road_left:road_right] = ROAD_COLOR
+        offset = (t * SCROLL_SPEED) % DASH_PERIOD
+        for y in range(-offset, height, DASH_PERIOD):
+            img[y:y + DASH_LENGTH, width // 2 - 5:width // 2 + 5] = DASH_COLOR
+
+        time_sec = t / fps
+        labels = []
+        for idx, df in enumerate(defects):
+            if not (df["start"] <= time_sec <= df["end"]):
+                continue
+            ratio = (time_sec - df["start"]) / (df["end"] - df["start"])
+            cx = int(df["x"])
+            cy = int(df["start_y"] + ratio * (df["end_y"] - df["start_y"]))
+            if df["shape"] == "circle":
+                r = df["size"] // 2
+                cv2.circle(img, (cx, cy), r, df["color"], -1)
+                x, y, w, h = cx - r, cy - r, 2 * r, 2 * r
+            else:
+                length, thick = df["length"], df["thickness"]
+                amp = thick * 2
+                pts = np.array(
+                    [(int(cx + ((-1) ** i) * amp),
+                      int(cy - length / 2 + i * length / (LINE_SEGMENTS - 1)))
+                     for i in range(LINE_SEGMENTS)],
+                    dtype=np.int32,
+                )
+                cv2.polylines(img, [pts], False, df["color"], thick)
+                x, y, w, h = cv2.boundingRect(pts)
+                x, y, w, h = x - thick, y - thick, w + 2 * thick, h + 2 * thick
+            x = max(0, x)
+            y = max(0, y)
+            w = min(w, width - x)
+            h = min(h, height - y)
+            labels.append(_label(t, time_sec, (x, y, w, h), width, height, df, idx))
+        yield t, img, labels
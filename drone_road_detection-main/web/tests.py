@@ -1,6 +1,47 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import re
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase as DjangoTestCase, override_settings
 from django.urls import reverse
+from django.utils.http import http_date
 
+from . import (
+    archive,
+    db,
+    detectors,
+    evaluation,
+    formats,
+    ingest,
+    matching,
+    overlay,
+    pipeline,
+    signals,
+    synth,
+    thumbnails,
+    trackdata,
+    versions,
+)
+from .decorators import reset_cache_stats
+from .purge import purge_batches
+from .snapshots import SNAPSHOT_SIZE, BestViews, SnapshotStore, best_boxes, crop
 from .models import (
     DetectionBatch,
     DefectTrack,
@@ -9,9 +50,35 @@ from .models import (
     WeatherType,
     MediaType,
     DiseaseMedia,
+    IngestToken,
+    ModelEvaluation,
+    OverlayCache,
+    PackedTrackFrames,
+    PredictionFrame,
+    StatsCounter,
+    DiseaseDailyRollup,
+    SeverityLevel,
 )
 
 
+def _run_on_commit(func, using=None, robust=False):
+    func()
+
+
+class TestCase(DjangoTestCase):
+    """Runs ``transaction.on_commit`` hooks as soon as they are registered.
+
+    Each test runs in a transaction that is rolled back, so hooks would
+    otherwise never run; :class:`DeferredInvalidationTest` covers the
+    deferral itself.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.enterClassContext(mock.patch.object(transaction, "on_commit", _run_on_commit))
+
+
 class AnomalyBoxesAPITest(TestCase):
     def setUp(self):
         dtype = DiseaseType.objects.create(name="裂缝")
@@ -24,6 +91,7 @@ class AnomalyBoxesAPITest(TestCase):
             weather=weather,
             video_link="/media/demo.mp4",
         )
+        self.batch = batch
         track = DefectTrack.objects.create(
             batch=batch,
             disease_type=dtype,
@@ -60,6 +128,1812 @@ class AnomalyBoxesAPITest(TestCase):
         self.assertEqual(first_box["end"], 12)
         self.assertEqual(first_box["label"], "裂缝")
 
+    def test_boxes_stream_matches_json(self):
+        resp = self.client.get(reverse("anomaly_boxes"))
+        streamed = self.client.get(reverse("anomaly_boxes"), {"stream": "1"})
+        self.assertEqual(streamed.status_code, 200)
+        self.assertTrue(streamed.streaming)
+        self.assertEqual(b"".join(streamed.streaming_content), resp.content)
+
+    def test_boxes_frame_window(self):
+        resp = self.client.get(
+            reverse("anomaly_boxes"),
+            {"batch": self.batch.id, "from_frame": 11, "to_frame": 20},
+        )
+        data = resp.json()
+        self.assertEqual([f["frame"] for f in data["frames"]], [11])
+        self.assertEqual(data["video"], "/media/demo.mp4")
+
+    def test_boxes_time_window(self):
+        # Without a known frame rate the window filters on ``time``.
+        params = {"batch": self.batch.id, "t0": 0.45, "t1": 1}
+        data = self.client.get(reverse("anomaly_boxes"), params).json()
+        self.assertEqual([f["frame"] for f in data["frames"]], [11])
+
+        self.batch.total_frames = 250
+        self.batch.video_duration = 10
+        self.batch.save()
+        params = {"batch": self.batch.id, "t0": 0, "t1": 0.44}
+        data = self.client.get(reverse("anomaly_boxes"), params).json()
+        self.assertEqual([f["frame"] for f in data["frames"]], [10])
+
+    def test_boxes_empty_window_keeps_video(self):
+        params = {"batch": self.batch.id, "t0": 30, "t1": 40}
+        data = self.client.get(reverse("anomaly_boxes"), params).json()
+        self.assertEqual(data["frames"], [])
+        self.assertEqual(data["video"], "/media/demo.mp4")
+
+    def test_boxes_columnar_matches_json(self):
+        data = self.client.get(reverse("anomaly_boxes")).json()
+        for request_kwargs in (
+            {"data": {"format": "columnar"}},
+            {"HTTP_ACCEPT": overlay.COLUMNAR_CONTENT_TYPE},
+        ):
+            resp = self.client.get(reverse("anomaly_boxes"), **request_kwargs)
+            self.assertEqual(resp["Content-Type"], overlay.COLUMNAR_CONTENT_TYPE)
+            decoded = overlay.decode_columnar(resp.content)
+            self.assertEqual(decoded["video"], data["video"])
+            self.assertEqual(len(decoded["frames"]), len(data["frames"]))
+            for got, expected in zip(decoded["frames"], data["frames"]):
+                self.assertEqual(got["frame"], expected["frame"])
+                self.assertAlmostEqual(got["time"], expected["time"])
+                self.assertEqual(len(got["boxes"]), len(expected["boxes"]))
+                for box, ref in zip(got["boxes"], expected["boxes"]):
+                    for key in ("track", "label", "start", "end"):
+                        self.assertEqual(box[key], ref[key])
+                    for key in ("x", "y", "w", "h"):
+                        self.assertAlmostEqual(box[key], ref[key], places=6)
+
+    def test_boxes_invalid_window(self):
+        resp = self.client.get(reverse("anomaly_boxes"), {"from_frame": "x"})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_boxes_non_finite_or_huge_window(self):
+        self.batch.total_frames = 250
+        self.batch.video_duration = 10
+        self.batch.save()
+        url = reverse("anomaly_boxes")
+        for params in ({"t1": "inf"}, {"t1": "1e400"}, {"t0": "-inf"}, {"t0": "nan"}):
+            resp = self.client.get(url, {"batch": self.batch.id, **params})
+            self.assertEqual(resp.status_code, 400, params)
+        for params, frames in (
+            ({"t1": "1e300"}, [10, 11]),
+            ({"from_frame": 10**30}, []),
+            ({"to_frame": -(10**30)}, []),
+            ({"from_frame": -(10**30), "to_frame": 10**30}, [10, 11]),
+        ):
+            data = self.client.get(url, {"batch": self.batch.id, **params}).json()
+            self.assertEqual([f["frame"] for f in data["frames"]], frames, params)
+
+
+@override_settings(API_CACHE_TTLS={})
+class OverlayCacheTest(TestCase):
+    def setUp(self):
+        dtype = DiseaseType.objects.create(name="裂缝")
+        self.batch = DetectionBatch.objects.create(
+            start_time="2024-01-01T00:00:00Z",
+            end_time="2024-01-01T01:00:00Z",
+            airport="A1",
+            drone_id="D1",
+            video_link="/media/demo.mp4",
+        )
+        self.track = DefectTrack.objects.create(
+            batch=self.batch,
+            disease_type=dtype,
+            unique_code="TRK1",
+            start_frame=10,
+            end_frame=11,
+        )
+        self.frame = GroundTruthFrame.objects.create(
+            track=self.track,
+            frame_index=10,
+            time=0.4,
+            bbox_x=0.1,
+            bbox_y=0.2,
+            bbox_width=0.3,
+            bbox_height=0.4,
+        )
+
+    def get_boxes(self, **extra):
+        return self.client.get(reverse("anomaly_boxes"), {"batch": self.batch.id}, **extra)
+
+    def test_cached_payload_and_etag(self):
+        resp = self.get_boxes()
+        self.assertIn("ETag", resp)
+        self.assertEqual(OverlayCache.objects.filter(batch=self.batch).count(), 1)
+        with self.assertNumQueries(4):
+            again = self.get_boxes()
+        self.assertEqual(again.content, resp.content)
+        not_modified = self.get_boxes(HTTP_IF_NONE_MATCH=resp["ETag"])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_invalidated_by_frame_write(self):
+        etag = self.get_boxes()["ETag"]
+        GroundTruthFrame.objects.create(
+            track=self.track,
+            frame_index=11,
+            time=0.5,
+            bbox_x=0.1,
+            bbox_y=0.2,
+            bbox_width=0.3,
+            bbox_height=0.4,
+        )
+        self.assertFalse(OverlayCache.objects.filter(batch=self.batch).exists())
+        resp = self.get_boxes(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.json()["frames"]), 2)
+
+    def test_frame_moved_to_another_batch(self):
+        other = DetectionBatch.objects.create(
+            start_time="2024-01-02T00:00:00Z",
+            end_time="2024-01-02T01:00:00Z",
+            airport="A1",
+            drone_id="D1",
+        )
+        other_track = DefectTrack.objects.create(
+            batch=other,
+            disease_type=self.track.disease_type,
+            unique_code="TRK2",
+            start_frame=10,
+            end_frame=11,
+        )
+        self.assertEqual(len(self.get_boxes().json()["frames"]), 1)
+        self.client.get(reverse("anomaly_boxes"), {"batch": other.id})
+        self.frame.track = other_track
+        self.frame.save()
+        self.assertEqual(self.frame.batch_id, other.id)
+        self.assertFalse(OverlayCache.objects.exists())
+        resp = self.get_boxes()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()["frames"], [])
+        moved = self.client.get(reverse("anomaly_boxes"), {"batch": other.id}).json()
+        self.assertEqual(moved["frames"][0]["boxes"][0]["track"], other_track.id)
+
+    def test_windowed_requests_not_materialised(self):
+        for n in range(3):
+            resp = self.client.get(
+                reverse("anomaly_boxes"), {"batch": self.batch.id, "from_frame": n}
+            )
+            self.assertEqual(resp.status_code, 200)
+        self.assertFalse(OverlayCache.objects.exists())
+
+    def test_processing_batch_not_cached(self):
+        self.batch.status = "processing"
+        self.batch.save()
+        self.assertEqual(self.get_boxes().status_code, 200)
+        self.assertFalse(OverlayCache.objects.exists())
+
+
+class DeferredInvalidationTest(DjangoTestCase):
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.batch = DetectionBatch.objects.create(
+                start_time="2024-01-01T00:00:00Z",
+                end_time="2024-01-01T01:00:00Z",
+                airport="A1",
+                drone_id="D1",
+            )
+            self.track = DefectTrack.objects.create(
+                batch=self.batch,
+                disease_type=DiseaseType.objects.create(name="裂缝"),
+                unique_code="TRK1",
+                start_frame=0,
+                end_frame=20,
+            )
+        self.scope = versions.batch_scope(self.batch.id)
+
+    def frame(self, i):
+        return GroundTruthFrame(
+            track=self.track,
+            batch=self.batch,
+            frame_index=i,
+            bbox_x=0.1,
+            bbox_y=0.2,
+            bbox_width=0.3,
+            bbox_height=0.4,
+        )
+
+    def test_writes_invalidate_once_on_commit(self):
+        OverlayCache.objects.create(batch=self.batch, version=1, variant="json", content=b"{}")
+        version = versions.current(self.scope)
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertNumQueries(1):
+                self.frame(0).save()
+            frame = GroundTruthFrame.objects.select_related("track").get()
+            frame.bbox_x = 0.5
+            with self.assertNumQueries(1):
+                frame.save()
+            self.track.end_frame = 21
+            self.track.save()
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(versions.current(self.scope), version)
+        self.assertTrue(OverlayCache.objects.exists())
+
+        callbacks[0]()
+        self.assertGreater(versions.current(self.scope), version)
+        self.assertFalse(OverlayCache.objects.exists())
+
+    def test_bulk_writes_invalidate_once_on_commit(self):
+        GroundTruthFrame.objects.bulk_create(self.frame(i) for i in range(5))
+        OverlayCache.objects.create(batch=self.batch, version=1, variant="json", content=b"{}")
+        version = versions.current(self.scope)
+        with self.captureOnCommitCallbacks() as callbacks:
+            trackdata.pack_batch(self.batch.id, chunk_size=2)
+            signals.bulk_changed(self.batch.id)
+        self.assertEqual(len(callbacks), 1)
+        self.assertTrue(OverlayCache.objects.exists())
+
+        callbacks[0]()
+        self.assertGreater(versions.current(self.scope), version)
+        self.assertFalse(OverlayCache.objects.exists())
+
+    def test_track_delete_does_not_scale_with_frames(self):
+        counts = []
+        for frames in (2, 40):
+            with self.captureOnCommitCallbacks(execute=True):
+                GroundTruthFrame.objects.bulk_create(self.frame(i) for i in range(frames))
+            with self.captureOnCommitCallbacks(execute=True):
+                with CaptureQueriesContext(connection) as queries:
+                    DefectTrack.objects.filter(pk=self.track.pk).delete()
+            counts.append(len(queries))
+            with self.captureOnCommitCallbacks(execute=True):
+                self.track.pk = None
+                self.track.save()
+        self.assertEqual(counts[0], counts[1])
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        self.dtype = DiseaseType.objects.create(name="裂缝")
+        self.batch = DetectionBatch.objects.create(
+            start_time="2024-01-01T00:00:00Z",
+            end_time="2024-01-01T01:00:00Z",
+            airport="A1",
+            drone_id="D1",
+        )
+        self.other = DetectionBatch.objects.create(
+            start_time="2024-01-02T00:00:00Z",
+            end_time="2024-01-02T01:00:00Z",
+            airport="A2",
+            drone_id="D2",
+        )
+
+    def test_all_apis_answer_not_modified(self):
+        for name in (
+            "stats",
+            "disease_type_stats",
+            "batches",
+            "anomaly_boxes",
+            "defect_tracks",
+            "current_weather",
+        ):
+            resp = self.client.get(reverse(name))
+            self.assertIn("ETag", resp, name)
+            self.assertNotIn("Last-Modified", resp, name)
+            with self.assertNumQueries(1):
+                cached = self.client.get(reverse(name), HTTP_IF_NONE_MATCH=resp["ETag"])
+            self.assertEqual(cached.status_code, 304, name)
+
+    def test_if_modified_since_never_answers_stale(self):
+        url = reverse("defect_tracks")
+        since = http_date(time.time() + 60)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=since).status_code, 200)
+        DefectTrack.objects.create(
+            batch=self.batch,
+            disease_type=self.dtype,
+            unique_code="T1",
+            start_frame=1,
+            end_frame=2,
+        )
+        resp = self.client.get(url, HTTP_IF_MODIFIED_SINCE=since)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.json()["tracks"]), 1)
+
+    def test_batch_scoped_etag(self):
+        url = reverse("defect_tracks")
+        etag = self.client.get(url, {"batch": self.batch.id})["ETag"]
+        global_etag = self.client.get(reverse("stats"))["ETag"]
+        DefectTrack.objects.create(
+            batch=self.other,
+            disease_type=self.dtype,
+            unique_code="T1",
+            start_frame=1,
+            end_frame=2,
+        )
+        resp = self.client.get(url, {"batch": self.batch.id}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client.get(reverse("stats"), HTTP_IF_NONE_MATCH=global_etag)
+        self.assertEqual(resp.status_code, 200)
+
+        DefectTrack.objects.create(
+            batch=self.batch,
+            disease_type=self.dtype,
+            unique_code="T2",
+            start_frame=1,
+            end_frame=2,
+        )
+        resp = self.client.get(url, {"batch": self.batch.id}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.json()["tracks"]), 1)
+
+    def test_dictionary_write_changes_batch_etag(self):
+        url = reverse("anomaly_boxes")
+        etag = self.client.get(url, {"batch": self.batch.id})["ETag"]
+        self.dtype.name = "坑槽"
+        self.dtype.save()
+        resp = self.client.get(url, {"batch": self.batch.id}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+
+
+class ApiResponseCacheTest(TestCase):
+    def setUp(self):
+        caches["api"].clear()
+        reset_cache_stats()
+        self.dtype = DiseaseType.objects.create(name="裂缝")
+        self.batches = [
+            DetectionBatch.objects.create(
+                start_time=f"2024-01-0{i}T00:00:00Z",
+                end_time=f"2024-01-0{i}T01:00:00Z",
+                airport=f"A{i}",
+                drone_id=f"D{i}",
+            )
+            for i in (1, 2)
+        ]
+
+    def counts(self, endpoint):
+        data = self.client.get(reverse("api_cache_stats")).json()
+        return data["endpoints"].get(endpoint, {"hits": 0, "misses": 0})
+
+    def test_hits_and_targeted_invalidation(self):
+        url = reverse("defect_tracks")
+        for batch in self.batches:
+            self.client.get(url, {"batch": batch.id})
+            self.client.get(url, {"batch": batch.id})
+        self.client.get(reverse("stats"))
+        self.assertEqual(self.counts("tracks"), {"hits": 2, "misses": 2})
+
+        DefectTrack.objects.create(
+            batch=self.batches[0],
+            disease_type=self.dtype,
+            unique_code="T1",
+            start_frame=1,
+            end_frame=2,
+        )
+        resp = self.client.get(url, {"batch": self.batches[0].id})
+        self.assertEqual(len(resp.json()["tracks"]), 1)
+        self.client.get(url, {"batch": self.batches[1].id})
+        self.assertEqual(self.counts("tracks"), {"hits": 3, "misses": 3})
+
+        data = self.client.get(reverse("stats")).json()
+        self.assertEqual(data["pending_count"], 1)
+        self.assertEqual(self.counts("stats"), {"hits": 0, "misses": 2})
+
+    @override_settings(API_CACHE_TTLS={"stats": 0})
+    def test_disabled_endpoint(self):
+        self.client.get(reverse("stats"))
+        self.client.get(reverse("stats"))
+        self.assertEqual(self.counts("stats"), {"hits": 0, "misses": 0})
+
+    def test_large_bodies_are_not_cached(self):
+        url = reverse("defect_tracks")
+        params = {"batch": self.batches[0].id}
+        size = len(self.client.get(url, params).content)
+        with override_settings(API_CACHE_MAX_BODY=size - 1):
+            caches["api"].clear()
+            self.client.get(url, params)
+            self.client.get(url, params)
+        self.assertEqual(self.counts("tracks"), {"hits": 0, "misses": 3})
+        self.client.get(url, params)
+        self.client.get(url, params)
+        self.assertEqual(self.counts("tracks"), {"hits": 1, "misses": 4})
+
+
+@override_settings(API_CACHE_TTLS={})
+class QueryPlanTest(TestCase):
+    """Run ``EXPLAIN QUERY PLAN`` on every query issued by the dashboard
+    APIs and fail on full scans or temporary sorts of the fact tables.
+
+    Requests mirror what the dashboard sends: boxes and tracks are always
+    scoped to a batch.
+    """
+
+    HOT_TABLES = (
+        "detection_batch",
+        "defect_track",
+        "ground_truth_frame",
+        "disease_media",
+        "packed_track_frames",
+    )
+
+    # ``(table, plan detail)`` pairs accepted on purpose.
+    ALLOWED = {
+        # Filtering the rollup by airport or day leaves the rows out of
+        # disease-type order; the GROUP BY tree holds one entry per type.
+        ("disease_daily_rollup", "USE TEMP B-TREE FOR GROUP BY"),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        dtype = DiseaseType.objects.create(name="裂缝")
+        mtype = MediaType.objects.create(name="图片", code="image")
+        for b in range(3):
+            batch = DetectionBatch.objects.create(
+                start_time=f"2024-01-0{b + 1}T00:00:00Z",
+                end_time=f"2024-01-0{b + 1}T01:00:00Z",
+                airport="A1",
+                drone_id="D1",
+                status="processing",
+                total_frames=300,
+                video_duration=10,
+            )
+            for t in range(3):
+                track = DefectTrack.objects.create(
+                    batch=batch,
+                    disease_type=dtype,
+                    unique_code=f"P{b}-{t}",
+                    start_frame=t * 10,
+                    end_frame=t * 10 + 4,
+                    develop_trend="已修复" if t else "",
+                )
+                DiseaseMedia.objects.create(
+                    defect_track=track, media_type=mtype, file_link=f"/media/{b}{t}.jpg"
+                )
+                for f in range(t * 10, t * 10 + 5):
+                    GroundTruthFrame.objects.create(
+                        track=track,
+                        frame_index=f,
+                        time=f / 30,
+                        bbox_x=0.1,
+                        bbox_y=0.2,
+                        bbox_width=0.3,
+                        bbox_height=0.4,
+                    )
+        cls.batch = batch
+
+    def assert_plans(self, url, params=None):
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(url, params or {})
+            if resp.streaming:
+                b"".join(resp.streaming_content)
+        self.assertEqual(resp.status_code, 200)
+        with connection.cursor() as cursor:
+            for query in ctx.captured_queries:
+                sql = query["sql"]
+                if not sql.lstrip().upper().startswith("SELECT"):
+                    continue
+                # Subqueries name their tables by Django aliases such as U0.
+                aliases = dict(
+                    (alias, table) for table, alias in re.findall(r'"(\w+)" (U\d+|T\d+)\b', sql)
+                )
+                tables = set(re.findall(r'FROM "(\w+)"', sql))
+                cursor.execute("EXPLAIN QUERY PLAN " + sql)
+                for detail in (row[-1] for row in cursor.fetchall()):
+                    words = detail.split()
+                    if "TEMP B-TREE" in detail:
+                        allowed = any((table, detail) in self.ALLOWED for table in tables)
+                        self.assertTrue(allowed, f"{url}: {detail}: {sql}")
+                    if words[:1] == ["SCAN"]:
+                        table = aliases.get(words[1], words[1])
+                        if table in self.HOT_TABLES:
+                            self.assertIn("INDEX", detail, f"{url}: {sql}")
+
+    def test_dashboard_query_plans(self):
+        batch = {"batch": self.batch.id}
+        self.assert_plans(reverse("stats"))
+        self.assert_plans(reverse("stats"), batch)
+        self.assert_plans(reverse("disease_type_stats"))
+        self.assert_plans(reverse("disease_type_stats"), {"since": "2024-01-02", "airport": "A1"})
+        self.assert_plans(reverse("batches"))
+        self.assert_plans(reverse("anomaly_boxes"), batch)
+        self.assert_plans(reverse("anomaly_boxes"), {**batch, "t0": 0, "t1": 10})
+        self.assert_plans(reverse("anomaly_boxes"), {**batch, "format": "columnar", "t0": 0, "t1": 10})
+        self.assert_plans(reverse("anomaly_boxes"), {**batch, "stream": 1})
+        self.assert_plans(reverse("defect_tracks"), batch)
+        self.assert_plans(reverse("current_weather"))
+
+    def test_cached_overlay_query_plans(self):
+        self.batch.status = "done"
+        self.batch.save()
+        self.assert_plans(reverse("anomaly_boxes"), {"batch": self.batch.id})
+        self.assert_plans(reverse("anomaly_boxes"), {"batch": self.batch.id})
+
+
+class SqliteProfileTest(TestCase):
+    def test_performance_pragmas_enable_wal(self):
+        profile = settings.SQLITE_PROFILES["performance"]
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = sqlite3.connect(str(Path(tmp) / "profile.sqlite3"))
+            try:
+                db.apply_pragmas(conn.cursor(), profile["pragmas"])
+                self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+                self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 1)
+                self.assertEqual(conn.execute("PRAGMA busy_timeout").fetchone()[0], 5000)
+            finally:
+                conn.close()
+
+    def test_bench_command_reports_each_profile(self):
+        out = StringIO()
+        call_command("bench_sqlite", duration=0.2, readers=2, rows=1000, stdout=out)
+        for name in settings.SQLITE_PROFILES:
+            self.assertIn(f"[{name}]", out.getvalue())
+        self.assertIn("lock_errors=", out.getvalue())
+
+
+class GenerateDemoDataTest(TestCase):
+    def test_rendering_memory_does_not_grow_with_duration(self):
+        from web.management.commands.generate_demo_data import Command
+
+        width, height = 640, 360
+        with tempfile.TemporaryDirectory() as tmp:
+            tracemalloc.start()
+            try:
+                Command()._generate_demo_video_with_defects(
+                    Path(tmp) / "video.mp4", duration=6, fps=10, width=width, height=height
+                )
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        # 60 frames are rendered; only a handful may be alive at any time.
+        self.assertLess(peak, 4 * width * height * 3)
+
+    def test_snapshots_written_in_render_pass(self):
+        with tempfile.TemporaryDirectory() as tmp, override_settings(MEDIA_ROOT=tmp, DEMO_DAYS=2):
+            call_command(
+                "generate_demo_data", "--duration=2", "--fps=5", "--resolution=320x180",
+                stdout=StringIO(),
+            )
+            self.assertTrue((Path(tmp) / "demo" / "demo_video.mp4").exists())
+            self.assertEqual(DetectionBatch.objects.count(), 2)
+            for batch in DetectionBatch.objects.all():
+                self.assertEqual(batch.total_frames, 10)
+            links = DiseaseMedia.objects.values_list("file_link", flat=True)
+            self.assertTrue(links)
+            for link in links:
+                self.assertTrue((Path(tmp) / link.removeprefix("/media/")).exists(), link)
+
+    def test_one_cropped_snapshot_per_track(self):
+        import imageio
+
+        with tempfile.TemporaryDirectory() as tmp, override_settings(MEDIA_ROOT=tmp, DEMO_DAYS=2):
+            call_command(
+                "generate_demo_data", "--duration=2", "--fps=5", "--resolution=960x540",
+                "--workers=0", stdout=StringIO(),
+            )
+            self.assertEqual(DiseaseMedia.objects.count(), DefectTrack.objects.count())
+            for track in DefectTrack.objects.prefetch_related("media"):
+                (media,) = track.media.all()
+                self.assertEqual(media.file_link, track.snapshot_link)
+            for link in set(DiseaseMedia.objects.values_list("file_link", flat=True)):
+                img = imageio.imread(Path(tmp) / link.removeprefix("/media/"))
+                self.assertLessEqual(max(img.shape[:2]), SNAPSHOT_SIZE)
+                self.assertLess(img.shape[0] * img.shape[1], 960 * 540 / 4)
+
+    def test_scaled_bulk_load_keeps_derived_data_consistent(self):
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as tmp, override_settings(MEDIA_ROOT=tmp, DEMO_DAYS=2):
+            call_command(
+                "generate_demo_data", "--duration=2", "--fps=5", "--resolution=320x180",
+                "--scale=3", "--batch-size=7", "--workers=2", stdout=out,
+            )
+        self.assertEqual(DetectionBatch.objects.count(), 6)
+        # Every day references the same content-addressed snapshot files.
+        links = set(DiseaseMedia.objects.values_list("file_link", flat=True))
+        self.assertLess(len(links) * 6, DiseaseMedia.objects.count() + 1)
+        self.assertTrue(all(link.startswith("/media/snapshots/") for link in links))
+        self.assertRegex(out.getvalue(), r"Loaded \d+ rows in .* rows/s")
+        self.assertFalse(GroundTruthFrame.objects.filter(batch__isnull=True).exists())
+        self.assertEqual(DiseaseMedia.objects.count(), DefectTrack.objects.count())
+        stats = StatsCounter.objects.get(key="global")
+        self.assertEqual(stats.inspection_count, 6)
+        self.assertEqual(stats.defect_count, DefectTrack.objects.count())
+        self.assertEqual(
+            sum(DiseaseDailyRollup.objects.values_list("count", flat=True)),
+            DefectTrack.objects.count(),
+        )
+
+    def test_keyframe_load_stores_packed_tracks(self):
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as tmp, override_settings(MEDIA_ROOT=tmp, DEMO_DAYS=2):
+            call_command(
+                "generate_demo_data", "--duration=2", "--fps=10", "--resolution=320x180",
+                "--workers=0", "--keyframe-iou=0.9", stdout=out,
+            )
+        self.assertFalse(GroundTruthFrame.objects.exists())
+        self.assertEqual(PackedTrackFrames.objects.count(), DefectTrack.objects.count())
+        self.assertRegex(out.getvalue(), r"Keyframes: \d+ of \d+ boxes stored per batch")
+        batch = DetectionBatch.objects.first()
+        frames = self.client.get(reverse("anomaly_boxes"), {"batch": batch.id}).json()["frames"]
+        self.assertEqual(
+            sum(len(frame["boxes"]) for frame in frames),
+            sum(PackedTrackFrames.objects.filter(track__batch=batch).values_list("frame_count", flat=True)),
+        )
+
+
+class SnapshotStoreTest(TestCase):
+    def test_identical_frames_are_stored_once(self):
+        frame = np.zeros((48, 64, 3), np.uint8)
+        other = np.full((48, 64, 3), 200, np.uint8)
+        with tempfile.TemporaryDirectory() as tmp:
+            with SnapshotStore(tmp, "/media/snapshots", workers=0) as store:
+                store.put("a", frame)
+                store.put("b", frame)
+                store.put("c", other)
+            self.assertEqual(store.urls["a"], store.urls["b"])
+            self.assertNotEqual(store.urls["a"], store.urls["c"])
+            self.assertEqual((store.files, store.duplicates), (2, 1))
+            self.assertEqual(len(list(Path(tmp).rglob("*.jpg"))), 2)
+            self.assertTrue(store.urls["a"].startswith("/media/snapshots/"))
+
+    def test_best_view_is_largest_then_most_central_box(self):
+        frame = np.arange(100 * 200 * 3, dtype=np.uint8).reshape(100, 200, 3)
+        boxes = [
+            (1, (0.0, 0.0, 0.2, 0.2)),
+            (1, (0.4, 0.4, 0.2, 0.2)),   # same area, central: best
+            (1, (-0.1, 0.4, 0.2, 0.2)),  # partly outside the frame
+            (2, (0.9, 0.9, 0.2, 0.2)),
+            (2, (0.7, 0.7, 0.2, 0.2)),   # best
+            (2, (0.1, 0.1, 0.1, 0.1)),
+        ]
+        views = BestViews(margin=0.5)
+        for frame_index, (track, bbox) in enumerate(boxes):
+            views.offer(track, frame_index, frame, bbox)
+        self.assertEqual({k: v[0] for k, v in views.views.items()}, {1: 1, 2: 4})
+        tracks, bbox = zip(*boxes)
+        self.assertEqual(best_boxes(np.array(tracks), np.array(bbox)).tolist(), [1, 4])
+        # 0.2 x 0.2 box plus half its size on each side, clipped to the frame.
+        self.assertEqual(views.views[1][2].shape, (40, 80, 3))
+        self.assertEqual(crop(frame, (0.7, 0.7, 0.2, 0.2), 0.5).shape, (40, 80, 3))
+        self.assertEqual(crop(frame, (0.9, 0.9, 0.2, 0.2), 0.5).shape, (20, 40, 3))
+
+    def test_snapshots_are_downscaled(self):
+        import imageio
+
+        frame = np.full((600, 1000, 3), 90, np.uint8)
+        with tempfile.TemporaryDirectory() as tmp:
+            with SnapshotStore(tmp, "/media/snapshots", workers=0, max_size=100) as store:
+                store.put("a", frame)
+            (path,) = Path(tmp).rglob("*.jpg")
+            self.assertEqual(imageio.imread(path).shape, (60, 100, 3))
+
+
+class RoadRendererTest(TestCase):
+    def setUp(self):
+        np.random.seed(7)
+        self.width, self.height, self.fps = 640, 360, 10
+        self.defects = synth.random_defects(6, self.width, self.height)
+
+    def test_interval_index_matches_linear_scan(self):
+        index = synth.IntervalIndex(
+            [d["start"] for d in self.defects], [d["end"] for d in self.defects]
+        )
+        for t in np.linspace(0, 6, 241):
+            expected = [i for i, d in enumerate(self.defects) if d["start"] <= t <= d["end"]]
+            self.assertEqual(index.active(t).tolist(), expected)
+
+    def test_matches_reference_renderer(self):
+        renderer = synth.RoadRenderer(self.defects, self.width, self.height, self.fps)
+        reference = synth.reference_frames(self.defects, self.width, self.height, self.fps, 60)
+        for t, ref_img, ref_labels in reference:
+            img, labels = renderer.render(t)
+            self.assertEqual(labels, ref_labels)
+            if (t * synth.SCROLL_SPEED) % synth.DASH_PERIOD == 0:
+                # The reference mis-draws the dash straddling the top edge once scrolled.
+                np.testing.assert_array_equal(img, ref_img)
+
+    def test_background_is_a_view(self):
+        renderer = synth.RoadRenderer([], self.width, self.height, self.fps)
+        img, labels = renderer.render(3)
+        self.assertEqual(labels, [])
+        self.assertTrue(np.shares_memory(img, renderer.background(0)))
+        self.assertFalse(img.flags.writeable)
+
+
+class PurgeBatchesTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.settings_override = override_settings(MEDIA_ROOT=self.tmp.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+        dtype = DiseaseType.objects.create(name="裂缝")
+        mtype = MediaType.objects.create(name="图片", code="image")
+        weather = WeatherType.objects.create(name="晴天", code="sunny")
+        for name in ("shared.jpg", "only1.jpg"):
+            (Path(self.tmp.name) / name).write_bytes(b"jpg")
+        self.batches = []
+        for b in range(2):
+            batch = DetectionBatch.objects.create(
+                start_time="2024-01-01T00:00:00Z",
+                end_time="2024-01-01T01:00:00Z",
+                airport=f"A{b}",
+                drone_id="D1",
+                weather=weather,
+            )
+            self.batches.append(batch)
+            for t in range(3):
+                track = DefectTrack.objects.create(
+                    batch=batch,
+                    disease_type=dtype,
+                    unique_code=f"P{b}-{t}",
+                    start_frame=0,
+                    end_frame=2,
+                    develop_trend="已修复" if t == 0 else "",
+                )
+                links = ["/media/shared.jpg"] + (["/media/only1.jpg"] if b == 0 else [])
+                for link in links:
+                    DiseaseMedia.objects.create(defect_track=track, media_type=mtype, file_link=link)
+                for i in range(3):
+                    GroundTruthFrame.objects.create(
+                        track=track, frame_index=i, bbox_x=0, bbox_y=0, bbox_width=0.1, bbox_height=0.1
+                    )
+
+    def test_purge_one_batch_keeps_the_other_consistent(self):
+        deletes = []
+        receiver = lambda sender, **kwargs: deletes.append(sender)
+        post_delete.connect(receiver)
+        self.addCleanup(post_delete.disconnect, receiver)
+        purged, kept = self.batches
+
+        with self.captureOnCommitCallbacks(execute=True):
+            deleted, removed = purge_batches([purged.id], chunk_size=2)
+
+        tree = {DetectionBatch, DefectTrack, DiseaseMedia, GroundTruthFrame}
+        self.assertFalse(tree & set(deletes), "purge must not go through the ORM collector")
+        self.assertEqual(deleted["ground_truth_frame"], 9)
+        self.assertEqual(deleted["disease_media"], 6)
+        self.assertEqual(deleted["defect_track"], 3)
+        self.assertEqual(list(DetectionBatch.objects.values_list("pk", flat=True)), [kept.id])
+        self.assertEqual(GroundTruthFrame.objects.count(), 9)
+        self.assertEqual(removed, ["/media/only1.jpg"])
+        self.assertTrue((Path(self.tmp.name) / "shared.jpg").exists())
+
+        counted = {c.key: c for c in StatsCounter.objects.all()}
+        rollup = list(DiseaseDailyRollup.objects.values_list("airport", "count"))
+        call_command("rebuild_counters", stdout=StringIO())
+        call_command("backfill_rollups", stdout=StringIO())
+        for key, counter in StatsCounter.objects.in_bulk().items():
+            self.assertEqual(
+                (counted[key].inspection_count, counted[key].defect_count, counted[key].completed_count),
+                (counter.inspection_count, counter.defect_count, counter.completed_count),
+            )
+        self.assertEqual(rollup, list(DiseaseDailyRollup.objects.values_list("airport", "count")))
+
+    def test_command_purges_everything_and_reports_progress(self):
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("purge_batches", "--all", "--chunk-size=4", stdout=out)
+        self.assertFalse(DetectionBatch.objects.exists())
+        self.assertFalse(GroundTruthFrame.objects.exists())
+        self.assertFalse(any(Path(self.tmp.name).iterdir()))
+        self.assertIn("ground_truth_frame: 4 rows deleted", out.getvalue())
+        self.assertIn("Purged 2 batches", out.getvalue())
+        self.assertEqual(self.client.get(reverse("stats")).json()["inspection_count"], 0)
+
+    def test_command_requires_a_selection(self):
+        with self.assertRaises(CommandError):
+            call_command("purge_batches", stdout=StringIO())
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.settings_override = override_settings(ARCHIVE_ROOT=self.tmp.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+        dtype = DiseaseType.objects.create(name="裂缝")
+        self.batch = DetectionBatch.objects.create(
+            start_time="2024-01-01T00:00:00Z",
+            end_time="2024-01-01T01:00:00Z",
+            airport="A1",
+            drone_id="D1",
+            video_link="/media/demo.mp4",
+            total_frames=30,
+            video_duration=1,
+            status="done",
+            expire_at="2024-02-01T00:00:00Z",
+        )
+        for n in range(2):
+            track = DefectTrack.objects.create(
+                batch=self.batch,
+                disease_type=dtype,
+                unique_code=f"ARC{n}",
+                start_frame=n,
+                end_frame=n + 5,
+            )
+            for i in range(n, n + 6):
+                GroundTruthFrame.objects.create(
+                    track=track,
+                    frame_index=i,
+                    time=i / 30 if i % 4 else None,
+                    bbox_x=0.1 * n + 0.01 * i,
+                    bbox_y=0.2,
+                    bbox_width=0.3,
+                    bbox_height=0.4,
+                )
+
+    def payloads(self):
+        url = reverse("anomaly_boxes")
+        batch = {"batch": self.batch.id}
+        return [
+            self.client.get(url, batch).content,
+            self.client.get(url, {**batch, "format": "columnar"}).content,
+            b"".join(self.client.get(url, {**batch, "stream": "1"}).streaming_content),
+            self.client.get(url, {**batch, "from_frame": 2, "to_frame": 3}).content,
+            self.client.get(url, {**batch, "t0": 0.1, "t1": 0.15, "stream": "1"}).getvalue(),
+            self.client.get(reverse("defect_tracks"), batch).content,
+        ]
+
+    def test_archived_batch_replays_identically(self):
+        before = self.payloads()
+        out = StringIO()
+        call_command("archive_batches", "--chunk-size=5", stdout=out)
+
+        self.batch.refresh_from_db()
+        self.assertTrue(self.batch.is_archived)
+        self.assertFalse(GroundTruthFrame.objects.exists())
+        self.assertTrue(archive.archive_path(self.batch.id).exists())
+        self.assertIn("12 frames archived", out.getvalue())
+        self.assertEqual(self.payloads(), before)
+        self.assertEqual(archive.expired_batches(), [])
+
+    def test_purge_removes_archive_file(self):
+        archive.archive_batch(self.batch.id)
+        self.assertEqual(len(list(archive.iter_rows(self.batch.id))), 12)
+        path = archive.archive_path(self.batch.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            purge_batches([self.batch.id])
+        self.assertFalse(path.exists())
+
+    def test_rows_are_read_one_chunk_at_a_time(self):
+        rows, chunk_rows = 200_000, 5_000
+        frame_index = np.arange(rows, dtype="<u4")
+        chunks = (
+            trackdata.BatchColumns(
+                frame_index[start:start + chunk_rows],
+                np.full(chunk_rows, 0.5),
+                np.full(chunk_rows, 7, "<i8"),
+                np.full((chunk_rows, 4), 0.25),
+            )
+            for start in range(0, rows, chunk_rows)
+        )
+        path = archive.archive_path(self.batch.id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.assertEqual(archive.write_archive(path, chunks), rows)
+
+        tracemalloc.start()
+        try:
+            count = sum(1 for _ in archive.iter_rows(self.batch.id, {"frame_index__gte": 5000}))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(count, rows - 5000)
+        # The whole columns take 10 MB.
+        self.assertLess(peak, 4 << 20)
+
+        window = {"frame_index__gte": 100_000, "frame_index__lte": 100_001}
+        self.assertEqual(
+            list(archive.iter_rows(self.batch.id, window)),
+            [(100_000, 0.5, 7, 0.25, 0.25, 0.25, 0.25), (100_001, 0.5, 7, 0.25, 0.25, 0.25, 0.25)],
+        )
+
+    def test_format_1_archives_are_still_read(self):
+        columns = overlay.batch_columns(self.batch.id)
+        path = archive.archive_path(self.batch.id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as fh:
+            np.savez_compressed(fh, format=np.array(1), **columns._asdict())
+        self.assertEqual(
+            list(archive.iter_rows(self.batch.id)),
+            list(trackdata.columns_to_rows(columns)),
+        )
+        self.assertTrue(archive.has_frames(self.batch.id))
+
+    def test_interrupted_archive_resumes_without_reexport(self):
+        archive.export_batch(self.batch.id)
+        DetectionBatch.objects.filter(pk=self.batch.id).update(is_archived=True)
+        archived, deleted = archive.archive_batch(self.batch.id, chunk_size=5)
+        self.assertEqual((archived, deleted), (0, 12))
+        self.assertEqual(len(list(archive.iter_rows(self.batch.id))), 12)
+
+
+class TrackDataTest(TestCase):
+    def setUp(self):
+        dtype = DiseaseType.objects.create(name="坑槽")
+        self.batch = DetectionBatch.objects.create(
+            start_time="2024-01-01T00:00:00Z",
+            end_time="2024-01-01T01:00:00Z",
+            airport="A1",
+            drone_id="D1",
+            video_link="/media/demo.mp4",
+            total_frames=30,
+            video_duration=1,
+            status="done",
+        )
+        for n in range(3):
+            track = DefectTrack.objects.create(
+                batch=self.batch,
+                disease_type=dtype,
+                unique_code=f"PK{n}",
+                start_frame=n,
+                end_frame=n + 7,
+            )
+            GroundTruthFrame.objects.bulk_create(
+                GroundTruthFrame(
+                    track=track,
+                    batch=self.batch,
+                    frame_index=i,
+                    time=i / 30 if i % 3 else None,
+                    bbox_x=round(0.1 * n + 0.01 * i, 2),
+                    bbox_y=0.25,
+                    bbox_width=0.3,
+                    bbox_height=0.125,
+                )
+                for i in range(n, n + 8)
+            )
+
+    def payloads(self):
+        url = reverse("anomaly_boxes")
+        batch = {"batch": self.batch.id}
+        return [
+            self.client.get(url, batch).content,
+            self.client.get(url, {**batch, "format": "columnar"}).content,
+            b"".join(self.client.get(url, {**batch, "stream": "1"}).streaming_content),
+            self.client.get(url, {**batch, "from_frame": 2, "to_frame": 4}).content,
+            self.client.get(url, {**batch, "t0": 0.1, "t1": 0.2, "stream": "1"}).getvalue(),
+            self.client.get(reverse("defect_tracks"), batch).content,
+        ]
+
+    def test_pack_round_trip_within_float32_tolerance(self):
+        rng = np.random.default_rng(1)
+        bbox = rng.random((50, 4))
+        frame_index = rng.permutation(50)
+        time = [None if f % 7 == 0 else f / 30 for f in frame_index]
+        frames = trackdata.unpack(trackdata.pack(frame_index, time, bbox))
+
+        order = np.argsort(frame_index)
+        self.assertEqual(frames.frame_index.tolist(), list(range(50)))
+        np.testing.assert_allclose(frames.bbox, bbox[order], atol=2e-7, rtol=0)
+        self.assertTrue(np.isnan(frames.time[0]))
+        self.assertEqual(frames.time[1], 1 / 30)
+        with self.assertRaises(ValueError):
+            trackdata.unpack(b"XXXX" + bytes(12))
+
+    def test_packed_batch_serves_identical_payloads(self):
+        before = self.payloads()
+        out = StringIO()
+        call_command("convert_frames", str(self.batch.id), "--to=packed", stdout=out)
+
+        self.assertFalse(GroundTruthFrame.objects.exists())
+        self.assertEqual(PackedTrackFrames.objects.count(), 3)
+        self.assertIn("Converted 3 tracks (24 frame rows)", out.getvalue())
+        self.assertEqual(self.payloads(), before)
+
+        trackdata.unpack_batch(self.batch.id)
+        self.assertFalse(PackedTrackFrames.objects.exists())
+        self.assertEqual(GroundTruthFrame.objects.filter(batch=self.batch).count(), 24)
+        self.assertEqual(self.payloads(), before)
+
+    def test_mixed_storage_and_archive(self):
+        before = self.payloads()
+        first = DefectTrack.objects.get(unique_code="PK0")
+        frames = trackdata.read_track(first.pk)
+        with mock.patch.object(trackdata, "DEFAULT_CHUNK_SIZE", 3), \
+                CaptureQueriesContext(connection) as ctx:
+            trackdata.write_track(first.pk, frames.frame_index, frames.time, frames.bbox)
+        deletes = [
+            q["sql"] for q in ctx.captured_queries
+            if q["sql"].startswith('DELETE FROM "ground_truth_frame"')
+        ]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(GroundTruthFrame.objects.count(), 16)
+        self.assertEqual(self.payloads(), before)
+
+        with tempfile.TemporaryDirectory() as root, override_settings(ARCHIVE_ROOT=root):
+            self.assertEqual(archive.archive_batch(self.batch.id), (24, 16))
+            self.assertFalse(PackedTrackFrames.objects.exists())
+            self.assertEqual(self.payloads(), before)
+
+    def test_iter_rows_merges_packed_tracks_lazily(self):
+        dtype = DiseaseType.objects.get(name="坑槽")
+        for n in range(3, 6):
+            track = DefectTrack.objects.create(
+                batch=self.batch,
+                disease_type=dtype,
+                unique_code=f"PK{n}",
+                start_frame=10 * n,
+                end_frame=10 * n + 3,
+            )
+            frames = range(10 * n, 10 * n + 4)
+            trackdata.write_track(
+                track.pk, frames, [f / 30 for f in frames], [[0.5, 0.5, 0.1, 0.1]] * 4
+            )
+        first = DefectTrack.objects.get(unique_code="PK1")
+        frames = trackdata.read_track(first.pk)
+        trackdata.write_track(first.pk, frames.frame_index, frames.time, frames.bbox)
+
+        windows = [None, {"frame_index__gte": 3, "frame_index__lte": 40}, {"time__lt": 0.2}]
+        expected = [
+            list(trackdata.columns_to_rows(trackdata.batch_columns(self.batch.id, window)))
+            for window in windows
+        ]
+        for window, rows in zip(windows, expected):
+            self.assertEqual(list(trackdata.iter_rows(self.batch.id, window)), rows)
+        self.assertEqual(
+            PackedTrackFrames.objects.get(track__unique_code="PK4").first_frame, 40
+        )
+        self.assertEqual(
+            PackedTrackFrames.objects.get(track__unique_code="PK4").last_frame, 43
+        )
+
+        # A frame window fetches only the BLOBs of the tracks it overlaps, once.
+        with CaptureQueriesContext(connection) as ctx:
+            list(trackdata.iter_rows(self.batch.id, {"frame_index__gte": 35}))
+        blobs = [q["sql"] for q in ctx.captured_queries if '"data"' in q["sql"]]
+        self.assertEqual(len(blobs), 2)
+        self.assertTrue(all("IN (" in sql for sql in blobs))
+
+        # Only tracks the merge has reached are decoded.
+        unpacked = []
+        unpack = trackdata.unpack
+        trackdata.unpack = lambda data: unpacked.append(data) or unpack(data)
+        self.addCleanup(setattr, trackdata, "unpack", unpack)
+        rows = trackdata.iter_rows(self.batch.id)
+        self.assertEqual(next(rows)[0], 0)
+        self.assertEqual(len(unpacked), 0)
+        self.assertEqual(next(row for row in rows if row[0] == 30)[0], 30)
+        self.assertEqual(len(unpacked), 2)
+
+        with tempfile.TemporaryDirectory() as root, override_settings(ARCHIVE_ROOT=root), \
+                mock.patch.object(archive, "ARCHIVE_CHUNK_ROWS", 5):
+            archive.archive_batch(self.batch.id)
+            for window, rows in zip(windows, expected):
+                self.assertEqual(list(archive.iter_rows(self.batch.id, window)), rows)
+
+    def synthetic_tracks(self, fps):
+        np.random.seed(7)
+        defects = synth.random_defects(4, 1920, 1080)
+        renderer = synth.RoadRenderer(defects, 1920, 1080, fps)
+        tracks = {}
+        for _, _, labels in renderer.frames(4 * fps):
+            for lab in labels:
+                tracks.setdefault(lab["track_id"], []).append(lab)
+        return tracks.values()
+
+    def test_keyframes_reproduce_boxes_within_iou_bound(self):
+        for min_iou in (0.95, 0.9, 0.8):
+            dense = stored = 0
+            for labels in self.synthetic_tracks(fps=60):
+                frame_index = [lab["frame_index"] for lab in labels]
+                time = [lab["time"] for lab in labels]
+                bbox = np.array(
+                    [[lab["bbox_x"], lab["bbox_y"], lab["bbox_width"], lab["bbox_height"]]
+                     for lab in labels]
+                )
+                data = trackdata.pack(frame_index, time, bbox, min_iou)
+                frames = trackdata.unpack(data)
+
+                self.assertEqual(frames.frame_index.tolist(), frame_index)
+                self.assertGreaterEqual(trackdata.box_iou(frames.bbox, bbox).min(), min_iou)
+                self.assertLessEqual(
+                    np.abs(frames.time - time).max(), trackdata.TIME_TOLERANCE
+                )
+                dense += len(frame_index)
+                stored += trackdata.stored_boxes(data)
+            self.assertGreaterEqual(dense / stored, 10, min_iou)
+
+    def test_keyframes_never_interpolate_across_gaps(self):
+        frame_index = [0, 1, 2, 3, 10, 11, 12]
+        bbox = [[0.1 * f, 0.2, 0.3, 0.4] for f in frame_index]
+        time = [f / 30 for f in frame_index]
+        data = trackdata.pack(frame_index, time, bbox, min_iou=0.99)
+        frames = trackdata.unpack(data)
+        self.assertEqual(trackdata.stored_boxes(data), 4)
+        self.assertEqual(frames.frame_index.tolist(), frame_index)
+        np.testing.assert_allclose(frames.bbox, bbox, atol=2e-7)
+
+    def test_keyframe_batch_serves_interpolated_boxes(self):
+        GroundTruthFrame.objects.filter(time__isnull=True).update(time=F("frame_index") / 30.0)
+        url = reverse("anomaly_boxes")
+        before = self.client.get(url, {"batch": self.batch.id}).json()
+        out = StringIO()
+        call_command(
+            "convert_frames", str(self.batch.id), "--to=keyframes", "--min-iou=0.99", stdout=out
+        )
+        self.assertFalse(GroundTruthFrame.objects.exists())
+        stored = trackdata.stored_boxes_of_batch(self.batch.id)
+        self.assertLess(stored, 24)
+        self.assertIn(f"{stored} boxes stored", out.getvalue())
+
+        after = self.client.get(url, {"batch": self.batch.id}).json()
+        self.assertEqual(after["video"], before["video"])
+        self.assertEqual(
+            [f["frame"] for f in after["frames"]], [f["frame"] for f in before["frames"]]
+        )
+        for old, new in zip(before["frames"], after["frames"]):
+            self.assertEqual(len(old["boxes"]), len(new["boxes"]))
+            for old_box, new_box in zip(old["boxes"], new["boxes"]):
+                for key, value in old_box.items():
+                    if isinstance(value, float):
+                        self.assertAlmostEqual(new_box[key], value, places=6)
+                    else:
+                        self.assertEqual(new_box[key], value)
+
+        # Exports are dense again.
+        trackdata.unpack_batch(self.batch.id)
+        self.assertEqual(GroundTruthFrame.objects.count(), 24)
+
+    def test_bench_command_compares_storage_modes(self):
+        out = StringIO()
+        call_command(
+            "bench_track_storage", "--batches=2", "--tracks=3", "--frames=20", "--repeat=1",
+            stdout=out,
+        )
+        self.assertIn("rows  :", out.getvalue())
+        self.assertIn("packed:", out.getvalue())
+
+
+class IngestAPITest(TestCase):
+    def setUp(self):
+        DiseaseType.objects.create(name="裂缝")
+        DiseaseType.objects.create(name="坑槽")
+        SeverityLevel.objects.create(name="轻度", code="low")
+        self.batch = DetectionBatch.objects.create(
+            start_time="2024-01-01T00:00:00Z",
+            end_time="2024-01-01T01:00:00Z",
+            airport="A1",
+            drone_id="D1",
+            status="processing",
+        )
+        self.token = IngestToken.objects.create(name="D1 edge", drone_id="D1")
+        self.url = reverse("ingest", args=[self.batch.id])
+
+    def lines(self, tracks=3, frames=1000):
+        return [
+            json.dumps(
+                {
+                    "track": t,
+                    "frame": f,
+                    "time": f / 30,
+                    "bbox": [0.1 * t, 0.001 * f, 0.05, 0.05],
+                    "label": "坑槽" if t else "裂缝",
+                    "severity": "low",
+                },
+                ensure_ascii=False,
+            )
+            for f in range(frames)
+            for t in range(tracks)
+        ]
+
+    def post(self, lines, compress=True, key=None, **headers):
+        body = "\n".join(lines).encode("utf-8")
+        if compress:
+            body = gzip.compress(body)
+            headers.setdefault("Content-Encoding", "gzip")
+        headers.setdefault("Authorization", f"Bearer {key or self.token.key}")
+        return self.client.post(
+            self.url, body, content_type="application/x-ndjson", headers=headers
+        )
+
+    def test_ingest_groups_tracks_and_retry_is_idempotent(self):
+        lines = self.lines()
+        resp = self.post(lines)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            resp.json(), {"lines": 3000, "frames": 3000, "duplicates": 0, "tracks": 3}
+        )
+        track = DefectTrack.objects.get(unique_code=ingest.track_code(self.batch.id, 2))
+        self.assertEqual((track.start_frame, track.end_frame), (0, 999))
+        self.assertAlmostEqual(track.end_time, 999 / 30)
+        self.assertEqual(track.disease_type.name, "坑槽")
+        self.assertEqual(track.severity.code, "low")
+        self.assertEqual(GroundTruthFrame.objects.filter(batch=self.batch).count(), 3000)
+        self.assertEqual(StatsCounter.objects.get(key="global").defect_count, 3)
+        self.assertEqual(sum(DiseaseDailyRollup.objects.values_list("count", flat=True)), 3)
+
+        # A retried upload, partly overlapping and partly new, stores only new frames.
+        retry = self.post(lines[1500:] + self.lines(frames=1002)[3000:], compress=False)
+        self.assertEqual(
+            retry.json(), {"lines": 1506, "frames": 6, "duplicates": 1500, "tracks": 0}
+        )
+        track.refresh_from_db()
+        self.assertEqual(track.end_frame, 1001)
+        self.assertEqual(StatsCounter.objects.get(key="global").defect_count, 3)
+
+        boxes = self.client.get(reverse("anomaly_boxes"), {"batch": self.batch.id}).json()
+        self.assertEqual(len(boxes["frames"]), 1002)
+
+    def test_failed_chunk_keeps_earlier_chunks(self):
+        lines = self.lines(tracks=1, frames=6)
+        lines[4] = '{"track": 0, "frame": 4, "bbox": [0.1, 0.2]}'
+        with self.assertRaises(ingest.IngestError) as ctx:
+            ingest.ingest(self.batch, iter(lines), chunk_size=2)
+        self.assertEqual(ctx.exception.line, 5)
+        self.assertEqual(ctx.exception.stats["frames"], 4)
+        self.assertEqual(GroundTruthFrame.objects.count(), 4)
+
+        resp = self.post(lines)
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json()["line"], 5)
+
+    def test_concurrent_first_upload_of_a_track(self):
+        lines = self.lines(tracks=1, frames=4)
+        new_track = ingest._Ingest._new_track
+
+        def racing(ingest_run, code, *args):
+            # Another upload stores the track after this one looked it up.
+            ingest._Ingest._new_track = new_track
+            ingest.ingest(self.batch, iter(lines[:2]))
+            return new_track(ingest_run, code, *args)
+
+        ingest._Ingest._new_track = racing
+        self.addCleanup(setattr, ingest._Ingest, "_new_track", new_track)
+        stats = ingest.ingest(self.batch, iter(lines))
+        self.assertEqual(stats, {"lines": 4, "frames": 2, "duplicates": 2, "tracks": 0})
+        self.assertEqual(DefectTrack.objects.get().end_frame, 3)
+        self.assertEqual(StatsCounter.objects.get(key="global").defect_count, 1)
+
+    def test_rejected_requests(self):
+        lines = self.lines(tracks=1, frames=2)
+        self.assertEqual(self.post(lines, Authorization="").status_code, 401)
+        self.assertEqual(self.post(lines, key="wrong").status_code, 401)
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+        self.assertEqual(self.post(lines, compress=False, **{"Content-Encoding": "br"}).status_code, 415)
+        self.assertEqual(self.post(["{not json"]).json()["error"], "invalid JSON")
+        self.assertEqual(self.post([json.dumps({**json.loads(lines[0]), "label": "?"})]).status_code, 400)
+
+        first = json.loads(lines[0])
+        for change in ({"label": ["x"]}, {"severity": ["x"]}, {"frame": 2**40}, {"track": "x" * 64}):
+            resp = self.post([lines[0], json.dumps({**first, **change})])
+            self.assertEqual(resp.status_code, 400, change)
+            self.assertEqual(resp.json()["line"], 2, change)
+
+        other = IngestToken.objects.create(name="D2 edge", drone_id="D2")
+        self.assertEqual(self.post(lines, key=other.key).status_code, 403)
+        self.batch.status = "done"
+        self.batch.save()
+        self.assertEqual(self.post(lines).status_code, 409)
+        self.assertFalse(GroundTruthFrame.objects.exists())
+
+
+class AnnotationInterchangeTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        crack = DiseaseType.objects.create(name="裂缝")
+        pothole = DiseaseType.objects.create(name="坑槽")
+        self.batch = DetectionBatch.objects.create(
+            start_time="2024-01-01T00:00:00Z",
+            end_time="2024-01-01T01:00:00Z",
+            airport="A1",
+            drone_id="D1",
+        )
+        for n, dtype in enumerate((crack, pothole, crack)):
+            track = DefectTrack.objects.create(
+                batch=self.batch,
+                disease_type=dtype,
+                unique_code=f"IO{n}",
+                start_frame=n,
+                end_frame=n + 9,
+            )
+            GroundTruthFrame.objects.bulk_create(
+                GroundTruthFrame(
+                    track=track,
+                    batch=self.batch,
+                    frame_index=i,
+                    time=round(i / 30, 3),
+                    bbox_x=0.1 * n + 0.01 * i,
+                    bbox_y=0.5 - 0.02 * i,
+                    bbox_width=0.125,
+                    bbox_height=0.0625,
+                )
+                for i in range(n, n + 10)
+            )
+
+    def path(self, name):
+        return str(Path(self.tmp.name) / name)
+
+    def boxes(self, batch):
+        tracks = dict(
+            DefectTrack.objects.filter(batch=batch)
+            .order_by("pk")
+            .values_list("pk", "disease_type__name")
+        )
+        numbers = {pk: n for n, pk in enumerate(tracks)}
+        return sorted(
+            (row[0], row[1], numbers[row[2]], tracks[row[2]], *np.round(row[3:], 6))
+            for row in overlay.iter_frame_rows(batch.pk)
+        )
+
+    def test_round_trip_through_both_formats(self):
+        expected = self.boxes(self.batch)
+        out = StringIO()
+        call_command("export_annotations", self.batch.id, self.path("a.json"), stdout=out)
+        call_command(
+            "export_annotations", self.batch.id, self.path("a.txt"), "--map=裂缝=3",
+            "--map=坑槽=4", stdout=out,
+        )
+        self.assertIn("Exported 30 boxes", out.getvalue())
+        self.assertEqual(
+            Path(self.path("a.txt")).read_text().splitlines()[0], "1,1,0,540,240,67.5,1,3,1"
+        )
+
+        out = StringIO()
+        call_command(
+            "import_annotations", self.path("a.json"), self.path("a.txt"), "--workers=2",
+            "--map=3=裂缝", "--map=4=坑槽", "--drone=D9", stdout=out,
+        )
+        self.assertRegex(out.getvalue(), r"Imported 60 boxes in 6 tracks from 2 files .* boxes/s")
+        coco, mot = DetectionBatch.objects.filter(drone_id="D9").order_by("pk")
+        self.assertEqual(self.boxes(coco), expected)
+        self.assertEqual(self.boxes(mot), expected)
+        track = DefectTrack.objects.filter(batch=mot).order_by("pk")[1]
+        self.assertEqual((track.start_frame, track.end_frame, track.end_time), (1, 10, 0.333))
+        self.assertEqual(StatsCounter.objects.get(key=f"batch:{mot.pk}").defect_count, 3)
+        self.assertEqual(sum(DiseaseDailyRollup.objects.values_list("count", flat=True)), 9)
+
+    def test_unknown_labels_need_mapping_or_creation(self):
+        Path(self.path("b.txt")).write_text("1,7,10,10,20,20,1,9,1\n2,7,12,10,20,20,1,9,1\n")
+        with self.assertRaisesMessage(CommandError, "unknown disease types: 9"):
+            call_command("import_annotations", self.path("b.txt"), "--workers=0")
+        self.assertEqual(DetectionBatch.objects.count(), 1)
+        call_command(
+            "import_annotations", self.path("b.txt"), "--workers=0", "--create-types",
+            stdout=StringIO(),
+        )
+        self.assertEqual(DefectTrack.objects.get(disease_type__name="9").frames.count(), 2)
+
+    def test_json_reader_handles_chunk_boundaries(self):
+        doc = {
+            "info": {"images": [0], "note": 'a "b" \\ ]}'},
+            "version": -2500.0,
+            "images": [{"id": i, "score": i * 1.25, "name": "图" * i} for i in range(50)],
+            "annotations": [],
+        }
+        text = json.dumps(doc, ensure_ascii=False, indent=1)
+        for chunk_size in (1, 3, 17, 4096):
+            reader = formats.JsonArrayReader(StringIO(text), chunk_size)
+            items = list(reader.items({"images", "annotations"}))
+            self.assertEqual(items, [("images", image) for image in doc["images"]])
+
+    def test_json_reader_skips_large_arrays_in_bounded_memory(self):
+        import time
+
+        annotation = json.dumps(
+            {"id": 1, "image_id": 1, "bbox": [1.5, 2, 3, 4], "note": 'a "quoted" \\ [note] {x}'}
+        )
+        path = self.path("large.json")
+        with open(path, "w", encoding="utf-8") as fh:
+            fh.write('{"annotations": [')
+            block = ", ".join([annotation] * 1000)
+            for i in range(200):  # about 20 MB
+                fh.write(("" if i == 0 else ", ") + block)
+            fh.write('], "info": "\\\"]}", "images": [{"id": 7}]}')
+
+        started = time.perf_counter()
+        tracemalloc.start()
+        try:
+            with open(path, encoding="utf-8") as fh:
+                items = list(formats.JsonArrayReader(fh, 1 << 16).items({"images"}))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(items, [("images", {"id": 7})])
+        self.assertLess(peak, 1 << 20)
+        self.assertLess(time.perf_counter() - started, 5)
+
+
+class DefectMatchingTest(TestCase):
+    def setUp(self):
+        self.crack = DiseaseType.objects.create(name="裂缝")
+        self.pothole = DiseaseType.objects.create(name="坑槽")
+
+    def batch(self, day, airport="A1"):
+        return DetectionBatch.objects.create(
+            start_time=f"2024-01-{day:02d}T00:00:00Z",
+            end_time=f"2024-01-{day:02d}T01:00:00Z",
+            airport=airport,
+            drone_id="D1",
+            total_frames=300,
+            video_duration=10,
+        )
+
+    def track(self, batch, code, dtype, x, size, first=0):
+        track = DefectTrack.objects.create(
+            batch=batch,
+            disease_type=dtype,
+            unique_code=code,
+            start_frame=first,
+            end_frame=first + 4,
+        )
+        GroundTruthFrame.objects.bulk_create(
+            GroundTruthFrame(
+                track=track,
+                batch=batch,
+                frame_index=i,
+                time=i / 30,
+                bbox_x=x,
+                bbox_y=0.4,
+                bbox_width=size,
+                bbox_height=size,
+            )
+            for i in range(first, first + 5)
+        )
+        return track
+
+    def trends(self, batch):
+        return dict(DefectTrack.objects.filter(batch=batch).values_list("unique_code", "develop_trend"))
+
+    def test_hungarian_matches_brute_force(self):
+        from itertools import permutations
+
+        rng = np.random.default_rng(3)
+        for n, m in [(1, 1), (3, 3), (4, 6), (6, 4), (5, 5)]:
+            cost = rng.random((n, m)).round(2)
+            rows, cols = matching.hungarian(cost)
+            self.assertEqual(len(rows), min(n, m))
+            self.assertEqual(len(set(cols.tolist())), len(cols))
+            if n <= m:
+                best = min(cost[range(n), p].sum() for p in permutations(range(m), n))
+            else:
+                best = min(cost[p, range(m)].sum() for p in permutations(range(n), m))
+            self.assertAlmostEqual(cost[rows, cols].sum(), best)
+
+    def test_components_split_candidate_graph(self):
+        rows, cols = np.array([0, 1, 1, 3]), np.array([0, 0, 2, 3])
+        row_labels, col_labels = matching.components(rows, cols, 4, 5)
+        self.assertEqual(row_labels.tolist(), [0, 0, 2, 3])
+        self.assertEqual(col_labels.tolist(), [0, 5, 0, 3, 8])
+
+    def test_match_defects_sets_trends_and_counters(self):
+        old = self.batch(1)
+        self.track(old, "OLD-A", self.crack, 0.1, 0.1)
+        self.track(old, "OLD-B", self.crack, 0.5, 0.1)
+        self.track(old, "OLD-C", self.pothole, 0.8, 0.1)
+        self.track(self.batch(2, airport="A2"), "OTHER", self.crack, 0.5, 0.1)
+        new = self.batch(3)
+        self.track(new, "NEW-A", self.crack, 0.1, 0.1)
+        self.track(new, "NEW-B", self.crack, 0.49, 0.13)
+        self.track(new, "NEW-C", self.crack, 0.8, 0.1)
+        self.track(new, "NEW-D", self.crack, 0.1, 0.1, first=100)
+
+        out = StringIO()
+        call_command("match_defects", "--all", stdout=out)
+        self.assertIn(f"Batch {new.pk} (previous: {old.pk}): 2 matched, 1 repaired", out.getvalue())
+        self.assertEqual(
+            self.trends(new),
+            {"NEW-A": "无变化", "NEW-B": "扩大", "NEW-C": "新增", "NEW-D": "新增"},
+        )
+        self.assertEqual(self.trends(old), {"OLD-A": "新增", "OLD-B": "新增", "OLD-C": "已修复"})
+        self.assertEqual(StatsCounter.objects.get(key=f"batch:{old.pk}").completed_count, 1)
+        self.assertEqual(StatsCounter.objects.get(key="global").completed_count, 1)
+
+        # Rerunning is idempotent and keeps the counters in step.
+        call_command("match_defects", str(new.pk), stdout=StringIO())
+        self.assertEqual(StatsCounter.objects.get(key="global").completed_count, 1)
+        self.assertEqual(self.client.get(reverse("stats")).json()["pending_count"], 7)
+
+    def test_rematch_reopens_tracks_that_now_match(self):
+        first, second, third = self.batch(1), self.batch(2), self.batch(3)
+        self.track(first, "A", self.crack, 0.1, 0.1)
+        moved = self.track(second, "B", self.crack, 0.6, 0.1)
+        self.track(third, "C", self.pothole, 0.3, 0.1)
+        for batch in (first, second, third):
+            matching.match_batch(batch.pk)
+        self.assertEqual(self.trends(first), {"A": "已修复"})
+        self.assertEqual(self.trends(second), {"B": "已修复"})
+        self.assertEqual(StatsCounter.objects.get(key="global").completed_count, 2)
+
+        # The track was mislocated; re-matching its batch finds A again.
+        GroundTruthFrame.objects.filter(track=moved).update(bbox_x=0.1)
+        result = matching.match_batch(second.pk)
+        self.assertEqual(result.pairs, [(moved.pk, DefectTrack.objects.get(unique_code="A").pk)])
+        self.assertEqual(self.trends(first), {"A": "新增"})
+        self.assertEqual(self.trends(second), {"B": "已修复"})
+        self.assertEqual(StatsCounter.objects.get(key=f"batch:{first.pk}").completed_count, 0)
+        self.assertEqual(StatsCounter.objects.get(key="global").completed_count, 1)
+
+    def test_thousands_of_tracks_match_in_seconds(self):
+        import time
+
+        rng = np.random.default_rng(5)
+        n = 3000
+        xy = rng.random((n, 2)) * 0.95
+        size = rng.uniform(0.01, 0.04, (n, 1))
+        start = rng.uniform(0, 600, n)
+        types = rng.integers(0, 4, n)
+        old = matching.TrackSummary(
+            np.arange(n), types, np.hstack([xy, size, size]), start, start + 2
+        )
+        order = rng.permutation(n)
+        jitter = rng.normal(0, 0.001, (n, 2))
+        new = matching.TrackSummary(
+            np.arange(n, 2 * n),
+            types[order],
+            np.hstack([xy[order] + jitter, size[order], size[order]]),
+            start[order] + 0.1,
+            start[order] + 2.1,
+        )
+
+        started = time.perf_counter()
+        pairs, trends, repaired = matching.match(new, old)
+        self.assertLess(time.perf_counter() - started, 10)
+        self.assertEqual(sorted(pairs), sorted(zip((n + np.arange(n)).tolist(), order.tolist())))
+        self.assertEqual(repaired, [])
+        self.assertNotIn(matching.NEW, trends.values())
+
+
+class DetectionEvaluationTest(TestCase):
+    def boxes(self, rows):
+        frame_index, track, label, score, *bbox = np.array(rows, np.float64).T
+        return evaluation.Boxes(
+            frame_index.astype(np.int64), track.astype(np.int64), label.astype(np.int64),
+            score, np.stack(bbox, 1),
+        )
+
+    def test_greedy_match_equals_sequential_greedy(self):
+        rng = np.random.default_rng(7)
+        for _ in range(20):
+            edges = rng.permutation([(g, p) for g in range(6) for p in range(6) if rng.random() < 0.4])
+            if not len(edges):
+                continue
+            used_gt, expected = set(), np.full(6, -1)
+            for g, p in edges:
+                if g not in used_gt and expected[p] < 0:
+                    used_gt.add(g)
+                    expected[p] = g
+            matched = evaluation.greedy_match(edges[:, 0], edges[:, 1], 6, 6)
+            self.assertEqual(matched.tolist(), expected.tolist())
+
+    def test_metrics_of_hand_made_tracks(self):
+        a, b = (0.1, 0.1, 0.2, 0.2), (0.6, 0.6, 0.2, 0.2)
+        gt = self.boxes([(f, 1, 1, 1, *a) for f in range(3)] + [(f, 2, 1, 1, *b) for f in range(3)])
+        pred = self.boxes([
+            (0, 10, 1, 0.9, *a), (1, 10, 1, 0.9, *a), (2, 11, 1, 0.9, *a),  # ID switch
+            (0, 20, 1, 0.9, *b), (1, 20, 1, 0.9, *b),  # frame 2 missed
+            (1, 30, 1, 0.1, 0.4, 0.4, 0.1, 0.1),  # false positive
+            (0, 40, 2, 0.9, *a),  # right box, wrong class
+        ])
+        metrics = evaluation.evaluate(gt, pred, {1: "裂缝", 2: "坑槽"})
+        self.assertEqual((metrics.gt_count, metrics.prediction_count), (6, 7))
+        self.assertAlmostEqual(metrics.precision, 5 / 7)
+        self.assertAlmostEqual(metrics.recall, 5 / 6)
+        # Recall 5/6 at precision 1: 84 of the 101 recall points.
+        self.assertAlmostEqual(metrics.map, 84 / 101)
+        self.assertAlmostEqual(metrics.per_class["裂缝"]["precision"], 5 / 6)
+        self.assertEqual(metrics.per_class["坑槽"]["precision"], 0)
+        self.assertEqual(metrics.id_switches, 1)
+        self.assertAlmostEqual(metrics.mota, 1 - (1 + 2 + 1) / 6)
+        self.assertAlmostEqual(metrics.idf1, 2 * 4 / 13)
+        self.assertAlmostEqual(metrics.motp, 1)
+
+    def test_command_scores_exported_labels_as_perfect(self):
+        crack = DiseaseType.objects.create(name="裂缝")
+        batch = DetectionBatch.objects.create(
+            start_time="2024-01-01T00:00:00Z",
+            end_time="2024-01-01T01:00:00Z",
+            airport="A1",
+            drone_id="D1",
+        )
+        for n in range(3):
+            track = DefectTrack.objects.create(
+                batch=batch, disease_type=crack, unique_code=f"EV{n}", start_frame=0, end_frame=9
+            )
+            GroundTruthFrame.objects.bulk_create(
+                GroundTruthFrame(
+                    track=track,
+                    batch=batch,
+                    frame_index=i,
+                    bbox_x=0.3 * n,
+                    bbox_y=0.02 * i,
+                    bbox_width=0.125,
+                    bbox_height=0.0625,
+                )
+                for i in range(10)
+            )
+        with tempfile.TemporaryDirectory() as tmp:
+            path = str(Path(tmp) / "pred.json")
+            call_command("export_annotations", str(batch.pk), path, stdout=StringIO())
+            out = StringIO()
+            call_command(
+                "evaluate_detections", str(batch.pk), "--model=yolo", f"--predictions={path}",
+                stdout=out,
+            )
+        self.assertIn("Stored 30 predictions", out.getvalue())
+        self.assertIn("mAP@[.5:.95] 1.000", out.getvalue())
+        result = ModelEvaluation.objects.get()
+        self.assertEqual((result.mota, result.idf1, result.id_switches), (1, 1, 0))
+        self.assertEqual(result.per_class["裂缝"]["recall"], 1)
+        self.assertEqual(result.report.batch_id, batch.pk)
+        self.assertIn("MOTA 1.000", result.report.content)
+
+        with self.assertRaisesMessage(CommandError, "no predictions of model 'ssd'"):
+            call_command("evaluate_detections", str(batch.pk), "--model=ssd")
+        purge_batches([batch.pk])
+        self.assertFalse(PredictionFrame.objects.exists())
+        self.assertFalse(ModelEvaluation.objects.exists())
+
+    def test_large_flight_evaluates_quickly(self):
+        import time
+
+        rng = np.random.default_rng(11)
+        frames, per_frame = 10000, 20
+        n = frames * per_frame
+        frame_index = np.repeat(np.arange(frames), per_frame)
+        track = np.tile(np.arange(per_frame), frames) + frame_index // 500 * per_frame
+        bbox = np.hstack([rng.random((n, 2)) * 0.9, rng.uniform(0.02, 0.08, (n, 2))])
+        gt = evaluation.Boxes(frame_index, track, track % 4, np.ones(n), bbox)
+        noisy = bbox + np.hstack([rng.normal(0, 0.002, (n, 2)), np.zeros((n, 2))])
+        pred = evaluation.Boxes(frame_index, track, track % 4, rng.random(n), noisy)
+
+        started = time.perf_counter()
+        metrics = evaluation.evaluate(gt, pred)
+        self.assertLess(time.perf_counter() - started, 20)
+        self.assertEqual(metrics.id_switches, 0)
+        self.assertGreater(metrics.mota, 0.99)
+        self.assertGreater(metrics.map50, 0.98)
+        self.assertLess(metrics.map, metrics.map50)
+
+
+class VideoIngestTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.settings_override = override_settings(MEDIA_ROOT=self.tmp.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        DiseaseType.objects.create(name="裂缝")
+        DiseaseType.objects.create(name="坑槽")
+
+    def render(self, width=960, height=540, fps=30, frames=60):
+        """Write a synthetic flight with two cracks and a pothole; return its labels."""
+        import imageio
+
+        travel = {"start_y": height + 75, "end_y": -75}
+        defects = [
+            dict(label="裂缝", shape="line", start=0.0, end=1.8, x=330, length=150,
+                 thickness=4, color=(30, 30, 30), **travel),
+            dict(label="裂缝", shape="line", start=0.3, end=2.0, x=560, length=150,
+                 thickness=4, color=(30, 30, 30), **travel),
+            dict(label="坑槽", shape="circle", start=0.1, end=1.9, x=450, size=60,
+                 color=(80, 80, 80), **travel),
+        ]
+        renderer = synth.RoadRenderer(defects, width, height, fps)
+        labels = []
+        path = Path(self.tmp.name) / "flight.mp4"
+        with imageio.get_writer(str(path), fps=fps, codec="libx264", bitrate="2M",
+                                macro_block_size=None) as writer:
+            for _, img, frame_labels in renderer.frames(frames):
+                writer.append_data(img)
+                labels.extend(frame_labels)
+        return labels
+
+    def test_tracker_follows_moving_boxes(self):
+        tracker = pipeline.IouTracker(min_iou=0.3, max_age=2, min_hits=2)
+        rows = []
+        for frame in range(6):
+            boxes = [(0.1, 0.8 - 0.04 * frame, 0.1, 0.1), (0.5 + 0.05 * frame, 0.5, 0.1, 0.1)]
+            labels = ["坑槽", "裂缝"]
+            if frame == 2:
+                boxes.append((0.8, 0.1, 0.05, 0.05))  # one-off false positive
+                labels.append("坑槽")
+            if frame == 3:
+                del boxes[0], labels[0]  # missed detection
+            rows += tracker.update(frame, detectors.Detections(np.array(boxes), labels, np.ones(3)))
+        tracks = {}
+        for track, frame, _, bbox, label, _ in rows:
+            tracks.setdefault((track, label), []).append(frame)
+        self.assertEqual(tracks, {("1", "坑槽"): [0, 1, 2, 4, 5], ("2", "裂缝"): list(range(6))})
+
+    def test_ingest_video_stores_tracks(self):
+        labels = self.render()
+        batch = DetectionBatch.objects.create(
+            start_time="2024-01-01T00:00:00Z",
+            end_time="2024-01-01T01:00:00Z",
+            airport="A1",
+            drone_id="D1",
+            video_link="/media/flight.mp4",
+            status="pending",
+        )
+        out = StringIO()
+        call_command("ingest_video", str(batch.pk), "--workers=1", "--snapshots", stdout=out)
+        self.assertRegex(out.getvalue(), r"Processed 60 frames in .*fps\): 3 tracks, \d+ boxes")
+        self.assertIn("Stored 3 track snapshots", out.getvalue())
+        batch.refresh_from_db()
+        self.assertEqual((batch.status, batch.total_frames, batch.video_duration), ("done", 60, 2.0))
+        self.assertEqual(
+            sorted(DefectTrack.objects.filter(batch=batch).values_list("disease_type__name", flat=True)),
+            ["坑槽", "裂缝", "裂缝"],
+        )
+        self.assertEqual(StatsCounter.objects.get(key=f"batch:{batch.pk}").defect_count, 3)
+
+        names = dict(DiseaseType.objects.values_list("name", "pk"))
+        truth = evaluation.Boxes(
+            np.array([row["frame_index"] for row in labels]),
+            np.array([row["track_id"] for row in labels]),
+            np.array([names[row["label"]] for row in labels]),
+            np.ones(len(labels)),
+            np.array([[row[k] for k in ("bbox_x", "bbox_y", "bbox_width", "bbox_height")]
+                      for row in labels]),
+        )
+        metrics = evaluation.evaluate(truth, evaluation.ground_truth(batch.pk))
+        self.assertGreater(metrics.recall, 0.8)
+        self.assertGreater(metrics.idf1, 0.8)
+
+        with self.assertRaisesMessage(CommandError, "already has defect tracks"):
+            call_command("ingest_video", str(batch.pk), "--workers=0")
+
+    def test_extract_snapshots_replaces_frame_images(self):
+        import imageio
+
+        labels = self.render()
+        batch = DetectionBatch.objects.create(
+            start_time="2024-01-01T00:00:00Z",
+            end_time="2024-01-01T01:00:00Z",
+            airport="A1",
+            drone_id="D1",
+            video_link="/media/flight.mp4",
+        )
+        image = MediaType.objects.create(name="图片", code="image")
+        frames_dir = Path(self.tmp.name) / "frames"
+        frames_dir.mkdir()
+        tracks = {}
+        for row in labels:
+            if row["track_id"] not in tracks:
+                tracks[row["track_id"]] = DefectTrack.objects.create(
+                    batch=batch,
+                    disease_type=DiseaseType.objects.get(name=row["label"]),
+                    unique_code=f"T{row['track_id']}",
+                    start_frame=row["frame_index"],
+                    end_frame=row["frame_index"],
+                )
+            track = tracks[row["track_id"]]
+            GroundTruthFrame.objects.create(
+                track=track, batch=batch, frame_index=row["frame_index"], time=row["time"],
+                **{k: row[k] for k in ("bbox_x", "bbox_y", "bbox_width", "bbox_height")},
+            )
+            name = f"{track.pk}-{row['frame_index']}.jpg"
+            (frames_dir / name).write_bytes(b"frame")
+            DiseaseMedia.objects.create(
+                defect_track=track, media_type=image, file_link=f"/media/frames/{name}"
+            )
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("extract_snapshots", str(batch.pk), "--workers=0", stdout=out)
+        self.assertRegex(out.getvalue(), rf"3 snapshots, 3 new files .* {len(labels)} media rows replaced")
+        self.assertEqual(DiseaseMedia.objects.count(), 3)
+        self.assertEqual(list(frames_dir.iterdir()), [])
+        for track in tracks.values():
+            track.refresh_from_db()
+            (media,) = track.media.all()
+            self.assertEqual(media.file_link, track.snapshot_link)
+            img = imageio.imread(Path(self.tmp.name) / track.snapshot_link.removeprefix("/media/"))
+            self.assertLessEqual(max(img.shape[:2]), 320)
+        response = self.client.get(reverse("defect_tracks"), {"batch": batch.pk})
+        self.assertEqual(
+            {t["snapshot"].split("?")[0] for t in response.json()["tracks"]},
+            {
+                reverse("media_thumbnail", args=[media.pk, "medium"])
+                for media in DiseaseMedia.objects.all()
+            },
+        )
+
+    def test_missing_video_is_reported(self):
+        batch = DetectionBatch.objects.create(
+            start_time="2024-01-01T00:00:00Z",
+            end_time="2024-01-01T01:00:00Z",
+            airport="A1",
+            drone_id="D1",
+            video_link="/media/none.mp4",
+        )
+        with self.assertRaisesMessage(CommandError, "has no local video"):
+            call_command("ingest_video", str(batch.pk))
+        with self.assertRaisesMessage(CommandError, "cannot load detector"):
+            call_command("ingest_video", str(batch.pk), "--video=x.mp4", "--detector=web.nope.Detector")
+
 
 class DashboardStatsAPITest(TestCase):
     def setUp(self):
@@ -106,6 +1980,36 @@ class DashboardStatsAPITest(TestCase):
         self.assertEqual(data["batch"]["pending_count"], 1)
         self.assertAlmostEqual(data["batch"]["completion_rate"], 50.0)
 
+    @override_settings(API_CACHE_TTLS={})
+    def test_stats_single_query(self):
+        # One data-version lookup for the ETag plus one counter lookup.
+        with self.assertNumQueries(2):
+            self.client.get(reverse("stats"), {"batch": self.batch.id})
+
+    def test_counters_follow_writes(self):
+        track = DefectTrack.objects.get(unique_code="REC2")
+        track.develop_trend = "已修复"
+        track.save()
+        data = self.client.get(reverse("stats"), {"batch": self.batch.id}).json()
+        self.assertEqual(data["pending_count"], 0)
+        self.assertEqual(data["batch"]["pending_count"], 0)
+
+        track.delete()
+        data = self.client.get(reverse("stats"), {"batch": self.batch.id}).json()
+        self.assertEqual(data["batch"]["defect_count"], 1)
+
+        self.batch.delete()
+        data = self.client.get(reverse("stats")).json()
+        self.assertEqual(data["inspection_count"], 0)
+        self.assertEqual(data["pending_count"], 0)
+
+    def test_rebuild_counters(self):
+        StatsCounter.objects.all().update(defect_count=99, inspection_count=7)
+        call_command("rebuild_counters", stdout=StringIO())
+        data = self.client.get(reverse("stats"), {"batch": self.batch.id}).json()
+        self.assertEqual(data["inspection_count"], 1)
+        self.assertEqual(data["batch"]["defect_count"], 2)
+
 
 class DefectTracksAPITest(TestCase):
     def setUp(self):
@@ -128,7 +2032,7 @@ class DefectTracksAPITest(TestCase):
             end_frame=2,
             start_time=0.0,
         )
-        DiseaseMedia.objects.create(
+        self.media = DiseaseMedia.objects.create(
             defect_track=track,
             media_type=mtype,
             file_link="/media/frame1.jpg",
@@ -140,7 +2044,122 @@ class DefectTracksAPITest(TestCase):
         data = resp.json()
         self.assertEqual(len(data["tracks"]), 1)
         self.assertEqual(data["tracks"][0]["start"], 0.0)
-        self.assertIn("/media/frame1.jpg", data["tracks"][0]["snapshot"])
+        # The slider gets thumbnails rather than the original frame.
+        thumb = reverse("media_thumbnail", args=[self.media.pk, "medium"])
+        self.assertTrue(data["tracks"][0]["snapshot"].startswith(thumb + "?v="))
+        self.assertIn(" 160w", data["tracks"][0]["srcset"])
+
+    def test_remote_media_are_linked_directly(self):
+        link = "https://cdn.example.com/frame1.jpg"
+        self.media.file_link = link
+        self.media.save()
+        track = self.client.get(reverse("defect_tracks")).json()["tracks"][0]
+        self.assertEqual(track["snapshot"], link)
+        self.assertEqual(track["srcset"], "")
+
+
+class ThumbnailAPITest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.settings_override = override_settings(MEDIA_ROOT=self.tmp.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        batch = DetectionBatch.objects.create(
+            start_time="2024-01-01T00:00:00Z",
+            end_time="2024-01-01T01:00:00Z",
+            airport="A1",
+            drone_id="D1",
+        )
+        self.track = DefectTrack.objects.create(
+            batch=batch,
+            disease_type=DiseaseType.objects.create(name="裂缝"),
+            unique_code="T1",
+            start_frame=0,
+            end_frame=1,
+        )
+        self.mtype = MediaType.objects.create(name="图片", code="image")
+
+    def media(self, name, width=1920, height=1080):
+        from PIL import Image
+
+        rng = np.random.default_rng(len(name))
+        pixels = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(Path(self.tmp.name) / name, quality=95)
+        return DiseaseMedia.objects.create(
+            defect_track=self.track, media_type=self.mtype, file_link=f"/media/{name}"
+        )
+
+    def thumbnail_files(self):
+        return [p for p in (Path(self.tmp.name) / "thumbnails").rglob("*") if p.is_file()]
+
+    def test_resized_and_cached(self):
+        from PIL import Image
+
+        media = self.media("frame.jpg")
+        url = reverse("media_thumbnail", args=[media.pk, "small"])
+        resp = self.client.get(url, HTTP_ACCEPT="image/webp,image/*")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp["Content-Type"], "image/webp")
+        self.assertIn("immutable", resp["Cache-Control"])
+        self.assertIn("max-age=31536000", resp["Cache-Control"])
+        self.assertIn("Accept", resp["Vary"])
+        with Image.open(io.BytesIO(resp.content)) as img:
+            self.assertEqual(img.size, (160, 90))
+        self.assertLess(len(resp.content), (Path(self.tmp.name) / "frame.jpg").stat().st_size / 50)
+        (cached,) = self.thumbnail_files()
+
+        again = self.client.get(url, HTTP_ACCEPT="image/webp")
+        self.assertEqual(again.content, resp.content)
+        self.assertEqual(self.thumbnail_files(), [cached])
+        self.assertEqual(
+            self.client.get(url, HTTP_ACCEPT="image/webp", HTTP_IF_NONE_MATCH=resp["ETag"]).status_code,
+            304,
+        )
+
+        jpeg = self.client.get(url, {"format": "jpeg"})
+        self.assertEqual(jpeg["Content-Type"], "image/jpeg")
+        self.assertEqual(len(self.thumbnail_files()), 2)
+
+    def test_unknown_or_missing_media(self):
+        media = self.media("frame.jpg", 64, 48)
+        self.assertEqual(
+            self.client.get(reverse("media_thumbnail", args=[media.pk, "huge"])).status_code, 404
+        )
+        self.assertEqual(
+            self.client.get(reverse("media_thumbnail", args=[media.pk + 1, "small"])).status_code, 404
+        )
+        (Path(self.tmp.name) / "frame.jpg").write_bytes(b"not an image")
+        self.assertEqual(
+            self.client.get(reverse("media_thumbnail", args=[media.pk, "small"])).status_code, 404
+        )
+        (Path(self.tmp.name) / "frame.jpg").unlink()
+        self.assertEqual(
+            self.client.get(reverse("media_thumbnail", args=[media.pk, "small"])).status_code, 404
+        )
+
+    def test_cache_evicts_least_recently_used(self):
+        import os
+
+        cache = thumbnails.DiskCache(Path(self.tmp.name) / "lru", max_bytes=250)
+        cache.put("aa", "jpeg", b"a" * 100)
+        os.utime(cache.path("aa", "jpeg"), (1000, 1000))
+        cache.put("bb", "jpeg", b"b" * 100)
+        os.utime(cache.path("bb", "jpeg"), (1001, 1001))
+        self.assertEqual(cache.get("aa", "jpeg"), b"a" * 100)  # refreshes "aa"
+        cache.put("cc", "jpeg", b"c" * 100)
+        self.assertIsNone(cache.get("bb", "jpeg"))
+        self.assertIsNotNone(cache.get("aa", "jpeg"))
+        self.assertIsNotNone(cache.get("cc", "jpeg"))
+        self.assertEqual(cache.evicted, 1)
+
+        media = [self.media(f"frame{i}.jpg", 640, 360) for i in range(4)]
+        size = len(self.client.get(reverse("media_thumbnail", args=[media[0].pk, "large"])).content)
+        with override_settings(THUMBNAIL_CACHE_BYTES=int(size * 2.5)):
+            for item in media:
+                url = reverse("media_thumbnail", args=[item.pk, "large"])
+                self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertLessEqual(sum(p.stat().st_size for p in self.thumbnail_files()), size * 2.5)
 
 
 class DiseaseTypeStatsAPITest(TestCase):
@@ -185,6 +2204,58 @@ class DiseaseTypeStatsAPITest(TestCase):
         self.assertEqual(label_data["裂缝"], 1)
         self.assertEqual(label_data["坑槽"], 2)
 
+    def test_disease_type_filters(self):
+        other = DetectionBatch.objects.create(
+            start_time="2024-02-01T00:00:00Z",
+            end_time="2024-02-01T01:00:00Z",
+            airport="A2",
+            drone_id="D2",
+        )
+        DefectTrack.objects.create(
+            batch=other,
+            disease_type=DiseaseType.objects.get(name="裂缝"),
+            unique_code="D4",
+            start_frame=1,
+            end_frame=2,
+        )
+        url = reverse("disease_type_stats")
+        data = self.client.get(url, {"airport": "A2"}).json()
+        self.assertEqual(dict(zip(data["labels"], data["data"])), {"裂缝": 1})
+        data = self.client.get(url, {"until": "2024-01-31"}).json()
+        self.assertEqual(dict(zip(data["labels"], data["data"])), {"裂缝": 1, "坑槽": 2})
+        data = self.client.get(url, {"since": "2024-02-01"}).json()
+        self.assertEqual(data["labels"], ["裂缝"])
+        for params in ({"since": "2024-13-01"}, {"since": "abc"}, {"until": "zzz"}):
+            self.assertEqual(self.client.get(url, params).status_code, 400, params)
+        self.assertEqual(self.client.get(url, {"since": ""}).status_code, 200)
+
+        other.airport = "A3"
+        other.save()
+        data = self.client.get(url, {"airport": "A3"}).json()
+        self.assertEqual(data["data"], [1])
+        DefectTrack.objects.get(unique_code="D4").delete()
+        data = self.client.get(url, {"airport": "A3"}).json()
+        self.assertEqual(data["labels"], [])
+
+    def test_deleting_severity_keeps_counts(self):
+        severe = SeverityLevel.objects.create(name="重度", code="high")
+        for track in DefectTrack.objects.filter(unique_code__in=["D1", "D2"]):
+            track.severity = severe
+            track.save()
+        url = reverse("disease_type_stats")
+        before = self.client.get(url).json()
+        severe.delete()
+        self.assertEqual(DefectTrack.objects.filter(severity__isnull=True).count(), 3)
+        self.assertEqual(self.client.get(url).json(), before)
+        rows = set(DiseaseDailyRollup.objects.values_list("disease_type__name", "severity", "count"))
+        self.assertEqual(rows, {("裂缝", None, 1), ("坑槽", None, 2)})
+
+    def test_backfill_rollups(self):
+        DiseaseDailyRollup.objects.all().delete()
+        call_command("backfill_rollups", stdout=StringIO())
+        data = self.client.get(reverse("disease_type_stats")).json()
+        self.assertEqual(dict(zip(data["labels"], data["data"])), {"裂缝": 1, "坑槽": 2})
+
 
 class DetectionBatchesAPITest(TestCase):
     def setUp(self):
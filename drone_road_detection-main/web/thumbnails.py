@@ -0,0 +1,187 @@
+"""Resized previews of media files, generated on demand.
+
+``/api/thumbnails/<media id>/<preset>/`` scales the image behind a
+``DiseaseMedia`` row down to the preset's longest side
+(``THUMBNAIL_PRESETS``) and encodes it as WebP, or JPEG for clients that
+do not accept WebP.  Thumbnails are cached under
+``MEDIA_ROOT/thumbnails`` by a key derived from the source file's path,
+size and modification time, so a replaced source is never served stale.
+The cache is bounded by ``THUMBNAIL_CACHE_BYTES``: reads refresh a
+file's modification time and, once a write pushes the cache over the
+bound, the least recently used files are deleted down to 90% of it.
+
+Thumbnail URLs carry a token of the media's ``file_link``, which lets
+responses be cached by browsers for a year as ``immutable``.
+"""
+
+import hashlib
+import io
+import os
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.urls import reverse
+from PIL import Image, ImageOps
+
+from .purge import media_path
+
+THUMBNAIL_DIR = "thumbnails"
+DEFAULT_PRESETS = {"small": 160, "medium": 320, "large": 640}
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+MAX_AGE = 365 * 24 * 3600
+
+FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg"}
+_SAVE_OPTIONS = {
+    "webp": {"format": "WEBP", "quality": 80, "method": 4},
+    "jpeg": {"format": "JPEG", "quality": 85, "optimize": True, "progressive": True},
+}
+# Reads refresh the modification time at most this often (seconds).
+_TOUCH_INTERVAL = 60
+
+
+def presets():
+    """Return the ``{name: longest side in pixels}`` presets."""
+    return getattr(settings, "THUMBNAIL_PRESETS", DEFAULT_PRESETS)
+
+
+def url(media_id, file_link, preset):
+    """Return the thumbnail URL of a media row, versioned by its link."""
+    token = hashlib.sha256(file_link.encode("utf-8")).hexdigest()[:12]
+    return f"{reverse('media_thumbnail', args=[media_id, preset])}?v={token}"
+
+
+def negotiate(request):
+    """Pick the output format from ``?format=`` or the ``Accept`` header."""
+    fmt = request.GET.get("format")
+    if fmt in FORMATS:
+        return fmt
+    return "webp" if "image/webp" in request.headers.get("Accept", "") else "jpeg"
+
+
+def render(path, size, fmt):
+    """Return ``path`` scaled to at most ``size`` pixels and encoded as ``fmt``.
+
+    Raises ``OSError`` if Pillow cannot read the file as an image.
+    """
+    try:
+        with Image.open(path) as img:
+            # JPEG sources are decoded at the smallest DCT scale still at
+            # least ``size``, which is most of the speed-up for large frames.
+            img.draft("RGB", (size, size))
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.thumbnail((size, size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            out = io.BytesIO()
+            img.save(out, **_SAVE_OPTIONS[fmt])
+    except Image.DecompressionBombError as exc:
+        raise OSError(str(exc)) from exc
+    return out.getvalue()
+
+
+class DiskCache:
+    """Files under ``root`` bounded to ``max_bytes`` by LRU eviction.
+
+    The total size is counted once per process and then tracked across
+    writes; eviction rescans the directory, so files written by other
+    processes are accounted for when it matters.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.evicted = 0
+        self._bytes = None
+        self._lock = threading.Lock()
+
+    def path(self, key, ext):
+        return self.root / key[:2] / f"{key}.{ext}"
+
+    def get(self, key, ext):
+        """Return the cached bytes of ``key`` or ``None``."""
+        path = self.path(key, ext)
+        try:
+            data = path.read_bytes()
+            if time.time() - path.stat().st_mtime > _TOUCH_INTERVAL:
+                os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, ext, data):
+        path = self.path(key, ext)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self._bytes += len(data)
+            if self._bytes > self.max_bytes:
+                self._evict(keep=path)
+
+    def _entries(self):
+        for path in self.root.rglob("*"):
+            if path.is_file() and not path.name.startswith("."):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _evict(self, keep):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+            self.evicted += 1
+        self._bytes = total
+
+
+_caches = {}
+
+
+def cache():
+    """Return the process's :class:`DiskCache` for the current settings."""
+    root = Path(settings.MEDIA_ROOT) / THUMBNAIL_DIR
+    max_bytes = getattr(settings, "THUMBNAIL_CACHE_BYTES", DEFAULT_CACHE_BYTES)
+    key = (str(root), max_bytes)
+    if key not in _caches:
+        _caches[key] = DiskCache(root, max_bytes)
+    return _caches[key]
+
+
+def thumbnail(file_link, size, fmt):
+    """Return ``(key, data)`` of the thumbnail of ``file_link``, generating
+    and caching it on first use; ``None`` if the source file is missing.
+
+    Raises ``OSError`` if the source is not an image.
+    """
+    path = media_path(file_link)
+    if path is None:
+        return None
+    try:
+        stat = path.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if not path.is_file():
+        return None
+    key = hashlib.sha256(
+        f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\0{size}\0{fmt}".encode("utf-8")
+    ).hexdigest()
+    store = cache()
+    data = store.get(key, fmt)
+    if data is None:
+        data = render(path, size, fmt)
+        store.put(key, fmt, data)
+    return key, data
@@ -0,0 +1,507 @@
+"""Packed per-track storage of frame annotations.
+
+Instead of one ``GroundTruthFrame`` row per box, a track may store all of
+its boxes in a single :class:`~web.models.PackedTrackFrames` BLOB::
+
+    magic "TRKP" | uint32 format version | uint64 frame count N
+    float64 time[N]          (NaN when the frame has no time)
+    uint32  frame_index[N]
+    float32 bbox[N * 4]      (x, y, w, h)
+    uint8   flags[N]         (version 2 only)
+
+Frames are stored sorted by ``frame_index``.  Boxes are read back rounded
+to :data:`BBOX_DECIMALS` decimals, i.e. within ``2e-7`` of the stored
+value, so the JSON payload shows ``0.1`` rather than float32 noise.  A
+batch may mix packed and row-per-frame tracks; :func:`batch_columns`
+merges both into arrays and :func:`iter_rows` streams them merged by
+frame, decoding each packed track only once the merge reaches its first
+frame.  The first and last frame of every BLOB are also stored as
+columns, so tracks outside a frame window are skipped in SQL.
+
+Version 2 BLOBs hold only the keyframes chosen by :func:`keyframes`.
+A keyframe flagged :data:`INTERPOLATE` is followed by every frame up to
+the next keyframe, whose time and box are interpolated linearly when the
+BLOB is unpacked; readers therefore always see every frame.
+"""
+
+import heapq
+import math
+import struct
+from collections import namedtuple
+
+import numpy as np
+from django.db import transaction
+
+from . import signals
+from .models import DefectTrack, GroundTruthFrame, PackedTrackFrames
+from .purge import DEFAULT_CHUNK_SIZE, delete_rows
+
+MAGIC = b"TRKP"
+FORMAT_VERSION = 1
+KEYFRAME_VERSION = 2
+BBOX_DECIMALS = 7
+
+# Largest ``frame_index`` a packed BLOB or archive can hold (uint32).
+MAX_FRAME_INDEX = 2**32 - 1
+
+# Keyframe flag: interpolate every frame up to the next keyframe.
+INTERPOLATE = 1
+
+# Largest error, in seconds, of an interpolated frame time.
+TIME_TOLERANCE = 1e-3
+
+_HEADER = struct.Struct("<4sIQ")
+_FRAME = struct.Struct("<I")
+
+# Packed BLOBs fetched per query.
+PACKED_CHUNK_SIZE = 100
+
+# Same column order as ``overlay.FRAME_FIELDS``.
+_FRAME_FIELDS = ("frame_index", "time", "track_id", "bbox_x", "bbox_y", "bbox_width", "bbox_height")
+
+# ``overlay.resolve_window`` lookups and how they apply to frame columns.
+_WINDOW_FILTERS = {
+    "frame_index__gte": ("frame_index", np.greater_equal),
+    "frame_index__lte": ("frame_index", np.less_equal),
+    "time__gte": ("time", np.greater_equal),
+    "time__lt": ("time", np.less),
+}
+
+TrackFrames = namedtuple("TrackFrames", "frame_index time bbox")
+
+BatchColumns = namedtuple("BatchColumns", "frame_index time track_id bbox")
+
+
+def _sorted(frame_index, time, bbox):
+    frame_index = np.asarray(frame_index, "<u4")
+    time = np.array([math.nan if t is None else t for t in time], "<f8")
+    bbox = np.asarray(bbox, np.float64).reshape(-1, 4)
+    if not len(frame_index) == len(time) == len(bbox):
+        raise ValueError("frame_index, time and bbox must have the same length")
+    order = np.argsort(frame_index, kind="stable")
+    return frame_index[order], time[order], bbox[order]
+
+
+def pack(frame_index, time, bbox, min_iou=None):
+    """Pack the boxes of one track; ``time`` may contain ``None``/NaN.
+
+    With ``min_iou`` only the :func:`keyframes` reproducing every box with
+    at least that IoU are stored.
+    """
+    frame_index, time, bbox = _sorted(frame_index, time, bbox)
+    parts = [time, frame_index, bbox.astype("<f4")]
+    version = FORMAT_VERSION
+    if min_iou is not None:
+        keep, flags = keyframes(frame_index, time, bbox, min_iou)
+        parts = [part[keep] for part in parts] + [flags]
+        version = KEYFRAME_VERSION
+    return b"".join(
+        [_HEADER.pack(MAGIC, version, len(parts[1]))] + [part.tobytes() for part in parts]
+    )
+
+
+def stored_boxes(data):
+    """Return the number of boxes physically stored in a packed BLOB."""
+    return _HEADER.unpack_from(bytes(data[:_HEADER.size]))[2]
+
+
+def _header(data):
+    magic, version, count = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("not a packed track")
+    if version not in (FORMAT_VERSION, KEYFRAME_VERSION):
+        raise ValueError("unsupported packed track version %s" % version)
+    return version, count
+
+
+def frame_range(data):
+    """Return the first and last ``frame_index`` of a packed BLOB without
+    unpacking it, or ``None`` if it holds no frame.
+
+    Keyframe BLOBs always keep the first and last frame of a track.
+    """
+    _, count = _header(data)
+    if not count:
+        return None
+    offset = _HEADER.size + 8 * count
+    return (
+        _FRAME.unpack_from(data, offset)[0],
+        _FRAME.unpack_from(data, offset + 4 * (count - 1))[0],
+    )
+
+
+def packed_fields(data):
+    """Return the ``first_frame``/``last_frame`` columns of a packed BLOB."""
+    span = frame_range(data) or (None, None)
+    return {"first_frame": span[0], "last_frame": span[1]}
+
+
+def unpack(data):
+    """Return the :class:`TrackFrames` arrays stored in a packed BLOB."""
+    data = bytes(data)
+    version, count = _header(data)
+    offset = _HEADER.size
+    time = np.frombuffer(data, "<f8", count, offset)
+    offset += time.nbytes
+    frame_index = np.frombuffer(data, "<u4", count, offset)
+    offset += frame_index.nbytes
+    bbox = np.frombuffer(data, "<f4", count * 4, offset).reshape(-1, 4).astype(np.float64)
+    offset += bbox.nbytes // 2
+    if version == KEYFRAME_VERSION:
+        flags = np.frombuffer(data, "u1", count, offset)
+        frame_index, time, bbox = interpolate(frame_index, time, bbox, flags)
+    return TrackFrames(frame_index, time, np.round(bbox, BBOX_DECIMALS))
+
+
+def box_iou(a, b):
+    """Row-wise IoU of two ``(N, 4)`` arrays of ``x, y, w, h`` boxes.
+
+    Negative sizes count as empty; two empty boxes match when they agree
+    to within ``1e-6``.
+    """
+    left = np.maximum(a[:, 0], b[:, 0])
+    top = np.maximum(a[:, 1], b[:, 1])
+    right = np.minimum(a[:, 0] + a[:, 2], b[:, 0] + b[:, 2])
+    bottom = np.minimum(a[:, 1] + a[:, 3], b[:, 1] + b[:, 3])
+    inter = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    area_a = np.clip(a[:, 2], 0, None) * np.clip(a[:, 3], 0, None)
+    area_b = np.clip(b[:, 2], 0, None) * np.clip(b[:, 3], 0, None)
+    union = area_a + area_b - inter
+    same = np.all(np.abs(a - b) <= 1e-6, axis=1).astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(union > 0, inter / union, same)
+
+
+def interpolate(frame_index, time, bbox, flags):
+    """Expand keyframes to every frame they cover.
+
+    Frames between a keyframe flagged :data:`INTERPOLATE` and the next
+    keyframe get linearly interpolated times and boxes; a time is NaN if
+    either keyframe has none.
+    """
+    count = len(frame_index)
+    if not count:
+        return frame_index, time, bbox
+    frame_index = frame_index.astype(np.int64)
+    gaps = np.diff(frame_index)
+    runs = np.append(np.where(flags[:-1] & INTERPOLATE, gaps, 1), 1)
+    seg = np.repeat(np.arange(count), runs)
+    offset = np.arange(len(seg)) - np.repeat(np.cumsum(runs) - runs, runs)
+    nxt = np.minimum(seg + 1, count - 1)
+    between = offset > 0
+    weight = np.where(between, offset / np.where(between, frame_index[nxt] - frame_index[seg], 1), 0)
+    out_time = np.where(between, time[seg] + weight * (time[nxt] - time[seg]), time[seg])
+    out_bbox = np.where(
+        between[:, None], bbox[seg] + weight[:, None] * (bbox[nxt] - bbox[seg]), bbox[seg]
+    )
+    return (frame_index[seg] + offset).astype(np.uint32), out_time, out_bbox
+
+
+def _reproduces(frame_index, time, bbox, stored, a, b, min_iou):
+    """Whether keyframes ``a`` and ``b`` reproduce the frames between them."""
+    if b - a < 2:
+        return True
+    ends = np.array([a, b])
+    _, t, box = interpolate(frame_index[ends], time[ends], stored[ends], np.array([INTERPOLATE, 0]))
+    t, box = t[1:-1], np.round(box[1:-1], BBOX_DECIMALS)
+    original = time[a + 1:b]
+    times_ok = np.where(
+        np.isnan(original), np.isnan(t), np.abs(t - original) <= TIME_TOLERANCE
+    )
+    return bool(times_ok.all() and (box_iou(box, bbox[a + 1:b]) >= min_iou).all())
+
+
+def keyframes(frame_index, time, bbox, min_iou):
+    """Choose keyframes reproducing every box with at least ``min_iou``.
+
+    Frames must be sorted by ``frame_index``.  Each run of consecutive
+    frames is covered greedily: a keyframe reaches as far forward as
+    interpolation stays within the tolerance, checked against the float32
+    boxes actually stored.  Gaps in the frame sequence are never
+    interpolated.  Returns ``(indices, flags)``.
+    """
+    frames = np.asarray(frame_index, np.int64)
+    stored = np.asarray(bbox, "<f4").astype(np.float64)
+    bbox = np.asarray(bbox, np.float64)
+    # Index of the last frame of the consecutive run each frame belongs to.
+    breaks = np.append(np.flatnonzero(np.diff(frames) != 1), len(frames) - 1)
+    run_end = np.repeat(breaks, np.diff(np.append(-1, breaks)))
+    keep, flags = [], []
+    start = 0
+    while start < len(frames):
+        keep.append(start)
+        if start == run_end[start]:
+            flags.append(0)
+            start += 1
+            continue
+        end = start + 1
+        while end < run_end[start] and _reproduces(
+            frames, time, bbox, stored, start, end + 1, min_iou
+        ):
+            end += 1
+        flags.append(INTERPOLATE)
+        start = end
+    return np.array(keep, np.intp), np.array(flags, "u1")
+
+
+def _row_frames(rows):
+    rows = list(rows)
+    return TrackFrames(
+        np.array([r[0] for r in rows], np.uint32),
+        np.array([math.nan if r[1] is None else r[1] for r in rows], np.float64),
+        np.array([r[2:] for r in rows], np.float64).reshape(-1, 4),
+    )
+
+
+def read_track(track_id):
+    """Return the :class:`TrackFrames` of a track in either storage mode."""
+    data = (
+        PackedTrackFrames.objects.filter(track_id=track_id)
+        .values_list("data", flat=True)
+        .first()
+    )
+    if data is not None:
+        return unpack(data)
+    return _row_frames(
+        GroundTruthFrame.objects.filter(track_id=track_id)
+        .order_by("frame_index")
+        .values_list("frame_index", "time", "bbox_x", "bbox_y", "bbox_width", "bbox_height")
+    )
+
+
+def write_track(track_id, frame_index, time, bbox, min_iou=None):
+    """Store the boxes of a track packed, replacing any per-frame rows.
+
+    ``min_iou`` stores keyframes only, see :func:`pack`.
+    """
+    data = pack(frame_index, time, bbox, min_iou)
+    with transaction.atomic():
+        PackedTrackFrames.objects.update_or_create(
+            track_id=track_id,
+            defaults={"frame_count": len(frame_index), "data": data, **packed_fields(data)},
+        )
+        pks = list(GroundTruthFrame.objects.filter(track_id=track_id).values_list("pk", flat=True))
+        for start in range(0, len(pks), DEFAULT_CHUNK_SIZE):
+            delete_rows(GroundTruthFrame, pks[start:start + DEFAULT_CHUNK_SIZE])
+
+
+def window_mask(frame_index, time, window):
+    """Boolean mask of the frames matching a ``resolve_window`` lookup dict."""
+    columns = {"frame_index": frame_index, "time": time}
+    mask = np.ones(len(frame_index), bool)
+    for lookup, value in (window or {}).items():
+        column, op = _WINDOW_FILTERS[lookup]
+        mask &= op(columns[column], value)
+    return mask
+
+
+def has_packed(batch_id):
+    """Whether any track of ``batch_id`` uses packed storage."""
+    return bool(batch_id) and PackedTrackFrames.objects.filter(track__batch_id=batch_id).exists()
+
+
+def batch_columns(batch_id, window=None):
+    """Return :class:`BatchColumns` of every box of a batch in ``window``,
+    from both storage modes, sorted by ``(frame_index, track_id)``."""
+    parts = []
+    packed = (
+        PackedTrackFrames.objects.filter(track__batch_id=batch_id)
+        .values_list("track_id", "data")
+        .iterator(chunk_size=PACKED_CHUNK_SIZE)
+    )
+    for track_id, data in packed:
+        parts.append(_track_columns(track_id, data, window))
+    rows = GroundTruthFrame.objects.filter(batch_id=batch_id)
+    if window:
+        rows = rows.filter(**window)
+    rows = list(rows.values_list(*_FRAME_FIELDS).iterator(chunk_size=DEFAULT_CHUNK_SIZE))
+    if rows:
+        frames = _row_frames((r[0], r[1], *r[3:]) for r in rows)
+        parts.append(
+            BatchColumns(
+                frames.frame_index, frames.time, np.array([r[2] for r in rows], np.int64), frames.bbox
+            )
+        )
+    if not parts:
+        return BatchColumns(
+            np.empty(0, np.uint32), np.empty(0), np.empty(0, np.int64), np.empty((0, 4))
+        )
+    columns = BatchColumns(*(np.concatenate(column) for column in zip(*parts)))
+    order = np.lexsort((columns.track_id, columns.frame_index))
+    return BatchColumns(*(column[order] for column in columns))
+
+
+def _track_columns(track_id, data, window):
+    frames = unpack(data)
+    mask = window_mask(frames.frame_index, frames.time, window)
+    return BatchColumns(
+        frames.frame_index[mask],
+        frames.time[mask],
+        np.full(int(mask.sum()), track_id, np.int64),
+        frames.bbox[mask],
+    )
+
+
+def columns_to_rows(columns):
+    """Yield ``overlay.FRAME_FIELDS`` tuples from :class:`BatchColumns`."""
+    return zip(
+        columns.frame_index.tolist(),
+        [None if math.isnan(t) else t for t in columns.time.tolist()],
+        columns.track_id.tolist(),
+        *(columns.bbox[:, i].tolist() for i in range(4)),
+    )
+
+
+def _packed_ranges(batch_id, window):
+    """Return ``(first_frame, track_id)`` of the packed tracks of a batch
+    that may have boxes in ``window``, sorted by first frame."""
+    packed = PackedTrackFrames.objects.filter(
+        track__batch_id=batch_id, first_frame__isnull=False
+    )
+    window = window or {}
+    if "frame_index__gte" in window:
+        packed = packed.filter(last_frame__gte=window["frame_index__gte"])
+    if "frame_index__lte" in window:
+        packed = packed.filter(first_frame__lte=window["frame_index__lte"])
+    # Latest first, so the next track to start is popped off the end.
+    return list(packed.order_by("-first_frame", "-track_id").values_list("first_frame", "track_id"))
+
+
+def iter_rows(batch_id, window=None):
+    """Yield annotation tuples like ``overlay.iter_frame_rows``.
+
+    Row-per-frame boxes are streamed from the database and merged by
+    ``(frame_index, track_id)`` with the packed tracks.  A packed track is
+    decoded when the merge reaches its first frame and dropped once its
+    last box is yielded, so memory is bounded by the tracks overlapping
+    the current frame rather than by the batch.
+    """
+    pending = _packed_ranges(batch_id, window)
+    rows = GroundTruthFrame.objects.filter(batch_id=batch_id)
+    if window:
+        rows = rows.filter(**window)
+    rows = (
+        rows.order_by("frame_index", "track_id")
+        .values_list(*_FRAME_FIELDS)
+        .iterator(chunk_size=DEFAULT_CHUNK_SIZE)
+    )
+    heap = []
+
+    def push(source):
+        row = next(source, None)
+        if row is not None:
+            # The source's id breaks ties without comparing iterators.
+            heapq.heappush(heap, (row[0], row[2], id(source), row, source))
+
+    push(rows)
+    while heap or pending:
+        limit = heap[0][0] if heap else pending[-1][0]
+        starting = []
+        while pending and pending[-1][0] <= limit:
+            starting.append(pending.pop()[1])
+        for start in range(0, len(starting), PACKED_CHUNK_SIZE):
+            packed = PackedTrackFrames.objects.filter(
+                track_id__in=starting[start:start + PACKED_CHUNK_SIZE]
+            ).values_list("track_id", "data")
+            for track_id, data in packed:
+                push(iter(columns_to_rows(_track_columns(track_id, data, window))))
+        while heap and not (pending and pending[-1][0] <= heap[0][0]):
+            row, source = heapq.heappop(heap)[3:]
+            yield row
+            push(source)
+
+
+def has_frames(batch_id):
+    """Whether ``batch_id`` has any box in either storage mode."""
+    return (
+        has_packed(batch_id)
+        or GroundTruthFrame.objects.filter(batch_id=batch_id).exists()
+    )
+
+
+def stored_boxes_of_batch(batch_id):
+    """Return the number of boxes physically stored for ``batch_id``."""
+    packed = PackedTrackFrames.objects.filter(track__batch_id=batch_id).values_list("data", flat=True)
+    return sum(stored_boxes(data) for data in packed.iterator(chunk_size=100)) + (
+        GroundTruthFrame.objects.filter(batch_id=batch_id).count()
+    )
+
+
+def pack_batch(batch_id, chunk_size=DEFAULT_CHUNK_SIZE, min_iou=None):
+    """Convert every row-per-frame track of a batch to packed storage.
+
+    Each track is converted in its own transaction and its rows are removed
+    with raw deletes; ``min_iou`` keeps keyframes only.  Tracks that are
+    already packed are left as they are.  Returns ``(tracks, rows)``
+    converted.
+    """
+    converted = rows_deleted = 0
+    pending = (
+        DefectTrack.objects.filter(batch_id=batch_id, packed_frames__isnull=True)
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+    for track_id in list(pending):
+        with transaction.atomic():
+            rows = list(
+                GroundTruthFrame.objects.filter(track_id=track_id)
+                .order_by("frame_index")
+                .values_list("pk", "frame_index", "time", "bbox_x", "bbox_y", "bbox_width", "bbox_height")
+            )
+            if not rows:
+                continue
+            frames = _row_frames(r[1:] for r in rows)
+            data = pack(frames.frame_index, frames.time, frames.bbox, min_iou)
+            PackedTrackFrames.objects.bulk_create(
+                [
+                    PackedTrackFrames(
+                        track_id=track_id, frame_count=len(rows), data=data, **packed_fields(data)
+                    )
+                ]
+            )
+            pks = [r[0] for r in rows]
+            for start in range(0, len(pks), chunk_size):
+                rows_deleted += delete_rows(GroundTruthFrame, pks[start:start + chunk_size])
+            converted += 1
+    signals.bulk_changed(batch_id)
+    return converted, rows_deleted
+
+
+def unpack_batch(batch_id, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Convert every packed track of a batch back to per-frame rows.
+
+    Returns ``(tracks, rows)`` converted.
+    """
+    converted = rows_created = 0
+    packed = (
+        PackedTrackFrames.objects.filter(track__batch_id=batch_id)
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+    for track_id in list(packed):
+        with transaction.atomic():
+            data = PackedTrackFrames.objects.filter(pk=track_id).values_list("data", flat=True).get()
+            frames = unpack(data)
+            created = GroundTruthFrame.objects.bulk_create(
+                (
+                    GroundTruthFrame(
+                        track_id=track_id,
+                        batch_id=batch_id,
+                        frame_index=f,
+                        time=None if math.isnan(t) else t,
+                        bbox_x=x,
+                        bbox_y=y,
+                        bbox_width=w,
+                        bbox_height=h,
+                    )
+                    for f, t, (x, y, w, h) in zip(
+                        frames.frame_index.tolist(), frames.time.tolist(), frames.bbox.tolist()
+                    )
+                ),
+                batch_size=chunk_size,
+            )
+            delete_rows(PackedTrackFrames, [track_id])
+            rows_created += len(created)
+            converted += 1
+    signals.bulk_changed(batch_id)
+    return converted, rows_created
@@ -9,6 +9,13 @@ urlpatterns = [
     path("api/batches/", views.detection_batches, name="batches"),
     path("api/boxes/", views.anomaly_boxes, name="anomaly_boxes"),
     path("api/tracks/", views.defect_tracks, name="defect_tracks"),
+    path(
+        "api/thumbnails/<int:media_id>/<str:preset>/",
+        views.media_thumbnail,
+        name="media_thumbnail",
+    ),
     path("api/road_stats/", views.road_stats, name="road_stats"),
     path("api/weather/", views.current_weather, name="current_weather"),
+    path("api/cache_stats/", views.api_cache_stats, name="api_cache_stats"),
+    path("api/ingest/<int:batch_id>/", views.ingest_detections, name="ingest"),
 ]
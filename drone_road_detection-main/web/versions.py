@@ -0,0 +1,75 @@
+"""Data versions bumped whenever the web models are written.
+
+Each scope owns a monotonically increasing version and the time of its
+last bump:
+
+* ``global`` -- any write to a web model,
+* ``batch:<id>`` -- writes to one detection batch and its annotation tree,
+* ``dictionary`` -- writes to the lookup tables (disease types, weather...).
+
+Caches and conditional responses key on these versions so a write only
+has to bump a counter to invalidate them.
+"""
+
+import time
+
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import DataVersion
+
+
+GLOBAL_SCOPE = "global"
+DICTIONARY_SCOPE = "dictionary"
+
+
+def batch_scope(batch_id):
+    """Return the version scope of a detection batch."""
+    return f"batch:{batch_id}"
+
+
+def _clock():
+    return time.time_ns()
+
+
+def bump(*scopes):
+    """Advance the version of every scope, creating missing ones.
+
+    Versions are at least the current time in nanoseconds, so they keep
+    increasing even if the version table is wiped and rows are recreated.
+    Existing scopes are advanced with a single ``UPDATE``.
+    """
+    scopes = set(scopes)
+    updated = DataVersion.objects.filter(scope__in=scopes).update(
+        version=Greatest(F("version") + 1, Value(_clock())),
+        updated_at=timezone.now(),
+    )
+    if updated < len(scopes):
+        existing = set(
+            DataVersion.objects.filter(scope__in=scopes).values_list("scope", flat=True)
+        )
+        DataVersion.objects.bulk_create(
+            [DataVersion(scope=scope, version=_clock()) for scope in scopes - existing],
+            ignore_conflicts=True,
+        )
+
+
+def current(scope):
+    """Return the version of ``scope``; ``0`` if it was never written."""
+    version = (
+        DataVersion.objects.filter(scope=scope)
+        .values_list("version", flat=True)
+        .first()
+    )
+    return version or 0
+
+
+def state(scopes):
+    """Return ``{scope: (version, updated_at)}`` for the written scopes."""
+    return {
+        scope: (version, updated_at)
+        for scope, version, updated_at in DataVersion.objects.filter(
+            scope__in=scopes
+        ).values_list("scope", "version", "updated_at")
+    }
@@ -1,19 +1,33 @@
 """Views for the web app."""
 
-from itertools import groupby
-from operator import attrgetter
+import math
 
-from django.db.models import Count
-from django.http import JsonResponse
+from django.db.models import Prefetch
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.dateparse import parse_date
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from django.views.decorators.vary import vary_on_headers
 from django.conf import settings
 
+from . import counters, ingest, overlay, rollups, thumbnails
+from .decorators import (
+    batch_scopes,
+    cache_stats,
+    cached_api,
+    conditional_api,
+    global_scopes,
+)
 from .models import (
     DetectionBatch,
     DefectTrack,
-    GroundTruthFrame,
     DiseaseMedia,
+    IngestToken,
+    StatsCounter,
 )
+from .purge import media_path
 
 
 def index(request):
@@ -21,35 +35,39 @@ def index(request):
     return render(request, "web/index.html")
 
 
+def _completion(total, completed):
+    """Return ``(pending, rate)`` for the given defect totals."""
+    rate = round((completed / total * 100) if total else 0, 2)
+    return total - completed, rate
+
+
+@conditional_api(global_scopes)
+@cached_api("stats", global_scopes)
 def dashboard_stats(request):
     """Return simple dashboard statistics.
 
     If a ``batch`` query parameter is supplied the response will also include
     statistics for that specific :class:`DetectionBatch` under the ``batch``
-    key.
+    key.  Figures come from the incrementally maintained counters, so the
+    whole request is a single primary-key lookup.
     """
 
-    inspection_count = DetectionBatch.objects.count()
-    total = DefectTrack.objects.count()
-    completed = DefectTrack.objects.filter(develop_trend="已修复").count()
-    pending = total - completed
-    rate = round((completed / total * 100) if total else 0, 2)
+    batch_id = request.GET.get("batch")
+    rows = counters.lookup(batch_id)
+    totals = rows.get(counters.GLOBAL_KEY) or StatsCounter()
+    pending, rate = _completion(totals.defect_count, totals.completed_count)
 
     data = {
-        "inspection_count": inspection_count,
+        "inspection_count": totals.inspection_count,
         "pending_count": pending,
         "completion_rate": rate,
     }
 
-    batch_id = request.GET.get("batch")
     if batch_id:
-        qs = DefectTrack.objects.filter(batch_id=batch_id)
-        b_total = qs.count()
-        b_completed = qs.filter(develop_trend="已修复").count()
-        b_pending = b_total - b_completed
-        b_rate = round((b_completed / b_total * 100) if b_total else 0, 2)
+        b_totals = rows.get(counters.batch_key(batch_id)) or StatsCounter()
+        b_pending, b_rate = _completion(b_totals.defect_count, b_totals.completed_count)
         data["batch"] = {
-            "defect_count": b_total,
+            "defect_count": b_totals.defect_count,
             "pending_count": b_pending,
             "completion_rate": b_rate,
         }
@@ -57,18 +75,32 @@ def dashboard_stats(request):
     return JsonResponse(data)
 
 
+@conditional_api(global_scopes)
+@cached_api("disease_types", global_scopes)
 def disease_type_stats(request):
-    """Return distribution of disease types."""
-    qs = (
-        DefectTrack.objects.values("disease_type__name")
-        .annotate(count=Count("id"))
-        .order_by("-count")
-    )
-    labels = [i["disease_type__name"] for i in qs]
-    data = [i["count"] for i in qs]
+    """Return distribution of disease types.
+
+    Reads only the daily rollup and accepts optional ``since``/``until``
+    dates (``YYYY-MM-DD``, inclusive) and an ``airport`` filter.
+    """
+    dates = {}
+    for name in ("since", "until"):
+        value = request.GET.get(name) or ""
+        try:
+            dates[name] = parse_date(value)
+        except ValueError:
+            dates[name] = None
+        if value and dates[name] is None:
+            return JsonResponse({"error": "invalid date"}, status=400)
+    since, until = dates["since"], dates["until"]
+    rows = rollups.distribution(since, until, request.GET.get("airport"))
+    labels = [label for label, _ in rows]
+    data = [count for _, count in rows]
     return JsonResponse({"labels": labels, "data": data})
 
 
+@conditional_api(global_scopes)
+@cached_api("batches", global_scopes)
 def detection_batches(request):
     """Return recent detection batches."""
     batches = [
@@ -78,66 +110,159 @@ def detection_batches(request):
     return JsonResponse({"batches": batches})
 
 
+def _window_params(request):
+    """Parse the optional ``from_frame``/``to_frame``/``t0``/``t1`` window.
+
+    Raises ``ValueError`` for malformed or non-finite values.
+    """
+    params = {}
+    for name, cast in (
+        ("from_frame", int),
+        ("to_frame", int),
+        ("t0", float),
+        ("t1", float),
+    ):
+        value = request.GET.get(name)
+        if value not in (None, ""):
+            params[name] = cast(value)
+            if cast is float and not math.isfinite(params[name]):
+                raise ValueError(f"{name} must be finite")
+    return params
+
+
+_BOXES_CONTENT_TYPES = {
+    "json": "application/json",
+    "columnar": overlay.COLUMNAR_CONTENT_TYPE,
+}
+
+
+def _wants_columnar(request):
+    """Whether the client asked for the columnar boxes encoding."""
+    fmt = request.GET.get("format")
+    if fmt:
+        return fmt == "columnar"
+    return overlay.COLUMNAR_CONTENT_TYPE in request.headers.get("Accept", "")
+
+
+@vary_on_headers("Accept")
+@conditional_api(batch_scopes)
+@cached_api("boxes", batch_scopes)
 def anomaly_boxes(request):
-    """Return bounding boxes for anomaly frames."""
+    """Return bounding boxes for anomaly frames.
+
+    The result can be limited to a window with ``from_frame``/``to_frame``
+    (inclusive) or ``t0``/``t1`` seconds (half-open), which lets the player
+    fetch annotations chunk by chunk.  Pass ``stream=1`` to receive the
+    same payload through a streaming response that is encoded frame by
+    frame, keeping memory bounded for long flights.  ``format=columnar`` or
+    an ``Accept`` header naming :data:`overlay.COLUMNAR_CONTENT_TYPE`
+    selects the compact binary encoding instead of JSON.
+
+    Non-streaming requests for a whole finished batch are answered from
+    the materialised overlay cache.
+    """
     batch_id = request.GET.get("batch")
-    qs = GroundTruthFrame.objects.select_related(
-        "track__disease_type", "track__batch"
-    )
-    if batch_id:
-        qs = qs.filter(track__batch_id=batch_id)
-    qs = qs.order_by("frame_index")
-    frames = []
-    for frame_index, group in groupby(qs, key=attrgetter("frame_index")):
-        group = list(group)
-        time = group[0].time
-        boxes = [
-            {
-                "track": g.track_id,
-                "x": g.bbox_x,
-                "y": g.bbox_y,
-                "w": g.bbox_width,
-                "h": g.bbox_height,
-                "label": g.track.disease_type.name,
-                "start": g.track.start_frame,
-                "end": g.track.end_frame,
-            }
-            for g in group
-        ]
-        frames.append({"frame": frame_index, "time": time, "boxes": boxes})
-    video = qs.first().track.batch.video_link if qs else ""
+    try:
+        window = overlay.resolve_window(batch_id, **_window_params(request))
+    except ValueError:
+        return JsonResponse({"error": "invalid window"}, status=400)
+    encoding = "columnar" if _wants_columnar(request) else "json"
+    streaming = request.GET.get("stream") in ("1", "true")
+    if batch_id and not streaming:
+        content = overlay.cached_payload(batch_id, encoding, window)
+        if content is not None:
+            return HttpResponse(content, content_type=_BOXES_CONTENT_TYPES[encoding])
+    if encoding == "columnar":
+        return HttpResponse(
+            overlay.build_columnar(batch_id, window),
+            content_type=overlay.COLUMNAR_CONTENT_TYPE,
+        )
+    if streaming:
+        return StreamingHttpResponse(
+            overlay.stream_json(batch_id, window), content_type="application/json"
+        )
+    frames = overlay.build_frames(batch_id, window)
+    video = overlay.payload_video(batch_id, window, has_frames=bool(frames))
     return JsonResponse({"video": video, "frames": frames})
 
 
+@conditional_api(batch_scopes)
+@cached_api("tracks", batch_scopes)
 def defect_tracks(request):
-    """Return available defect tracks with snapshot and start time."""
+    """Return available defect tracks with snapshot and start time.
+
+    ``snapshot`` is the thumbnail URL of the track's image (the
+    ``TRACK_THUMBNAIL_PRESET`` size) and ``srcset`` lists every preset.
+    Tracks whose ``snapshot_link`` has no media row, or whose image is not
+    a file under ``MEDIA_ROOT`` (remote or CDN links), link it directly.
+    """
     batch_id = request.GET.get("batch")
+    sizes = thumbnails.presets()
+    preset = getattr(settings, "TRACK_THUMBNAIL_PRESET", "medium")
     tracks = []
-    qs = DefectTrack.objects.select_related("disease_type").prefetch_related("media")
+    qs = DefectTrack.objects.select_related("disease_type").prefetch_related(
+        Prefetch("media", queryset=DiseaseMedia.objects.select_related("media_type"))
+    )
     if batch_id:
         qs = qs.filter(batch_id=batch_id)
     limit = getattr(settings, "TRACK_PREVIEW_LIMIT", 5)
     qs = qs[:limit]
     for t in qs:
-        snapshot = t.snapshot_link
-        if not snapshot:
-            media = next(
-                (m for m in t.media.all() if getattr(m.media_type, "code", "") == "image"),
-                None,
+        images = [m for m in t.media.all() if getattr(m.media_type, "code", "") == "image"]
+        media = next((m for m in images if m.file_link == t.snapshot_link), None)
+        if media is None and not t.snapshot_link and images:
+            media = images[0]
+        snapshot, srcset = t.snapshot_link, ""
+        if media is not None and media_path(media.file_link) is None:
+            snapshot = media.file_link
+        elif media is not None:
+            snapshot = thumbnails.url(media.pk, media.file_link, preset)
+            srcset = ", ".join(
+                f"{thumbnails.url(media.pk, media.file_link, name)} {size}w"
+                for name, size in sizes.items()
             )
-            if media:
-                snapshot = media.file_link
         tracks.append(
             {
                 "id": t.id,
                 "label": t.disease_type.name,
                 "start": t.start_time or 0,
                 "snapshot": snapshot or "",
+                "srcset": srcset,
             }
         )
     return JsonResponse({"tracks": tracks})
 
 
+@require_GET
+def media_thumbnail(request, media_id, preset):
+    """Return a resized WebP/JPEG of a media image, see ``web.thumbnails``.
+
+    Responses may be cached for a year: thumbnail URLs change with the
+    media's ``file_link``.
+    """
+    size = thumbnails.presets().get(preset)
+    link = DiseaseMedia.objects.filter(pk=media_id).values_list("file_link", flat=True).first()
+    if size is None or link is None:
+        raise Http404("unknown media or preset")
+    fmt = thumbnails.negotiate(request)
+    try:
+        result = thumbnails.thumbnail(link, size, fmt)
+    except OSError:
+        result = None
+    if result is None:
+        raise Http404("media file is missing or not an image")
+    key, data = result
+    etag = f'"{key[:32]}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(data, content_type=thumbnails.FORMATS[fmt])
+        response["ETag"] = etag
+    patch_cache_control(response, public=True, max_age=thumbnails.MAX_AGE, immutable=True)
+    if "format" not in request.GET:
+        patch_vary_headers(response, ["Accept"])
+    return response
+
+
 def road_stats(request):
     """Return total road mileage and count configured in settings."""
     return JsonResponse(
@@ -148,6 +273,8 @@ def road_stats(request):
     )
 
 
+@conditional_api(global_scopes)
+@cached_api("weather", global_scopes)
 def current_weather(request):
     """Return today's weather and temperature based on latest batch."""
     batch = DetectionBatch.objects.order_by("-start_time").first()
@@ -155,3 +282,50 @@ def current_weather(request):
     code = batch.weather.code if batch and batch.weather else ""
     temperature = batch.temperature if batch else None
     return JsonResponse({"weather": weather, "code": code, "temperature": temperature})
+
+
+def api_cache_stats(request):
+    """Return hit/miss counters of the API response cache."""
+    return JsonResponse({"endpoints": cache_stats()})
+
+
+def _ingest_token(request):
+    """Return the active :class:`IngestToken` named by the request."""
+    scheme, _, key = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() not in ("bearer", "token") or not key.strip():
+        return None
+    return IngestToken.objects.filter(key=key.strip(), is_active=True).first()
+
+
+@csrf_exempt
+@require_POST
+def ingest_detections(request, batch_id):
+    """Store frame detections streamed by a drone, see ``web.ingest``.
+
+    Requires ``Authorization: Bearer <IngestToken.key>``; tokens bound to a
+    drone may only upload its batches, and only while the batch is
+    ``processing``.  The body is read incrementally, never as a whole.
+    """
+    token = _ingest_token(request)
+    if token is None:
+        response = JsonResponse({"error": "authentication required"}, status=401)
+        response["WWW-Authenticate"] = 'Bearer realm="ingest"'
+        return response
+    batch = DetectionBatch.objects.filter(pk=batch_id).first()
+    if batch is None:
+        return JsonResponse({"error": "unknown batch"}, status=404)
+    if token.drone_id and token.drone_id != batch.drone_id:
+        return JsonResponse({"error": "token not valid for this drone"}, status=403)
+    if batch.status != "processing":
+        return JsonResponse({"error": "batch is not processing"}, status=409)
+    encoding = request.headers.get("Content-Encoding", "").strip().lower()
+    if encoding not in ingest.ENCODINGS:
+        return JsonResponse({"error": "unsupported content encoding"}, status=415)
+
+    try:
+        stats = ingest.ingest(batch, ingest.iter_lines(request, encoding))
+    except ingest.IngestError as exc:
+        return JsonResponse({"error": exc.message, "line": exc.line, **exc.stats}, status=400)
+    except (ValueError, OSError, EOFError) as exc:
+        return JsonResponse({"error": "invalid upload", **getattr(exc, "stats", {})}, status=400)
+    return JsonResponse(stats)